@@ -14,14 +14,23 @@ import logging
 # Setup logging before importing any crosstex things
 logging.basicConfig(format='%(message)s')
 
+import collections
 import copy
+import hashlib
+import heapq
 import importlib
 import itertools
 import operator
+import os.path
 import re
 
+import crosstex.cache
+import crosstex.constants
 import crosstex.objects
 import crosstex.parse
+import crosstex.rendered
+import crosstex.search
+import crosstex.style
 
 class CrossTeXError(Exception): pass
 
@@ -64,23 +73,33 @@ class Constraint(object):
     def empty(self):
         return not len(self._fields)
 
+    def candidates(self, index, alias):
+        '''The keys that may match, or None if any key may.
+
+        index is the crosstex.search.Index of the entries and alias maps keys
+        to the keys they stand for.  Every key that matches is among the
+        candidates, but not every candidate matches.
+        '''
+        values = [v for field, vs in self._fields.items()
+                  if field not in crosstex.search.UNINDEXED for v in vs]
+        return index.candidates(values, alias)
+
+    def _strings(self, value):
+        if isinstance(value, crosstex.parse.Value):
+            return [str(value.value).lower()]
+        if isinstance(value, crosstex.objects.string):
+            return [s for name in ('name', 'shortname', 'longname')
+                    for s in self._strings(getattr(value, name))]
+        if isinstance(value, list):
+            return [s for v in value for s in self._strings(v)]
+        return []
+
     def match(self, entry):
         entry = entry[0]
         for field, values in self._fields.items():
             if not hasattr(entry, field):
                 return False
-            tocheck = getattr(entry, field)
-            strings = set([])
-            if isinstance(tocheck, crosstex.parse.Value):
-                strings.add(str(tocheck.value).lower())
-            elif isinstance(tocheck, crosstex.objects.string):
-                strings.add(str(tocheck.name.value).lower())
-                strings.add(str(tocheck.shortname.value).lower())
-                strings.add(str(tocheck.longname.value).lower())
-            elif field == 'author' and isinstance(tocheck, list):
-                for a in tocheck:
-                    strings.add(str(a.value).lower())
-            strings = tuple(strings)
+            strings = tuple(set(self._strings(getattr(entry, field))))
             for value in values:
                 v = value.lower()
                 found = False
@@ -92,19 +111,296 @@ class Constraint(object):
                     return False
         return True
 
-class Database(object):
+def _same_entries(old, new, changed):
+    '''Whether two lists of Entry objects hold the same, apart from their uids.
+
+    The fields of an old entry from a memory-mapped database that were never
+    decoded cannot be decoded any more if its file changed since, in which
+    case the entry is taken to have changed; changed holds the names of the
+    files that did.
+    '''
+    if len(old) != len(new):
+        return False
+    for a, b in zip(old, new):
+        if a[1:3] + a[4:] != b[1:3] + b[4:]:
+            return False
+        if isinstance(a.fields, crosstex.parse.LazyFields) and not a.fields.materialized:
+            if a.file in changed:
+                return False
+            continue
+        if tuple(a.fields) != tuple(b.fields):
+            return False
+    return True
+
+def _portable(log):
+    'A log as it is stored, with what each record says rather than the record.'
+    return [item if isinstance(item, str) else (item.name, item.levelno, item.getMessage())
+            for item in log]
+
+def _unportable(log):
+    'A log as it was before _portable.'
+    return [item if isinstance(item, str) else
+            logging.makeLogRecord({'name': item[0], 'levelno': item[1],
+                                   'levelname': logging.getLevelName(item[1]), 'msg': item[2]})
+            for item in log]
+
+class _Recorder(logging.Handler):
+    'Hold on to what is logged while objects are resolved, for Database to replay.'
 
     def __init__(self):
+        logging.Handler.__init__(self)
+        self.frames = []
+        self.paused = 0
+        self.holding = False
+
+    def emit(self, record):
+        if self.frames and not self.paused:
+            self.frames[-1].append(record)
+
+    def hold(self, record):
+        'A filter for the logger that records what it is given, but lets nothing through.'
+        self.emit(record)
+        return False
+
+class _Chain(object):
+    'A sequence of conditionals made of others, which it shares rather than copies.'
+
+    def __init__(self, parts):
+        self._parts = tuple([part for part in parts if len(part)])
+        self._length = sum([len(part) for part in self._parts])
+
+    def __len__(self):
+        return self._length
+
+    def __reversed__(self):
+        # The parts being gone through, each with the position reached in it
+        parts = [reversed(self._parts)]
+        while parts:
+            for part in parts[-1]:
+                if isinstance(part, _Chain):
+                    parts.append(reversed(part._parts))
+                    break
+                for c in reversed(part):
+                    yield c
+            else:
+                parts.pop()
+
+class _Sweep(object):
+    '''The conditionals that may apply to an object being resolved.
+
+    Database._build goes through them in passes, always in the same order:
+    the object's own conditionals last first, then those of each object it
+    inherited from, in the order it did, each last first too.  A pass only
+    goes through those it did not look at since the fields they test were
+    last set, as the others cannot match if they did not then.
+    '''
+
+    def __init__(self):
+        self.conditionals = []
+        # The positions of the conditionals testing each field
+        self._testing = collections.defaultdict(list)
+        # The positions to go through in the next pass, besides those from
+        # fresh on, which were never gone through
+        self._dirty = set([])
+        self._fresh = 0
+        self._queue = None
+        self._position = None
+
+    def add(self, conditionals):
+        'Add conditionals (a list or _Chain), to be gone through last first.'
+        self.conditionals.extend(reversed(conditionals))
+
+    def changed(self, name):
+        'Note that the field name was set.'
+        for position in self._testing.get(name, ()):
+            if self._queue is None or position <= self._position:
+                self._dirty.add(position)
+            elif position not in self._queued:
+                # Still ahead in this pass
+                heapq.heappush(self._queue, position)
+                self._queued.add(position)
+
+    def __iter__(self):
+        'Go through the conditionals to look at in this pass, in order.'
+        self._queue = sorted(self._dirty)
+        self._queued = set(self._queue)
+        self._dirty = set([])
+        try:
+            while self._queue:
+                self._position = heapq.heappop(self._queue)
+                yield self.conditionals[self._position]
+            # Then those never gone through, which come after all the others
+            fresh, self._fresh = self._fresh, len(self.conditionals)
+            for self._position in range(fresh, self._fresh):
+                c = self.conditionals[self._position]
+                for f in c.if_fields:
+                    self._testing[f.name].append(self._position)
+                yield c
+        finally:
+            self._queue = None
+
+class Database(object):
+
+    def __init__(self, tokenizer='ply', use_mmap=False, jobs=1,
+                 cache_dir=None, use_cache=True, cache_size=crosstex.constants.CACHE_SIZE,
+                 columnar=False):
         self._path = ['.']
-        self._parser = crosstex.parse.Parser(self._path)
+        cache = None
+        if use_cache:
+            cache = crosstex.cache.CacheStore(cache_dir, crosstex.parse.GRAMMAR_VERSION,
+                                              cache_size)
+        self._parser = crosstex.parse.Parser(self._path, tokenizer=tokenizer,
+                                             use_mmap=use_mmap, jobs=jobs, cache=cache,
+                                             columnar=columnar)
+        self._store = cache
+        self._files = []
         self._cache = {}
+        self._logs = {}
+        self._replayed = set([])
+        self._recorder = _Recorder()
+        self._depends = {}
+        self._reads = []
+        self._references = {}
+        self._digests = {}
+        self._resolved_in = None
+        self._matchers = {}
+        # The keys of the objects resolved since they were last stored, and
+        # of those taken from the cache that it should keep for these sources
+        self._unsaved = []
+        self._renewed = set([])
 
     def append_path(self, path):
         self._path.append(path)
         self._parser.set_path(self._path)
 
     def parse_file(self, path):
+        self._files.append(path)
         self._parser.parse(path)
+        self._parsed()
+        # What was resolved so far may not hold for the databases parsed now
+        self._unsaved = []
+        self._renewed = set([])
+
+    def bibdata(self, path):
+        return self._parser.bibdata(path)
+
+    def parse_document(self, path):
+        'Parse the .aux file of another document and return its citations.'
+        citations = self._parser.parse_document(path)
+        self._parsed()
+        # What was resolved so far may not hold for the databases parsed now
+        self._unsaved = []
+        self._renewed = set([])
+        return copy.copy(citations)
+
+    def start_document(self):
+        '''Start looking up the citations of another document.
+
+        Objects resolved for the documents before are reused, and what was
+        logged while resolving them is logged again when this one uses them,
+        as if they were resolved for it alone.
+        '''
+        self._replayed = set([])
+
+    def forked(self):
+        'Call in a process forked from this one.'
+        if self._store is not None:
+            self._store.forked()
+
+    def reload(self):
+        '''Parse the same files again, after some of them changed.
+
+        Databases that did not change are not parsed again (see
+        Parser.renew).  Resolved objects are kept, unless the entries or the
+        alias of a key they depend on changed; what was logged while resolving
+        them is logged again when they are next used.
+        '''
+        old, new = self._parser, self._parser.renew()
+        for path in self._files:
+            new.parse(path)
+        self._parser = new
+        self._replayed = set([])
+        self._parsed()
+        if old.sources == new.sources:
+            # The same databases, unchanged since; only the citations changed.
+            # Keep the entries already read, which every resolved object's
+            # dependencies are among, for the next reload to compare.
+            new.entries = old.entries
+            return
+        files = set([os.path.basename(path) for path, stat in set(old.sources) ^ set(new.sources)])
+        changed = {}
+        def stale(key):
+            if key is None:
+                return True
+            if key not in changed:
+                changed[key] = old.alias.get(key) != new.alias.get(key) or \
+                               not _same_entries(old.entries.get(key, []), new.entries.get(key, []), files)
+            return changed[key]
+        for key, depends in list(self._depends.items()):
+            if any(stale(k) for k in depends):
+                logger.debug('Resolving %s again.' % key)
+                self._cache.pop(key, None)
+                self._logs.pop(key, None)
+                del self._depends[key]
+
+    def _parsed(self):
+        'Forget what was worked out from the entries, after parsing more of them.'
+        self._references = {}
+        self._digests = {}
+        self._resolved_in = None
+        self._matchers = {}
+
+    def inputs(self):
+        'The paths of the files parsed and of the directories searched for them.'
+        return self._parser.inputs()
+
+    def load_rendered(self, document, context):
+        if self._store is None:
+            return None
+        return self._store.load_rendered(document, context)
+
+    def store_rendered(self, document, context, items):
+        if self._store is not None:
+            self._store.store_rendered(document, context, items)
+
+    def store_resolved(self):
+        '''Keep the objects resolved since the last call in the cache, for later runs.
+
+        They are taken from there instead of being resolved again for as long
+        as the entries and aliases they were resolved from do not change (see
+        _restore).  Each object is stored without the other objects it took
+        fields and conditionals from, which are stored under their own keys.
+        '''
+        if self._store is None or not (self._unsaved or self._renewed):
+            return
+        context, sources = self._resolved_context()
+        # What stands for each object, and for its conditionals, in the
+        # objects that took them
+        references = {}
+        for key, (obj, conditionals) in self._cache.items():
+            references.setdefault(id(obj), (0, key))
+            references.setdefault(id(conditionals), (1, key))
+        rows = []
+        for keys in self._unsaved:
+            key = next(iter(keys))
+            if key not in self._cache:
+                # Dropped by reload since
+                continue
+            resolved = self._cache[key]
+            depends = dict([(k, self._digest(k)) for k in self._depends[key]])
+            try:
+                payload, referred = crosstex.cache.dumps_referring(resolved, references,
+                                                                   set(map(id, resolved)))
+                data = crosstex.cache.dumps((keys, _portable(self._logs[key]), depends,
+                                             referred, payload))
+            except Exception as e:
+                logger.debug('Cannot keep %s in the cache: %s.' % (key, e))
+                continue
+            rows.append((keys, data))
+        self._store.store_resolved(context, sources, [path for path, stat in self._parser.sources],
+                                   rows, [k for k in self._renewed if k in self._cache])
+        self._unsaved = []
+        self._renewed = set([])
 
     def aux_citations(self):
         return copy.copy(self._parser.citations)
@@ -124,6 +420,37 @@ class Database(object):
     def titlesmalls(self):
         return copy.copy(self._parser.titlesmalls)
 
+    def titlephrases_matcher(self):
+        'The titlephrases as a crosstex.style.Phrases, built once for all titles.'
+        return self._matcher('titlephrases')
+
+    def titlesmalls_matcher(self):
+        'The titlesmalls as a crosstex.style.Phrases, built once for all titles.'
+        return self._matcher('titlesmalls')
+
+    def _matcher(self, which):
+        if which not in self._matchers:
+            self._matchers[which] = crosstex.style.Phrases(getattr(self._parser, which))
+        return self._matchers[which]
+
+    def sources(self):
+        'The (path, signature) of each database parsed, in the order they were merged.'
+        return tuple(self._parser.sources)
+
+    def share_resolved(self, pool):
+        '''Share the objects resolved from the same databases with other Databases.
+
+        pool is a dictionary from the sources of a Database to what it
+        resolved.  If another Database with the same sources put its objects
+        there, this one takes them over; otherwise it adds its own.  Call this
+        after parsing and before looking anything up.
+        '''
+        key = self.sources()
+        if key in pool:
+            self._cache, self._logs, self._depends = pool[key]
+        else:
+            pool[key] = (self._cache, self._logs, self._depends)
+
     def lookup(self, key):
         if key.startswith('!'):
             return self._semantic_lookup(key)
@@ -132,12 +459,19 @@ class Database(object):
 
     def _semantic_lookup(self, key, context=None):
         '''Resolve an entry matching the constrained citation.'''
+        # Any entry might match
+        self._depend(None)
         const = Constraint(key)
         if const.empty():
             logger.error('Empty constraint "%s".' % key)
             return None
         matches = []
-        for k in self._parser.entries.keys():
+        keys = const.candidates(self._parser.entries.index(), self._parser.alias)
+        if keys is None:
+            keys = self._parser.entries.keys()
+        else:
+            keys = self._parser.entries.ordered(keys)
+        for k in keys:
             obj = self._lookup(k)
             if obj and const.match(obj):
                 matches.append(obj)
@@ -154,11 +488,21 @@ class Database(object):
         the entry is stable and return the result.
         '''
 
+        self._depend(key)
         if key in self._parser.alias:
-            key = self._parser.alias[key]
-            if key.startswith('!'):
-                return self._semantic_lookup(key)
-            return self._lookup(key)
+            # Follow aliases to the key they stand for
+            aliases = [key]
+            seen = set(aliases)
+            while key in self._parser.alias:
+                key = self._parser.alias[key]
+                if key.startswith('!'):
+                    return self._semantic_lookup(key)
+                aliases.append(key)
+                if key in seen:
+                    logger.error('There is a reference cycle: %s' % ', '.join(aliases))
+                    return (None, None)
+                seen.add(key)
+                self._depend(key)
 
         # Check for loops
         context = list(context or [])
@@ -168,10 +512,306 @@ class Database(object):
             return (None, None)
         context.append(key)
 
+        if key not in self._cache:
+            self._restore(key)
+        if key not in self._cache and not self._reads:
+            self._prepare(key)
+
         # This makes things about 30% faster
         if key in self._cache:
+            self._replay(key)
+            if self._reads:
+                self._reads[-1].update(self._depends.get(key, ()))
             return self._cache[key]
+        return self._resolve(key, context)
+
+    def _prepare(self, key):
+        '''Resolve what the object for key refers to before key itself.
+
+        The keys are resolved in the order _plan gives, each after every key
+        it may look up, so that none of them has to look up anything that is
+        not memoized and resolving goes no deeper however long the chains of
+        references.  Nothing is logged meanwhile: what would have been is
+        logged when key is resolved and looks the objects up, in the same
+        order as if it had resolved them itself.
+        '''
+        recorder = self._recorder
+        recorder.holding = True
+        logger.addFilter(recorder.hold)
+        try:
+            for k in self._plan(key):
+                if k not in self._cache and not self._restore(k):
+                    self._resolve(k, [k])
+        except Exception:
+            # Possibly for a reference that key never follows; resolving key
+            # finds out.
+            pass
+        finally:
+            logger.removeFilter(recorder.hold)
+            recorder.holding = False
+
+    def _plan(self, key):
+        '''The keys to resolve before key, in the order to resolve them.
+
+        Finds the strongly connected components of the keys the object for
+        key may refer to, directly or not, and lists each key after every key
+        it may look up.  Keys that are part of a cycle, or that may look up
+        one, are left out along with key itself: resolving them is logged
+        with the references that led to each cycle, so they are only resolved
+        as they are looked up.  Keys already resolved are not gone through.
+        '''
+        references = self._references_of(key)
+        if references is None or all([r in self._cache for r in references]):
+            return []
+        index = {key: 0}
+        low = {key: 0}
+        stack = [key]
+        # Each key being gone through, its references and where it is in stack
+        work = [(key, iter(references), 0)]
+        unsafe = set([])
+        order = []
+        while work:
+            k, references, position = work[-1]
+            for r in references:
+                if r in index:
+                    if r in low:
+                        low[k] = min(low[k], index[r])
+                    continue
+                if r in self._cache:
+                    continue
+                index[r] = low[r] = len(index)
+                work.append((r, iter(self._references_of(r) or ()), len(stack)))
+                stack.append(r)
+                break
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent], low[k])
+                if low[k] != index[k]:
+                    continue
+                component = stack[position:]
+                del stack[position:]
+                for c in component:
+                    # Out of the stack: no longer in a cycle with what is
+                    del low[c]
+                refs = [self._references_of(c) for c in component]
+                if len(component) > 1 or None in refs or k in refs[0] or \
+                   any(r in unsafe for rs in refs for r in rs):
+                    unsafe.update(component)
+                else:
+                    order.append(k)
+        return [k for k in order if k != key]
+
+    def _references_of(self, key):
+        '''The keys that resolving key may look up, after following aliases.
+
+        None if it may look up any key or one that is not defined, which
+        raises an error.  These are all the keys the entries selected for key
+        refer to, from any field, default or conditional, and the authors and
+        editors they name, whether or not resolving them uses them.
+        '''
+        if key in self._references:
+            return self._references[key]
+        alias = self._parser.alias
+        entries = self._parser.entries
+        if key not in entries:
+            references = None
+        else:
+            references = set([])
+            for k in entries.group(key):
+                for entry in entries.get(k, []):
+                    for f in itertools.chain(entry.defaults, entry.fields):
+                        fields = f.then_fields if isinstance(f, crosstex.parse.Conditional) else (f,)
+                        for name, value in fields:
+                            if value.kind == 'key':
+                                references.add(value.value)
+                            elif name in ('author', 'editor'):
+                                # Those resolved already are certainly defined
+                                references.update([n for n in _author.split(value.value)
+                                                   if n in self._cache or n in entries])
+            references = [self._unalias(r) if r in alias else r for r in references]
+            references = None if None in references else tuple(references)
+        self._references[key] = references
+        return references
+
+    def _restore(self, key):
+        '''Take the object for key from the cache, if it is there and still valid.
+
+        It is valid if the databases have the signatures they had when it was
+        stored, or if the entries and alias of each key it depends on have
+        the digest they had then.  The objects it looked up, and those it
+        took fields and conditionals from, are restored along with it.
+        Returns whether it was restored.
+        '''
+        if self._store is None:
+            return False
+        context, sources = self._resolved_context()
+        found = {}
+        renewed = []
+        todo = [key]
+        while todo:
+            k = todo.pop()
+            if k in self._cache or k in found:
+                continue
+            row = self._store.load_resolved(context, k)
+            if row is None:
+                return False
+            try:
+                found[k] = crosstex.cache.loads(row[1])
+            except Exception:
+                return False
+            keys, log, depends, referred, payload = found[k]
+            if row[0] != sources:
+                if None in depends or \
+                   any([self._digest(d) != digest for d, digest in depends.items()]):
+                    return False
+                renewed += keys
+            todo += [item for item in log if isinstance(item, str)]
+            todo += [r for which, r in referred]
+        # Restore each object after those it took from, which its pickle
+        # refers to
+        order = []
+        placed = set([])
+        for first in found:
+            if first in placed:
+                continue
+            placed.add(first)
+            stack = [(first, iter(found[first][3]))]
+            while stack:
+                k, referred = stack[-1]
+                for which, r in referred:
+                    if r in found and r not in placed:
+                        placed.add(r)
+                        stack.append((r, iter(found[r][3])))
+                        break
+                else:
+                    stack.pop()
+                    order.append(k)
+        resolve = lambda reference: self._cache[reference[1]][reference[0]]
+        for k in order:
+            keys, log, depends, referred, payload = found[k]
+            try:
+                resolved = crosstex.cache.loads_referring(payload, resolve)
+            except Exception:
+                return False
+            log = _unportable(log)
+            depends = set(depends)
+            for k in keys:
+                if k not in self._cache:
+                    self._cache[k] = resolved
+                    self._logs[k] = log
+                    self._depends[k] = depends
+        self._renewed.update(renewed)
+        return True
+
+    def _resolved_context(self):
+        '''The context the objects resolved from these databases are stored in.
 
+        Returns (context, sources), digests of the paths of the databases and
+        the level of the logger, which the objects and their logs depend on,
+        and of the databases' signatures.
+        '''
+        if self._resolved_in is None:
+            sources = self._parser.sources
+            context = repr(([path for path, stat in sources], logger.getEffectiveLevel()))
+            self._resolved_in = (hashlib.sha1(context.encode('utf-8')).hexdigest(),
+                                 hashlib.sha1(repr(sources).encode('utf-8')).hexdigest())
+        return self._resolved_in
+
+    def _digest(self, key):
+        '''A digest of the entries and alias of key, which objects depending on it read.
+
+        None stands for every key, and has no digest.
+        '''
+        if key is None:
+            return None
+        if key not in self._digests:
+            entries = [(e.kind, e.keys, tuple(e.fields), e.file, e.line, e.defaults)
+                       for e in self._parser.entries.get(key, [])]
+            text = repr((self._parser.alias.get(key), entries))
+            self._digests[key] = hashlib.sha1(text.encode('utf-8')).hexdigest()
+        return self._digests[key]
+
+    def _depend(self, key):
+        '''Note that the object being resolved depends on the entries and alias of key.
+
+        None stands for every key.
+        '''
+        if self._reads:
+            self._reads[-1].add(key)
+
+    def _unalias(self, key):
+        'The key that key stands for, or None if an alias for a constraint or a cycle of aliases.'
+        seen = set([key])
+        while key in self._parser.alias:
+            key = self._parser.alias[key]
+            if key.startswith('!') or key in seen:
+                return None
+            seen.add(key)
+        return key
+
+    def _replay(self, key):
+        '''Log again what was logged when the object for key was resolved.
+
+        This happens only the first time this Database uses the object, and
+        only if it was resolved by another Database sharing it (see
+        share_resolved) or before it was needed (see _prepare), so that the
+        messages are the same as if it had been resolved as it was looked up.
+        '''
+        recorder = self._recorder
+        if recorder.frames and not recorder.paused:
+            recorder.frames[-1].append(key)
+        if recorder.holding:
+            return
+        recorder.paused += 1
+        try:
+            # The logs being replayed, each with the position reached in it
+            logs = [iter([key])]
+            while logs:
+                for item in logs[-1]:
+                    if not isinstance(item, str):
+                        logging.getLogger(item.name).handle(item)
+                        continue
+                    log = self._logs.get(item)
+                    if log is not None and id(log) not in self._replayed:
+                        self._replayed.add(id(log))
+                        logs.append(iter(log))
+                        break
+                else:
+                    logs.pop()
+        finally:
+            recorder.paused -= 1
+
+    def _resolve(self, key, context):
+        '''Resolve key, recording what is logged meanwhile.
+
+        The log of an object that is memoized consists of the records logged
+        while resolving it and the keys of the memoized objects it looked up;
+        the log of one that is not is part of the log of whatever looked it up.
+        '''
+        recorder = self._recorder
+        if not recorder.frames:
+            logger.addHandler(recorder)
+        recorder.frames.append([])
+        self._reads.append(set([]))
+        try:
+            result = self._build(key, context)
+        finally:
+            log = recorder.frames.pop()
+            if not recorder.frames:
+                logger.removeHandler(recorder)
+            reads = self._reads.pop()
+            if self._reads:
+                self._reads[-1].update(reads)
+        if recorder.frames:
+            if self._logs.get(key) is log:
+                recorder.frames[-1].append(key)
+            else:
+                recorder.frames[-1].extend(log)
+        return result
+
+    def _build(self, key, context):
         # Lookup all raw Entry objects
         keys, base, extensions = self._select(key)
         if base is None:
@@ -216,28 +856,41 @@ class Database(object):
 
         # This loop resolves conditionals or references until the object reaches
         # a fixed point
-        anotherpass = True
         applied_conditionals = set([])
-        while anotherpass:
-            anotherpass = False
+        sweep = _Sweep()
+        sweep.add(conditionals)
+        # The conditionals of the object and of those it inherits from, the
+        # last inherited first
+        inherited = [conditionals]
+        # The fields that may still refer to another object, and those that
+        # may still name authors, in the order of fields
+        references = [name for name, value in fields.items() if value.kind == 'key']
+        names = [name for name in fields if name in ('author', 'editor')]
+        while True:
             # This loop pulls references from other objects
-            for name, value in fields.items():
-                if not isinstance(value, crosstex.parse.Value):
-                    continue
-                if value.kind != 'key':
+            found = False
+            for name in list(references):
+                value = fields[name]
+                if not isinstance(value, crosstex.parse.Value) or value.kind != 'key':
+                    references.remove(name)
                     continue
                 obj, conds = self._lookup(value.value, context)
                 if obj is not None:
                     assert conds is not None
                     fields[name] = obj
-                    conditionals = conds + conditionals
-                    anotherpass = True
+                    references.remove(name)
+                    sweep.changed(name)
+                    inherited.append(conds)
+                    sweep.add(conds)
+                    found = True
                     break
             # We want to make only one change at a time
-            if anotherpass:
+            if found:
                 continue
+            # What a conflicting value is compared with below
+            value = next(reversed(fields.values())) if fields else None
             # This loop applies conditionals
-            for c in reversed(conditionals):
+            for c in sweep:
                 if c in applied_conditionals:
                     continue
                 # Skip if not all of the fields match
@@ -256,6 +909,11 @@ class Database(object):
                         # things up willy-nilly
                         fields[f.name] = f.value
                         dupes.add(f.name)
+                        sweep.changed(f.name)
+                        if f.value.kind == 'key':
+                            references.append(f.name)
+                        if f.name in ('author', 'editor'):
+                            names.append(f.name)
                     elif f.name in kind.allowed:
                         if f.value.kind == 'key':
                             obj, conds = self._lookup(f.value.value, context)
@@ -268,29 +926,32 @@ class Database(object):
                 applied_conditionals.add(c)
 
             # This loop expands author/editor fields
-            for name, value in fields.items():
-                if name not in ('author', 'editor'):
-                    continue
-
+            for name in names:
+                value = fields[name]
                 if not isinstance(value, crosstex.parse.Value):
                     continue
 
-                names = []
+                expanded = []
                 for n in _author.split(value.value):
+                    self._depend(n)
                     if n in self._parser.entries:
                         obj, conds = self._lookup(n, context)
                     else:
                         obj, conds = None, None
                     if obj is not None:
                         assert conds is not None
-                        names.append(obj)
-                        conditionals = conds + conditionals
+                        expanded.append(obj)
+                        inherited.append(conds)
+                        sweep.add(conds)
                     else:
-                        names.append(crosstex.parse.Value(file=value.file, line=value.line, kind='string', value=n))
-                fields[name] = names
-                anotherpass = True
+                        expanded.append(crosstex.parse.Value(file=value.file, line=value.line, kind='string', value=n))
+                fields[name] = expanded
+                sweep.changed(name)
                 break
-        
+            else:
+                break
+        conditionals = _Chain(inherited[::-1])
+
         # Do a pass over alternate fields to copy them
         for name, alternates in kind.alternates.items():
             if name not in fields:
@@ -310,46 +971,33 @@ class Database(object):
         k = kind(**fields)
         
         # Memoize
+        log = self._recorder.frames[-1]
+        if not self._recorder.holding:
+            self._replayed.add(id(log))
         for key in keys:
             self._cache[key] = (k, conditionals)
+            self._logs[key] = log
+            self._depends[key] = self._reads[-1]
+        self._unsaved.append(keys)
         return k, conditionals
 
     def _select(self, key):
         '''Select Entry objects tagged with "key".
 
-        Aliases will be transitively followed to select all Entry objects.
+        Aliases will be transitively followed to select all Entry objects;
+        the parser keeps them grouped (see crosstex.parse.Entries.select).
 
         The return value will be a tuple of (keys, base, extensions).  "keys"
         will be a set consisting of key and all its aliases.  "base" will be the
         Entry object that the key maps to.  "extensions" will be a list of
         objects that extend "base".
         '''
-        keys = set([])
-        todo = set([key])
-        seen = set([])
-        base = None
-        extensions = []
-
-        while todo:
-            key = todo.pop()
-            keys.add(key)
-            for entry in self._parser.entries.get(key, []):
-                if entry.uid in seen:
-                    continue
-
-                seen.add(entry.uid)
-
-                if entry.kind == 'extend':
-                    extensions.append(entry)
-                elif base is None:
-                    base = entry
-                else:
-                    logger.error('%s:%d: Alias %s is also defined at %s:%d.' %
-                                 (base.file, base.line, key, entry.file, entry.line))
-                    continue
-                for k in entry.keys:
-                    if k not in keys:
-                        todo.add(k)
+        keys, base, extensions, duplicates = self._parser.entries.select(key)
+        for k in keys:
+            self._depend(k)
+        for k, entry in duplicates:
+            logger.error('%s:%d: Alias %s is also defined at %s:%d.' %
+                         (base.file, base.line, k, entry.file, entry.line))
 
         if base is None:
             if extensions:
@@ -366,13 +1014,20 @@ class Database(object):
 
 class CrossTeX(object):
 
-    def __init__(self, xtx_path=None):
-        self._db = Database()
+    def __init__(self, xtx_path=None, tokenizer='ply', use_mmap=False, jobs=1,
+                 cache_dir=None, use_cache=True, cache_size=crosstex.constants.CACHE_SIZE,
+                 columnar=False):
+        self._db = Database(tokenizer=tokenizer, use_mmap=use_mmap, jobs=jobs,
+                            cache_dir=cache_dir, use_cache=use_cache,
+                            cache_size=cache_size, columnar=columnar)
         for p in xtx_path or []:
             self._db.append_path(p)
         self._flags = set([])
         self._options = {}
         self._style = None
+        self._style_name = None
+        self._document = None
+        self._context = None
 
     def no_pages(self):
         self._flags.add('no-pages')
@@ -417,6 +1072,16 @@ class CrossTeX(object):
         if fmt not in styleclass.formats():
             raise CrossTeXError('Style %r does not support format %r' % (style, fmt))
         self._style = styleclass(fmt, self._flags, self._options, self._db)
+        self._style_name = (style, fmt)
+        self._context = None
+
+    def keep_rendered(self, document):
+        '''Keep what is rendered for document in the cache, to reuse in later runs.
+
+        Only what changed since is rendered again (see crosstex.rendered).
+        '''
+        self._document = document
+        self._context = None
 
     def parse(self, xtxname):
         self._db.parse_file(xtxname)
@@ -436,13 +1101,53 @@ class CrossTeX(object):
     def lookup(self, key):
         return self._db.lookup(key)
 
+    def sources(self):
+        return self._db.sources()
+
+    def bibdata(self, path):
+        return self._db.bibdata(path)
+
+    def parse_document(self, path):
+        '''Parse the .aux file of another document and return its citations.
+
+        The databases it uses are only merged if no document parsed before
+        used them already; call bibdata first to tell whether they would be
+        the same (see crosstex.cmd.batch).
+        '''
+        return self._db.parse_document(path)
+
+    def start_document(self, document):
+        '''Start on the bibliography of a document parsed with parse_document.
+
+        What is rendered is kept for document (see keep_rendered) and the
+        objects resolved for the documents before are reused.
+        '''
+        self.keep_rendered(document)
+        self._db.start_document()
+
+    def forked(self):
+        self._db.forked()
+
+    def reload(self):
+        self._db.reload()
+
+    def inputs(self):
+        return self._db.inputs()
+
+    def share_resolved(self, pool):
+        self._db.share_resolved(pool)
+
     def sort(self, citations, fields=None):
         if self._style is None:
             raise CrossTeXError('Cannot sort citations because no style is set')
         fields = fields or []
         citations = list(citations)
         citations = sorted(citations, key=operator.itemgetter(0))
-        citations = sorted(citations, key=self._style.sort_key)
+        self._rendered()
+        def sort_key(x):
+            k, o = x
+            return self._style.reuse('sort', k, o, self._style.sort_key, x)
+        citations = sorted(citations, key=sort_key)
         for field, reverse in reversed(fields):
             def sort_key(x):
                 k, o = x
@@ -463,7 +1168,32 @@ class CrossTeX(object):
         return new_citations
 
     def render(self, citations):
-        return self._style.render(citations)[1]
+        return self.render_with_labels_dict(citations)[1]
 
     def render_with_labels_dict(self, citations):
-        return self._style.render(citations)
+        rendered = self._rendered()
+        result = self._style.render(citations)
+        if self._document is not None and \
+           (rendered.computed or set(rendered.items) != set(rendered.previous)):
+            self._db.store_rendered(self._document, self._context, rendered.items)
+        rendered.advance()
+        self._db.store_resolved()
+        return result
+
+    def _rendered(self):
+        '''Set up the style to reuse what was computed before, in the same context.
+
+        The context is everything besides the objects cited that the style
+        depends upon.
+        '''
+        context = repr((self._style_name, sorted(self._flags), sorted(self._options.items()),
+                        sorted(self._db.titlephrases()), sorted(self._db.titlesmalls()),
+                        logger.getEffectiveLevel()))
+        context = hashlib.sha1(context.encode('utf-8')).hexdigest()
+        if context != self._context:
+            previous = None
+            if self._document is not None:
+                previous = self._db.load_rendered(self._document, context)
+            self._style.rendered = crosstex.rendered.RenderedItems(previous)
+            self._context = context
+        return self._style.rendered
@@ -0,0 +1,941 @@
+'''
+A single-file store for parsed databases.
+
+The cache is one SQLite file, CACHE_FILE_NAME, in a cache directory that
+defaults to $XDG_CACHE_HOME/crosstex, with a row for each database.  Rows
+that have not been used for the longest time are evicted once the cache
+grows beyond its maximum size.  The entries of a database are stored one per
+row, in the order they were created, along with an index of their keys, so
+that a cached database can be merged without reading any of its entries; they
+are fetched by key when looked up (see StoredEntries).  The first time a
+constrained citation is looked up in a database, its index (see
+crosstex.search) is stored along with it, a row for each word and for each key
+other entries refer to.
+
+A row is only used if the content digest of
+the database, the CrossTeX version and the grammar version all match what it
+was written with, so edits, upgrades and grammar changes each invalidate it.
+The digest is only recomputed when the file no longer has the size, times and
+inode recorded with it.
+
+Each database that was parsed on its own (rather than through @include) also
+gets a Manifest, recording everything parsing it and the files it includes
+depended upon, so that the whole tree can be checked and loaded at once.
+The listings of the directories searched for databases are kept as well (see
+crosstex.paths), and used for as long as a directory has the same signature.
+So is what was last rendered for each document (see crosstex.rendered).
+
+Objects resolved from the entries are stored as well, once for all the keys
+naming them, in a context naming the databases they were resolved from.
+Along with an object are the keys whose entries and aliases resolving it
+read, each with a digest of what they were then, and the signatures of the
+databases.  Objects are reused as they are while the databases keep the same
+signatures; otherwise only those for which one of these digests changed are
+resolved again (see Database._restore).
+
+Resolved objects and rendered items count towards the maximum size of the
+cache like databases do, and what has not been used for the longest time is
+evicted first: the objects of a context are evicted all at once, along with
+every context resolved from a database that is evicted.  Contexts
+that were not used for CONTEXT_LIFETIME are dropped by prune.
+'''
+
+import collections
+import copy
+import errno
+import hashlib
+import io
+import logging
+import os
+import sqlite3
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import cPickle as pickle
+except:
+    import pickle
+
+import crosstex.search
+from crosstex.constants import *
+
+logger = logging.getLogger('crosstex.parse')
+
+SCHEMA_VERSION = 13
+
+SCHEMA = ('''
+CREATE TABLE IF NOT EXISTS databases (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    digest TEXT NOT NULL,
+    stat TEXT NOT NULL,
+    version TEXT NOT NULL,
+    grammar TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    indexed INTEGER NOT NULL DEFAULT 0,
+    last_used REAL NOT NULL,
+    data BLOB NOT NULL
+)''', '''
+CREATE INDEX IF NOT EXISTS databases_last_used ON databases (last_used)
+''', '''
+CREATE TABLE IF NOT EXISTS entries (
+    file_id INTEGER NOT NULL,
+    ordinal INTEGER NOT NULL,
+    data BLOB NOT NULL,
+    PRIMARY KEY (file_id, ordinal)
+)''', '''
+CREATE TABLE IF NOT EXISTS keys (
+    file_id INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    ordinals TEXT NOT NULL,
+    PRIMARY KEY (file_id, key)
+)''', '''
+CREATE TABLE IF NOT EXISTS words (
+    file_id INTEGER NOT NULL,
+    word TEXT NOT NULL,
+    keys TEXT NOT NULL,
+    PRIMARY KEY (file_id, word)
+)''', '''
+CREATE TABLE IF NOT EXISTS referrers (
+    file_id INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    referrers TEXT NOT NULL,
+    PRIMARY KEY (file_id, key)
+)''', '''
+CREATE TABLE IF NOT EXISTS manifests (
+    path TEXT NOT NULL,
+    context TEXT NOT NULL,
+    version TEXT NOT NULL,
+    grammar TEXT NOT NULL,
+    data BLOB NOT NULL,
+    PRIMARY KEY (path, context)
+)''', '''
+CREATE TABLE IF NOT EXISTS directories (
+    path TEXT PRIMARY KEY,
+    stat TEXT NOT NULL,
+    names TEXT NOT NULL
+)''', '''
+CREATE TABLE IF NOT EXISTS rendered (
+    path TEXT PRIMARY KEY,
+    context TEXT NOT NULL,
+    version TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    last_used REAL NOT NULL,
+    data BLOB NOT NULL
+)''', '''
+CREATE TABLE IF NOT EXISTS contexts (
+    context TEXT PRIMARY KEY,
+    last_used REAL NOT NULL
+)''', '''
+CREATE TABLE IF NOT EXISTS context_databases (
+    context TEXT NOT NULL,
+    path TEXT NOT NULL,
+    PRIMARY KEY (context, path)
+)''', '''
+CREATE INDEX IF NOT EXISTS context_databases_path ON context_databases (path)
+''', '''
+CREATE TABLE IF NOT EXISTS resolved (
+    id INTEGER PRIMARY KEY,
+    context TEXT NOT NULL,
+    version TEXT NOT NULL,
+    sources TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    data BLOB NOT NULL
+)''', '''
+CREATE INDEX IF NOT EXISTS resolved_context ON resolved (context)
+''', '''
+CREATE TABLE IF NOT EXISTS resolved_keys (
+    context TEXT NOT NULL,
+    key TEXT NOT NULL,
+    object INTEGER NOT NULL,
+    PRIMARY KEY (context, key)
+)''')
+
+TABLES = ('databases', 'entries', 'keys', 'words', 'referrers', 'manifests', 'directories',
+          'rendered', 'contexts', 'context_databases', 'resolved', 'resolved_keys')
+
+# Only record that a database was used again once this many seconds passed
+LRU_RESOLUTION = 60
+
+# How many seconds prune keeps resolved objects and rendered items that are not used
+CONTEXT_LIFETIME = 30 * 24 * 3600
+
+# How many seconds to wait for another process to finish parsing a database
+LOCK_TIMEOUT = 30
+
+# How many keys to look up with one query, below SQLite's limit on variables
+QUERY_VARIABLES = 500
+
+def default_cache_dir():
+    'Where the cache is kept unless told otherwise.'
+    base = os.environ.get('XDG_CACHE_HOME', '')
+    if not os.path.isabs(base):
+        base = os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'crosstex')
+
+def digest(path):
+    'Return a digest of the contents of a file.'
+    h = hashlib.sha1()
+    with open(path, 'rb') as stream:
+        for block in iter(lambda: stream.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def signature(path):
+    'Summarize the stat of a file; a file with the same signature is unchanged.'
+    return stat_signature(os.stat(path))
+
+def stat_signature(st):
+    return '%d:%d:%d:%d' % (st.st_size, st.st_mtime_ns, st.st_ctime_ns, st.st_ino)
+
+def dumps(db):
+    return pickle.dumps(db, protocol=pickle.HIGHEST_PROTOCOL)
+
+def loads(data):
+    return pickle.loads(data)
+
+def dumps_referring(value, references, keep=()):
+    '''Pickle value, leaving out the objects it refers to that are stored elsewhere.
+
+    references maps the id of each such object to what stands for it in the
+    pickle; objects whose id is in keep are pickled along all the same.
+    Returns the pickle and what stood for each of the objects left out.
+    '''
+    referred = []
+    def persistent_id(obj):
+        reference = references.get(id(obj))
+        if reference is None or id(obj) in keep:
+            return None
+        referred.append(reference)
+        return reference
+    stream = io.BytesIO()
+    pickler = pickle.Pickler(stream, protocol=pickle.HIGHEST_PROTOCOL)
+    pickler.persistent_id = persistent_id
+    pickler.dump(value)
+    return stream.getvalue(), referred
+
+def loads_referring(data, resolve):
+    'Unpickle what dumps_referring pickled; resolve(reference) returns the object left out.'
+    unpickler = pickle.Unpickler(io.BytesIO(data))
+    unpickler.persistent_load = resolve
+    return unpickler.load()
+
+def encode(db):
+    '''Split an XTXFileInfo into the rows the store keeps for it.
+
+    Returns (header, count, entries, keys): the pickled XTXFileInfo without
+    its entries, the number of distinct entries, (ordinal, pickled Entry) for
+    each of them in the order they were created, and (key, position,
+    ordinals) for each key in the order the keys were added.
+    '''
+    unique = {}
+    for es in db.entries.values():
+        for e in es:
+            unique[e.uid] = e
+    uids = sorted(unique)
+    ordinal = dict([(uid, i) for i, uid in enumerate(uids)])
+    entries = [(ordinal[uid], dumps(unique[uid])) for uid in uids]
+    keys = [(key, position, ','.join([str(ordinal[e.uid]) for e in es]))
+            for position, (key, es) in enumerate(db.entries.items())]
+    header = copy.copy(db)
+    header.entries = None
+    return dumps(header), len(uids), entries, keys
+
+def decode(encoded):
+    'Rebuild the XTXFileInfo that encode split up, entries and all.'
+    header, count, entries, keys = encoded
+    db = loads(header)
+    decoded = dict([(ordinal, loads(data)) for ordinal, data in entries])
+    db.entries = collections.defaultdict(list)
+    for key, position, ordinals in sorted(keys, key=lambda k: k[1]):
+        db.entries[key] = [decoded[int(o)] for o in ordinals.split(',')]
+    return db
+
+class BuildLock(object):
+    '''An advisory lock on parsing one database into the cache.
+
+    Processes sharing a cache take it before parsing a database that is not
+    cached, so that only one of them parses it and the others load what it
+    stored.  Without fcntl, or if the lock file cannot be created, acquiring
+    always succeeds at once.
+    '''
+
+    def __init__(self, directory, path):
+        name = hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest()
+        self.path = os.path.join(directory, 'locks', name)
+        self._stream = None
+
+    def acquire(self, timeout=LOCK_TIMEOUT):
+        '''Take the lock, waiting up to timeout seconds for it.
+
+        Returns False if it is still held by someone else after that.
+        '''
+        if fcntl is None:
+            return True
+        try:
+            # Another process may be creating it at the same time
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._stream = open(self.path, 'a')
+        except (IOError, OSError):
+            return True
+        deadline = time.time() + timeout
+        while True:
+            try:
+                fcntl.flock(self._stream.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return True
+            except (IOError, OSError) as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES, errno.EWOULDBLOCK):
+                    self.release()
+                    return True
+            if time.time() >= deadline:
+                self.release()
+                return False
+            time.sleep(0.05)
+
+    def release(self):
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
+
+class StoredEntries(object):
+    '''The entries of a cached database, standing in for XTXFileInfo.entries.
+
+    Entries are only read from the store when a key is looked up, through
+    CacheStore.find.  When the database is merged, base is set to the uid of
+    its first entry; the others follow in the order they were created.
+    '''
+
+    def __init__(self, store, file_id, count):
+        self.store = store
+        self.file_id = file_id
+        self.count = count
+        self.base = 0
+        self.decoded = {}
+
+    def keys(self):
+        return self.store.keys(self.file_id)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+class Manifest(object):
+    '''What parsing a database and everything it includes depended upon.
+
+    files lists (path, digest) for each database in the order they were
+    merged, stats holds the signature of each, absent the paths that were
+    looked for and did not exist, seen the (name, ext, path) additions to
+    Parser._seen, and queried every name that was looked up.  A manifest that
+    is not complete, because something could not be found, is not stored.
+    '''
+
+    def __init__(self):
+        self.files = []
+        self.stats = {}
+        self.absent = set([])
+        self.seen = []
+        self.queried = set([])
+        self.complete = True
+
+    def changed(self, exists=os.path.exists):
+        '''Return None if anything the tree depended on has changed.
+
+        Otherwise return (path, signature) for the files that were touched
+        but still have the contents they had.  exists tells whether a file
+        that was absent has appeared.
+        '''
+        for path in self.absent:
+            if exists(path):
+                return None
+        digests = dict(self.files)
+        changed = []
+        for path, stat in self.stats.items():
+            try:
+                now = signature(path)
+                if now != stat:
+                    if digest(path) != digests[path]:
+                        return None
+                    changed.append((path, now))
+            except (IOError, OSError):
+                return None
+        return changed
+
+class CacheStore(object):
+    '''The cache of parsed databases kept in one directory.
+
+    max_size limits the total size of the stored databases in bytes; None
+    means there is no limit.
+    '''
+
+    def __init__(self, directory=None, grammar='', max_size=CACHE_SIZE):
+        self.directory = directory or default_cache_dir()
+        self.path = os.path.join(self.directory, CACHE_FILE_NAME)
+        self.max_size = max_size
+        self._grammar = grammar
+        self._conn = None
+        self._inherited = None
+        self._broken = False
+        # The contexts whose use was recorded already
+        self._contexts = set([])
+
+    def _connect(self):
+        if self._conn is None and not self._broken:
+            try:
+                # Another process may be creating it at the same time
+                os.makedirs(self.directory, exist_ok=True)
+                self._conn = sqlite3.connect(self.path, timeout=30)
+                with self._conn:
+                    if self._conn.execute('PRAGMA user_version').fetchone()[0] != SCHEMA_VERSION:
+                        # Only takes effect on a new file, and not in a transaction
+                        self._conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+                        # Processes opening a new cache at once set it up one
+                        # after the other, and only the first drops the tables
+                        self._conn.execute('BEGIN IMMEDIATE')
+                    if self._conn.execute('PRAGMA user_version').fetchone()[0] != SCHEMA_VERSION:
+                        for table in TABLES:
+                            self._conn.execute('DROP TABLE IF EXISTS %s' % table)
+                        self._conn.execute('PRAGMA user_version = %d' % SCHEMA_VERSION)
+                    for table in SCHEMA:
+                        self._conn.execute(table)
+            except (sqlite3.Error, OSError) as e:
+                logger.error("Could not open cache '%r', falling back to databases: %s." % (self.path, e))
+                self._conn = None
+                self._broken = True
+        return self._conn
+
+    def _query(self, sql, args, many=False):
+        conn = self._connect()
+        if conn is None:
+            return [] if many else None
+        try:
+            cursor = conn.execute(sql, args)
+            return cursor.fetchall() if many else cursor.fetchone()
+        except sqlite3.Error as e:
+            logger.error("Could not read cache '%r', falling back to database: %s." % (self.path, e))
+            return [] if many else None
+
+    def _update(self, sql, args):
+        conn = self._connect()
+        if conn is None:
+            return
+        try:
+            with conn:
+                conn.execute(sql, args)
+        except sqlite3.Error as e:
+            logger.error("Could not write cache '%r': %s." % (self.path, e))
+
+    def load(self, path, stat):
+        '''Look up the database at path.
+
+        Returns (digest, header) where header is None if nothing usable is
+        stored; otherwise it is the XTXFileInfo that was stored, with its
+        entries replaced by StoredEntries.  The file is only hashed if its
+        signature is not the stored one.
+        '''
+        row = self._query('SELECT digest, stat, id, count, last_used, data FROM databases '
+                          'WHERE path = ? AND version = ? AND grammar = ?',
+                          (os.path.abspath(path), VERSION, self._grammar))
+        if row is not None and row[1] != stat:
+            hashed = digest(path)
+            if row[0] != hashed:
+                return hashed, None
+            self.touch(path, stat)
+        if row is None:
+            return digest(path), None
+        self._used(row[2], row[4])
+        return row[0], self._header(row[2], row[3], row[5])
+
+    def load_digest(self, path, digest):
+        'Look up the database at path, if it is stored with exactly these contents.'
+        row = self._query('SELECT id, count, last_used, data FROM databases WHERE path = ? AND '
+                          'digest = ? AND version = ? AND grammar = ?',
+                          (os.path.abspath(path), digest, VERSION, self._grammar))
+        if row is None:
+            return None
+        self._used(row[0], row[2])
+        return self._header(row[0], row[1], row[3])
+
+    def lock(self, path):
+        'The BuildLock for caching the database at path.'
+        return BuildLock(self.directory, path)
+
+    def _used(self, file_id, last_used):
+        now = time.time()
+        if now - last_used >= LRU_RESOLUTION:
+            self._update('UPDATE databases SET last_used = ? WHERE id = ?', (now, file_id))
+
+    def _header(self, file_id, count, data):
+        db = loads(data)
+        db.entries = StoredEntries(self, file_id, count)
+        return db
+
+    def find(self, key, layers):
+        '''Read the entries for key from several StoredEntries of this store.
+
+        Returns a dictionary mapping each of the layers that has the key to
+        its list of Entry objects, with their final uids.
+        '''
+        ids = collections.defaultdict(list)
+        for layer in layers:
+            ids[layer.file_id].append(layer)
+        rows = self._query('SELECT file_id, ordinals FROM keys WHERE file_id IN (%s) '
+                           'AND key = ?' % ','.join(['?'] * len(ids)),
+                           list(ids) + [key], many=True)
+        found = {}
+        for file_id, ordinals in rows:
+            ordinals = [int(o) for o in ordinals.split(',')]
+            for layer in ids[file_id]:
+                missing = [o for o in ordinals if o not in layer.decoded]
+                if missing:
+                    for ordinal, data in self._query('SELECT ordinal, data FROM entries WHERE '
+                                                     'file_id = ? AND ordinal IN (%s)' %
+                                                     ','.join(['?'] * len(missing)),
+                                                     [file_id] + missing, many=True):
+                        layer.decoded[ordinal] = loads(data)._replace(uid=layer.base + ordinal)
+                found[layer] = [layer.decoded[o] for o in ordinals if o in layer.decoded]
+        return found
+
+    def keys(self, file_id):
+        'The keys of a stored database in the order they were added.'
+        return [row[0] for row in self._query('SELECT key FROM keys WHERE file_id = ? '
+                                              'ORDER BY position', (file_id,), many=True)]
+
+    def positions(self, file_id, keys):
+        'The position of each of keys that a stored database has, by key.'
+        keys = list(keys)
+        found = {}
+        for i in range(0, len(keys), QUERY_VARIABLES):
+            chunk = keys[i:i + QUERY_VARIABLES]
+            found.update(self._query('SELECT key, position FROM keys WHERE file_id = ? AND '
+                                     'key IN (%s)' % ','.join(['?'] * len(chunk)),
+                                     [file_id] + chunk, many=True))
+        return found
+
+    def _indexed(self, file_ids):
+        'Index the stored databases that have not been indexed yet.'
+        for file_id in file_ids:
+            row = self._query('SELECT indexed FROM databases WHERE id = ?', (file_id,))
+            if row is not None and not row[0]:
+                self._index(file_id)
+
+    def _index(self, file_id):
+        decoded = dict([(ordinal, loads(data)) for ordinal, data in
+                        self._query('SELECT ordinal, data FROM entries WHERE file_id = ?',
+                                    (file_id,), many=True)])
+        items = [(key, [decoded[int(o)] for o in ordinals.split(',')]) for key, ordinals in
+                 self._query('SELECT key, ordinals FROM keys WHERE file_id = ?',
+                             (file_id,), many=True)]
+        postings, referrers = crosstex.search.index(items)
+        words = [(file_id, word, ','.join(keys)) for word, keys in postings.items()]
+        referrers = [(file_id, key, ','.join(keys)) for key, keys in referrers.items()]
+        size = sum([len(word) + len(keys) for f, word, keys in words + referrers])
+        conn = self._connect()
+        if conn is None:
+            return
+        try:
+            with conn:
+                conn.execute('DELETE FROM words WHERE file_id = ?', (file_id,))
+                conn.execute('DELETE FROM referrers WHERE file_id = ?', (file_id,))
+                conn.executemany('INSERT INTO words VALUES (?, ?, ?)', words)
+                conn.executemany('INSERT INTO referrers VALUES (?, ?, ?)', referrers)
+                conn.execute('UPDATE databases SET indexed = 1, size = size + ? WHERE id = ?',
+                             (size, file_id))
+        except sqlite3.Error as e:
+            logger.error("Could not write cache '%r': %s." % (self.path, e))
+
+    def search(self, file_ids, piece):
+        '''The keys of stored databases whose entries have a word containing piece.
+
+        Databases are indexed the first time they are searched.
+        '''
+        self._indexed(file_ids)
+        found = set([])
+        for row in self._query('SELECT keys FROM words WHERE file_id IN (%s) AND '
+                               'instr(word, ?) > 0' % ','.join(['?'] * len(file_ids)),
+                               list(file_ids) + [piece], many=True):
+            found.update(row[0].split(','))
+        return found
+
+    def referrers(self, file_ids, keys):
+        'The keys of stored databases whose entries may refer to any of keys.'
+        self._indexed(file_ids)
+        keys = list(keys)
+        found = set([])
+        for i in range(0, len(keys), QUERY_VARIABLES):
+            chunk = keys[i:i + QUERY_VARIABLES]
+            for row in self._query('SELECT referrers FROM referrers WHERE file_id IN (%s) AND '
+                                   'key IN (%s)' % (','.join(['?'] * len(file_ids)),
+                                                    ','.join(['?'] * len(chunk))),
+                                   list(file_ids) + chunk, many=True):
+                found.update(row[0].split(','))
+        return found
+
+    def has(self, path, stat):
+        'True if load would find something, without reading it.'
+        row = self._query('SELECT digest, stat FROM databases WHERE '
+                          'path = ? AND version = ? AND grammar = ?',
+                          (os.path.abspath(path), VERSION, self._grammar))
+        if row is None:
+            return False
+        return row[1] == stat or row[0] == digest(path)
+
+    def store(self, path, digest, stat, encoded):
+        '''Replace whatever is stored for path with a database split by encode.
+
+        Returns the id of the new row, or None if it could not be written.
+        '''
+        conn = self._connect()
+        if conn is None:
+            return None
+        header, count, entries, keys = encoded
+        size = len(header) + sum([len(data) for ordinal, data in entries]) + \
+               sum([len(key) + len(ordinals) for key, position, ordinals in keys])
+        try:
+            with conn:
+                row = conn.execute('SELECT id FROM databases WHERE path = ?',
+                                   (os.path.abspath(path),)).fetchone()
+                if row is not None:
+                    self._delete(conn, row[0])
+                file_id = conn.execute('INSERT INTO databases (path, digest, stat, version, '
+                                       'grammar, count, size, last_used, data) '
+                                       'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                       (os.path.abspath(path), digest, stat, VERSION,
+                                        self._grammar, count, size, time.time(),
+                                        sqlite3.Binary(header))).lastrowid
+                conn.executemany('INSERT INTO entries VALUES (?, ?, ?)',
+                                 [(file_id, ordinal, sqlite3.Binary(data))
+                                  for ordinal, data in entries])
+                conn.executemany('INSERT INTO keys VALUES (?, ?, ?, ?)',
+                                 [(file_id, key, position, ordinals)
+                                  for key, position, ordinals in keys])
+                evicted = self._evict(conn, keep=('database', file_id))
+            if evicted:
+                conn.execute('PRAGMA incremental_vacuum')
+            return file_id
+        except sqlite3.Error as e:
+            logger.error("Could not write cache '%r': %s." % (self.path, e))
+            return None
+
+    def _delete(self, conn, file_id):
+        row = conn.execute('SELECT path FROM databases WHERE id = ?', (file_id,)).fetchone()
+        for table in ('entries', 'keys', 'words', 'referrers'):
+            conn.execute('DELETE FROM %s WHERE file_id = ?' % table, (file_id,))
+        conn.execute('DELETE FROM databases WHERE id = ?', (file_id,))
+        if row is not None:
+            conn.execute('DELETE FROM manifests WHERE path = ?', (row[0],))
+
+    def _drop(self, conn, file_id):
+        '''Delete a database and the objects resolved from it.
+
+        Returns how many bytes of resolved objects were deleted with it.
+        '''
+        row = conn.execute('SELECT path FROM databases WHERE id = ?', (file_id,)).fetchone()
+        self._delete(conn, file_id)
+        size = 0
+        if row is not None:
+            for (context,) in conn.execute('SELECT context FROM context_databases WHERE path = ?',
+                                           (row[0],)).fetchall():
+                size += self._delete_context(conn, context)
+        return size
+
+    def _delete_context(self, conn, context):
+        'Delete the objects resolved in context; returns their size.'
+        size = conn.execute('SELECT COALESCE(SUM(size), 0) FROM resolved WHERE context = ?',
+                            (context,)).fetchone()[0]
+        for table in ('contexts', 'context_databases', 'resolved', 'resolved_keys'):
+            conn.execute('DELETE FROM %s WHERE context = ?' % table, (context,))
+        return size
+
+    def _size(self, conn):
+        'The size of everything stored, as the maximum size limits it.'
+        return conn.execute('SELECT (SELECT COALESCE(SUM(size), 0) FROM databases) + '
+                            '(SELECT COALESCE(SUM(size), 0) FROM resolved) + '
+                            '(SELECT COALESCE(SUM(size), 0) FROM rendered)').fetchone()[0]
+
+    def _evict(self, conn, keep=None):
+        '''Drop the least recently used databases, contexts and rendered items until the cache fits.
+
+        keep is ('database', id), ('context', context) or ('rendered', path)
+        for what was just stored, which is not dropped.  Returns how many were
+        dropped.
+        '''
+        if self.max_size is None:
+            return 0
+        total = self._size(conn)
+        evicted = 0
+        if total <= self.max_size:
+            return evicted
+        candidates = [(last_used, 'database', file_id, size) for file_id, size, last_used in
+                      conn.execute('SELECT id, size, last_used FROM databases').fetchall()]
+        candidates += [(last_used, 'context', context, size) for context, size, last_used in
+                       conn.execute('SELECT contexts.context, COALESCE(SUM(resolved.size), 0), '
+                                    'contexts.last_used FROM contexts LEFT JOIN resolved '
+                                    'ON resolved.context = contexts.context '
+                                    'GROUP BY contexts.context').fetchall()]
+        candidates += [(last_used, 'rendered', path, size) for path, size, last_used in
+                       conn.execute('SELECT path, size, last_used FROM rendered').fetchall()]
+        candidates.sort(key=lambda c: (c[0], c[1], c[2]))
+        dropped = set([])
+        for last_used, kind, name, size in candidates:
+            if total <= self.max_size:
+                break
+            if (kind, name) == keep or (kind, name) in dropped:
+                continue
+            if kind == 'database':
+                logger.debug('Evicting database %d from the cache.' % name)
+                dropped.update([('context', c) for (c,) in
+                                conn.execute('SELECT context FROM context_databases WHERE path = '
+                                             '(SELECT path FROM databases WHERE id = ?)',
+                                             (name,)).fetchall()])
+                total -= size + self._drop(conn, name)
+            elif kind == 'context':
+                logger.debug('Evicting the objects resolved in context %s from the cache.' % name)
+                total -= self._delete_context(conn, name)
+            else:
+                logger.debug('Evicting what was rendered for %s from the cache.' % name)
+                conn.execute('DELETE FROM rendered WHERE path = ?', (name,))
+                total -= size
+            dropped.add((kind, name))
+            evicted += 1
+        return evicted
+
+    def touch(self, path, stat):
+        'Record a new signature for a database whose contents did not change.'
+        self._update('UPDATE databases SET stat = ? WHERE path = ?',
+                     (stat, os.path.abspath(path)))
+
+    def load_manifest(self, path, context):
+        row = self._query('SELECT data FROM manifests WHERE path = ? AND '
+                          'context = ? AND version = ? AND grammar = ?',
+                          (os.path.abspath(path), context, VERSION, self._grammar))
+        if row is None:
+            return None
+        try:
+            return loads(row[0])
+        except Exception:
+            return None
+
+    def store_manifest(self, path, context, manifest):
+        self._update('INSERT OR REPLACE INTO manifests VALUES (?, ?, ?, ?, ?)',
+                     (os.path.abspath(path), context, VERSION, self._grammar,
+                      sqlite3.Binary(dumps(manifest))))
+
+    def load_listing(self, directory, stat):
+        '''Return the names stored for a directory by store_listing.
+
+        Returns None unless the directory still has the same signature.
+        '''
+        row = self._query('SELECT names FROM directories WHERE path = ? AND stat = ?',
+                          (os.path.abspath(directory), stat))
+        if row is None:
+            return None
+        return frozenset([n for n in row[0].split('/') if n])
+
+    def store_listing(self, directory, stat, names):
+        # No file name can contain a slash
+        self._update('INSERT OR REPLACE INTO directories VALUES (?, ?, ?)',
+                     (os.path.abspath(directory), stat, '/'.join(sorted(names))))
+
+    def load_rendered(self, path, context):
+        '''Return what store_rendered stored for the document at path.
+
+        Returns None unless it was rendered in the same context.
+        '''
+        row = self._query('SELECT data, last_used FROM rendered WHERE path = ? AND context = ? '
+                          'AND version = ?', (os.path.abspath(path), context, VERSION))
+        if row is None:
+            return None
+        now = time.time()
+        if now - row[1] >= LRU_RESOLUTION:
+            self._update('UPDATE rendered SET last_used = ? WHERE path = ?',
+                         (now, os.path.abspath(path)))
+        try:
+            return loads(row[0])
+        except Exception:
+            return None
+
+    def store_rendered(self, path, context, items):
+        conn = self._connect()
+        if conn is None:
+            return
+        data = dumps(items)
+        try:
+            with conn:
+                # Only the last context a document was rendered in is kept
+                conn.execute('INSERT OR REPLACE INTO rendered VALUES (?, ?, ?, ?, ?, ?)',
+                             (os.path.abspath(path), context, VERSION, len(data), time.time(),
+                              sqlite3.Binary(data)))
+                evicted = self._evict(conn, keep=('rendered', os.path.abspath(path)))
+            if evicted:
+                conn.execute('PRAGMA incremental_vacuum')
+        except sqlite3.Error as e:
+            logger.error("Could not write cache '%r': %s." % (self.path, e))
+
+    def load_resolved(self, context, key):
+        '''Return (sources, data) as store_resolved stored them for key in context.
+
+        Returns None if nothing was stored by this version of CrossTeX.
+        '''
+        row = self._query('SELECT resolved.sources, resolved.data FROM resolved_keys JOIN '
+                          'resolved ON resolved.id = resolved_keys.object WHERE '
+                          'resolved_keys.context = ? AND resolved_keys.key = ? AND '
+                          'resolved.version = ?', (context, key, VERSION))
+        if row is None:
+            return None
+        if context not in self._contexts:
+            self._contexts.add(context)
+            now = time.time()
+            self._update('UPDATE contexts SET last_used = ? WHERE context = ? AND last_used <= ?',
+                         (now, context, now - LRU_RESOLUTION))
+        return row[0], row[1]
+
+    def store_resolved(self, context, sources, paths, rows, renewed=()):
+        '''Store resolved objects in context, all at once.
+
+        paths are the databases the objects were resolved from.  rows lists
+        (keys, data) for each object, stored once for all of its keys;
+        renewed lists the keys of objects already stored that are still valid
+        for sources.
+        '''
+        conn = self._connect()
+        if conn is None:
+            return
+        try:
+            with conn:
+                conn.execute('INSERT OR REPLACE INTO contexts VALUES (?, ?)', (context, time.time()))
+                conn.executemany('INSERT OR IGNORE INTO context_databases VALUES (?, ?)',
+                                 [(context, os.path.abspath(path)) for path in paths])
+                # The objects the keys stood for until now
+                stored = [key for keys, data in rows for key in keys]
+                replaced = set([])
+                for i in range(0, len(stored), QUERY_VARIABLES):
+                    chunk = stored[i:i + QUERY_VARIABLES]
+                    replaced.update([row[0] for row in
+                                     conn.execute('SELECT object FROM resolved_keys WHERE '
+                                                  'context = ? AND key IN (%s)' %
+                                                  ','.join(['?'] * len(chunk)),
+                                                  [context] + chunk).fetchall()])
+                for keys, data in rows:
+                    size = len(data) + sum([len(key) for key in keys])
+                    object_id = conn.execute('INSERT INTO resolved (context, version, sources, '
+                                             'size, data) VALUES (?, ?, ?, ?, ?)',
+                                             (context, VERSION, sources, size,
+                                              sqlite3.Binary(data))).lastrowid
+                    conn.executemany('INSERT OR REPLACE INTO resolved_keys VALUES (?, ?, ?)',
+                                     [(context, key, object_id) for key in keys])
+                for object_id in replaced:
+                    if conn.execute('SELECT 1 FROM resolved_keys WHERE object = ? AND context = ? '
+                                    'LIMIT 1', (object_id, context)).fetchone() is None:
+                        conn.execute('DELETE FROM resolved WHERE id = ?', (object_id,))
+                conn.executemany('UPDATE resolved SET sources = ? WHERE id = (SELECT object FROM '
+                                 'resolved_keys WHERE context = ? AND key = ?)',
+                                 [(sources, context, key) for key in renewed])
+                evicted = self._evict(conn, keep=('context', context))
+            if evicted:
+                conn.execute('PRAGMA incremental_vacuum')
+        except sqlite3.Error as e:
+            logger.error("Could not write cache '%r': %s." % (self.path, e))
+
+    def stats(self):
+        '''Describe the cache as a list of (name, value) pairs.'''
+        conn = self._connect()
+        if conn is None:
+            return []
+        databases, entries = conn.execute('SELECT COUNT(*), COALESCE(SUM(count), 0) '
+                                          'FROM databases').fetchone()
+        size = self._size(conn)
+        manifests = conn.execute('SELECT COUNT(*) FROM manifests').fetchone()[0]
+        directories = conn.execute('SELECT COUNT(*) FROM directories').fetchone()[0]
+        rendered = conn.execute('SELECT COUNT(*) FROM rendered').fetchone()[0]
+        contexts = conn.execute('SELECT COUNT(*) FROM contexts').fetchone()[0]
+        resolved = conn.execute('SELECT COUNT(*) FROM resolved').fetchone()[0]
+        return [('cache', self.path),
+                ('databases', databases),
+                ('entries', entries),
+                ('include manifests', manifests),
+                ('directory listings', directories),
+                ('rendered documents', rendered),
+                ('resolved contexts', contexts),
+                ('resolved objects', resolved),
+                ('stored bytes', size),
+                ('file bytes', os.path.getsize(self.path)),
+                ('maximum bytes', self.max_size if self.max_size is not None else 'unlimited')]
+
+    def prune(self):
+        '''Drop what can no longer be used and shrink the cache to its maximum size.
+
+        That is databases written by another version of CrossTeX or for
+        another grammar, databases whose file is gone, the listings of
+        directories and the rendered items of documents that are gone, objects
+        resolved by another version, and the resolved objects and rendered
+        items that were not used for CONTEXT_LIFETIME.
+        Returns how many databases were dropped.
+        '''
+        conn = self._connect()
+        if conn is None:
+            return 0
+        dropped = 0
+        with conn:
+            for file_id, path, version, grammar in conn.execute('SELECT id, path, version, grammar '
+                                                                'FROM databases').fetchall():
+                if version != VERSION or grammar != self._grammar or not os.path.exists(path):
+                    self._drop(conn, file_id)
+                    dropped += 1
+            conn.execute('DELETE FROM manifests WHERE version != ? OR grammar != ?',
+                         (VERSION, self._grammar))
+            for (path,) in conn.execute('SELECT path FROM directories').fetchall():
+                if not os.path.isdir(path):
+                    conn.execute('DELETE FROM directories WHERE path = ?', (path,))
+            conn.execute('DELETE FROM rendered WHERE version != ? OR last_used < ?',
+                         (VERSION, time.time() - CONTEXT_LIFETIME))
+            for (context,) in conn.execute('SELECT context FROM contexts WHERE last_used < ?',
+                                           (time.time() - CONTEXT_LIFETIME,)).fetchall():
+                self._delete_context(conn, context)
+            conn.execute('DELETE FROM resolved WHERE version != ?', (VERSION,))
+            conn.execute('DELETE FROM resolved_keys WHERE object NOT IN (SELECT id FROM resolved)')
+            for table in ('contexts', 'context_databases'):
+                conn.execute('DELETE FROM %s WHERE context NOT IN (SELECT context FROM resolved)'
+                             % table)
+            for (path,) in conn.execute('SELECT path FROM rendered').fetchall():
+                if not os.path.exists(path):
+                    conn.execute('DELETE FROM rendered WHERE path = ?', (path,))
+            dropped += self._evict(conn)
+        conn.execute('VACUUM')
+        return dropped
+
+    def clear(self):
+        'Remove the cache entirely.'
+        self.close()
+        for suffix in ('', '-journal', '-wal', '-shm'):
+            if os.path.exists(self.path + suffix):
+                os.unlink(self.path + suffix)
+        locks = os.path.join(self.directory, 'locks')
+        if os.path.isdir(locks):
+            for name in os.listdir(locks):
+                os.unlink(os.path.join(locks, name))
+            os.rmdir(locks)
+
+    def __getstate__(self):
+        # Another process opens a connection of its own
+        return (self.directory, self._grammar, self.max_size)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def forked(self):
+        '''Call in a process forked while the cache was open.
+
+        A connection must not be used on both sides of a fork, so the child
+        leaves the one it inherited alone and opens its own when needed.
+        '''
+        self._inherited, self._conn = self._conn, None
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
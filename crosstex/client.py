@@ -0,0 +1,126 @@
+'''
+Hand a command line to a running "crosstex serve".
+
+This module only uses the standard library, so that bin/crosstex can load it
+on its own, without importing the rest of CrossTeX, and a server that already
+has everything loaded can answer instead.  The server runs the command in the
+directory it was given in and sends back what it would have written; the
+files are written here, as the user running the command.
+
+The protocol is a JSON object on each side of a Unix socket: the client sends
+{"argv": [...], "cwd": "..."} and closes its end for writing, and the server
+answers with {"status": N, "stdout": "...", "stderr": "...", "files": [[path,
+text], ...]}.
+'''
+
+import json
+import os
+import socket
+import sys
+import tempfile
+
+# Commands that are never forwarded
+LOCAL_COMMANDS = ('serve', 'cache')
+
+# Options that keep crosstex running, which would tie up the server, or that
+# build many documents, which is best done with processes of its own
+LOCAL_OPTIONS = ('--watch', '--batch', '--manifest')
+
+# How many seconds to wait for the server to accept the connection, and then
+# for each part of its answer, before running the command here instead
+CONNECT_TIMEOUT = 1
+READ_TIMEOUT = 60
+
+def default_socket():
+    '''Where "crosstex serve" listens unless told otherwise.
+
+    $CROSSTEX_SOCKET if set, otherwise crosstex.sock in $XDG_RUNTIME_DIR, or
+    server.sock in the cache directory if there is no runtime directory.
+    '''
+    if 'CROSSTEX_SOCKET' in os.environ:
+        return os.environ['CROSSTEX_SOCKET']
+    runtime = os.environ.get('XDG_RUNTIME_DIR', '')
+    if os.path.isabs(runtime):
+        return os.path.join(runtime, 'crosstex.sock')
+    # The same directory as crosstex.cache.default_cache_dir
+    base = os.environ.get('XDG_CACHE_HOME', '')
+    if not os.path.isabs(base):
+        base = os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'crosstex', 'server.sock')
+
+def write_file(path, contents):
+    '''Replace the file at path with contents (a str) in one step.
+
+    The contents are written to a temporary file next to it first, so that
+    nobody ever reads a partially written file.
+    '''
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp = tempfile.mkstemp(prefix='.' + os.path.basename(path) + '.', dir=directory)
+    try:
+        with os.fdopen(fd, 'w') as fout:
+            fout.write(contents)
+        if os.path.exists(path):
+            os.chmod(temp, os.stat(path).st_mode & 0o7777)
+        else:
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(temp, 0o666 & ~umask)
+        os.replace(temp, path)
+    except:
+        if os.path.exists(temp):
+            os.unlink(temp)
+        raise
+
+def request(path, argv, cwd):
+    '''Send one command line to the server at path and return its answer.
+
+    Raises socket.timeout if the server does not accept the connection within
+    CONNECT_TIMEOUT seconds or stops answering for READ_TIMEOUT seconds.
+    '''
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.settimeout(CONNECT_TIMEOUT)
+        conn.connect(path)
+        conn.settimeout(READ_TIMEOUT)
+        conn.sendall(json.dumps({'argv': argv, 'cwd': cwd}).encode('utf-8'))
+        conn.shutdown(socket.SHUT_WR)
+        chunks = []
+        while True:
+            chunk = conn.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    finally:
+        conn.close()
+    return json.loads(b''.join(chunks).decode('utf-8'))
+
+def forward(argv):
+    '''Run a crosstex command line through the server, if one is running.
+
+    Returns the exit status, or None if the command should be run here
+    instead, because there is no server, it could not be reached or it did
+    not answer in time.
+    '''
+    if argv and argv[0] in LOCAL_COMMANDS:
+        return None
+    if any(arg.split('=', 1)[0] in LOCAL_OPTIONS for arg in argv):
+        return None
+    path = default_socket()
+    if not path or not os.path.exists(path):
+        return None
+    try:
+        answer = request(path, argv, os.getcwd())
+    except socket.timeout:
+        sys.stderr.write('crosstex: the server did not answer in time, running here instead.\n')
+        sys.stderr.flush()
+        return None
+    except (OSError, ValueError):
+        return None
+    # In the order a command run here would have produced them
+    sys.stderr.write(answer['stderr'])
+    sys.stderr.flush()
+    for path, text in answer['files']:
+        write_file(path, text)
+    sys.stdout.write(answer['stdout'])
+    sys.stdout.flush()
+    return answer['status']
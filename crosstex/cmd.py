@@ -1,15 +1,27 @@
 import argparse
+import concurrent.futures
 import importlib
 import logging
+import multiprocessing
 import os
 import os.path
 import sys
+import time
+import traceback
 
 import crosstex
+import crosstex.cache
+import crosstex.client
+import crosstex.constants
+import crosstex.parse
+import crosstex.server
 import crosstex.style
 
 logger = logging.getLogger('crosstex')
 
+# How many seconds --watch waits between looking for changes
+WATCH_INTERVAL = 0.5
+
 parser = argparse.ArgumentParser(prog='crosstex',
                                  description='A modern, object-oriented bibliographic tool.')
 #parser.add_argument('--quiet',
@@ -64,11 +76,37 @@ parser = argparse.ArgumentParser(prog='crosstex',
 #                         'First" instead of "First Last" (the latter is the '
 #                         'default).  XXX:ignored')
 #parser.add_argument('--no-last-first')
-parser.add_argument('--version', version='CrossTeX 0.9.0', action='version')
+parser.add_argument('--version', version='CrossTeX ' + crosstex.constants.VERSION, action='version')
 parser.add_argument('-v', '--verbose', action='store_true')
 parser.add_argument('-d', '--dir', metavar='DIR', action='append', dest='dirs',
                     help='Add a directory in which to find data files, searched '
                          'from last specified to first.')
+parser.add_argument('--tokenizer', metavar='TOKENIZER', default='ply',
+                    choices=crosstex.parse.TOKENIZERS,
+                    help='Select the tokenizer for xtx and bib files: "ply" '
+                         'uses the PLY lexer, "fast" uses a hand-written '
+                         'scanner that is quicker on large files.')
+parser.add_argument('--mmap', dest='use_mmap', action='store_true',
+                    help='Memory-map database files and only decode the '
+                         'entries that are needed.  Bypasses the cache.')
+parser.add_argument('-j', '--jobs', metavar='N', type=int, default=1,
+                    help='Parse up to N uncached database files at once in '
+                         'separate processes, and with --batch, build up to '
+                         'N bibliographies at once.')
+parser.add_argument('--cache-dir', metavar='DIR',
+                    help='Keep parsed databases in DIR instead of '
+                         '$XDG_CACHE_HOME/crosstex.')
+parser.add_argument('--cache-size', metavar='MB', type=int,
+                    default=crosstex.constants.CACHE_SIZE // (1024 * 1024),
+                    help='Evict the least recently used databases once the '
+                         'cache grows beyond MB megabytes.  Default: %(default)s.')
+parser.add_argument('--no-cache', dest='use_cache', action='store_false',
+                    help='Neither read nor write the cache of parsed databases.')
+parser.add_argument('--columnar', action='store_true',
+                    help='Keep the entries of databases parsed without the '
+                         'cache in compact arrays, building them only when '
+                         'they are looked up.  Saves memory on very large '
+                         'databases.')
 parser.add_argument('--cite', metavar='CITE', action='append',
                     help='Cite a key exactly as with the \cite LaTeX command.')
 parser.add_argument('--cite-by', metavar='CITE_BY', default='style',
@@ -141,51 +179,151 @@ parser.add_argument('--add-proc', dest='add_proc',
 parser.add_argument('--add-proceedings', dest='add_proc',
                     action='store_const', const='proceedings',
                     help='Add "Proceedings of the" to conference and workshop publications.')
-parser.add_argument('files', metavar='FILES', nargs='+',
+parser.add_argument('--watch', action='store_true',
+                    help='Keep running, and run again whenever one of the '
+                         'files or a database they use changes, until '
+                         'interrupted.')
+parser.add_argument('--batch', action='store_true',
+                    help='Treat each of the files as the aux file of a '
+                         'separate document, and write the bibliography of '
+                         'each, parsing the databases they share only once.')
+parser.add_argument('--manifest', metavar='FILE',
+                    help='Also build the documents listed in FILE, one per '
+                         'line, relative to its directory; implies --batch.  '
+                         'Blank lines and lines starting with # are skipped.')
+parser.add_argument('files', metavar='FILES', nargs='*',
                     help='A list of xtx, aux, or bib files to process.')
 
+cache_parser = argparse.ArgumentParser(prog='crosstex cache',
+                                       description='Maintain the cache of parsed databases.')
+cache_parser.add_argument('action', choices=('stats', 'prune', 'clear'),
+                          help='With "stats", describe the cache.  With "prune", '
+                               'drop databases that are gone or were cached by '
+                               'another version and shrink the cache to its '
+                               'maximum size.  With "clear", remove it.')
+cache_parser.add_argument('--cache-dir', metavar='DIR',
+                          help='Use the cache in DIR instead of $XDG_CACHE_HOME/crosstex.')
+cache_parser.add_argument('--cache-size', metavar='MB', type=int,
+                          default=crosstex.constants.CACHE_SIZE // (1024 * 1024),
+                          help='The maximum size "prune" shrinks the cache to.')
 
-def main(argv):
-    try:
-        args = parser.parse_args()
-        path = list(args.dirs or []) + \
-               [os.path.join(os.path.join(os.path.expanduser('~'), '.crosstex'))] + \
-               ['/usr/local/share/crosstex'] + \
-               ['/XXX']
-
-        if args.verbose:
-            logger.setLevel(logging.DEBUG)
-            logging.getLogger('crosstex.parse').setLevel(logging.DEBUG)
-
-        xtx = crosstex.CrossTeX(xtx_path=path)
-        xtx.set_titlecase(args.titlecase)
-
-        if args.no_pages:
-            xtx.no_pages()
-        if args.no_address:
-            xtx.no_address()
-        if args.add_in:
-            xtx.add_in()
-        if args.add_proc == 'proc':
-            xtx.add_proc()
-        if args.add_proc == 'proceedings':
-            xtx.add_proceedings()
-        for s in args.short or []:
-            xtx.add_short(s)
-        xtx.set_style(args.fmt, args.style, args.cite_by)
-        for f in reversed(args.files):
-            xtx.parse(f)
+def cache_main(argv):
+    args = cache_parser.parse_args(argv)
+    store = crosstex.cache.CacheStore(args.cache_dir, crosstex.parse.GRAMMAR_VERSION,
+                                      args.cache_size * 1024 * 1024)
+    if args.action == 'clear':
+        store.clear()
+        return 0
+    if not os.path.exists(store.path):
+        sys.stdout.write('There is no cache at %s.\n' % store.path)
+        return 0
+    if args.action == 'prune':
+        sys.stdout.write('Dropped %d databases.\n' % store.prune())
+    for name, value in store.stats():
+        sys.stdout.write('%-20s %s\n' % (name + ':', value))
+    store.close()
+    return 0
+
+serve_parser = argparse.ArgumentParser(prog='crosstex serve',
+                                       description='Keep databases parsed and resolved in '
+                                                   'memory, and run the crosstex commands '
+                                                   'forwarded to this server.')
+serve_parser.add_argument('--socket', metavar='PATH',
+                          help='Listen on the Unix socket PATH instead of '
+                               '$CROSSTEX_SOCKET or $XDG_RUNTIME_DIR/crosstex.sock.  '
+                               'crosstex forwards commands to the same socket.')
+
+def serve_main(argv):
+    args = serve_parser.parse_args(argv)
+    return crosstex.server.serve(args.socket or crosstex.client.default_socket())
+
+def parse_args(argv):
+    args = parser.parse_args(argv)
+    if args.manifest:
+        args.batch = True
+    if not args.files and not args.manifest:
+        parser.error('the following arguments are required: FILES')
+    if args.batch and args.output:
+        parser.error('--batch writes the bibliography of each document next to it, not to --output')
+    if args.batch and args.watch:
+        parser.error('--watch cannot be combined with --batch')
+    return args
+
+def configure(args):
+    'Set up CrossTeX as the command line asks, without parsing anything.'
+    path = list(args.dirs or []) + \
+           [os.path.join(os.path.join(os.path.expanduser('~'), '.crosstex'))] + \
+           ['/usr/local/share/crosstex']
+
+    if args.verbose:
+        logger.setLevel(logging.DEBUG)
+        logging.getLogger('crosstex.parse').setLevel(logging.DEBUG)
+
+    xtx = crosstex.CrossTeX(xtx_path=path, tokenizer=args.tokenizer,
+                            use_mmap=args.use_mmap, jobs=args.jobs,
+                            cache_dir=args.cache_dir, use_cache=args.use_cache,
+                            cache_size=args.cache_size * 1024 * 1024,
+                            columnar=args.columnar)
+    xtx.set_titlecase(args.titlecase)
+
+    if args.no_pages:
+        xtx.no_pages()
+    if args.no_address:
+        xtx.no_address()
+    if args.add_in:
+        xtx.add_in()
+    if args.add_proc == 'proc':
+        xtx.add_proc()
+    if args.add_proc == 'proceedings':
+        xtx.add_proceedings()
+    for s in args.short or []:
+        xtx.add_short(s)
+    xtx.set_style(args.fmt, args.style, args.cite_by)
+    return xtx
+
+def prepare(argv, resolved=None):
+    '''Set up CrossTeX for a command line and parse the files it names.
 
+    Returns (args, xtx).  resolved is a dictionary kept between commands, in
+    which objects resolved from the same databases are shared (see
+    Database.share_resolved); it is not used with --verbose, as the debug
+    messages of objects resolved without it would be missing.
+    '''
+    args = parse_args(argv)
+    return args, load(args, resolved)
+
+def load(args, resolved=None):
+    'Set up CrossTeX for parsed command line arguments and parse the files; see prepare.'
+    xtx = configure(args)
+    xtx.keep_rendered(args.files[-1])
+    for f in reversed(args.files):
+        xtx.parse(f)
+    if resolved is not None and not args.verbose:
+        xtx.share_resolved(resolved)
+    return xtx
+
+def finish(args, xtx, document=None, citations=None):
+    '''Look up, sort and render what prepare parsed; returns (status, outputs).
+
+    outputs lists (path, text) for each file the command writes, with None
+    as the path of standard output.  document and citations stand in for the
+    last of the files and the citations of the aux files parsed, for --batch.
+    '''
+    if document is None:
+        document = args.files[-1]
+    if citations is None:
+        citations = xtx.aux_citations()
+    try:
         # We'll use this check later
-        is_aux = os.path.splitext(args.files[-1])[1] == '.aux' or \
-                 xtx.aux_citations() and os.path.splitext(args.files[-1])[1] == ''
+        is_aux = os.path.splitext(document)[1] == '.aux' or \
+                 citations and os.path.splitext(document)[1] == ''
         # Get a list of things to cite
         cite = []
         warn_uncitable = True
         if args.cite:
             cite = args.cite
         elif is_aux:
-            cite = xtx.aux_citations()
+            cite = citations
         elif xtx.has_inline_citations():
             cite = xtx.inline_citations()
         else:
@@ -212,22 +350,190 @@ def main(argv):
             citeable = xtx.heading(citeable, args.heading[0], args.heading[1])
         try:
             rendered = xtx.render(citeable)
-            rendered = rendered.encode('utf8')
         except crosstex.style.UnsupportedCitation as e:
             logger.error('Style does not support citations for %s' % e.citetype)
-            return 1
+            return 1, []
         if args.output:
-            with open(args.output, 'w') as fout:
-                fout.write(rendered.decode('utf-8'))
-                fout.flush()
+            return 0, [(args.output, rendered)]
         elif is_aux and args.fmt == 'bbl':
-            with open(os.path.splitext(args.files[-1])[0] + '.bbl', 'w') as fout:
-                fout.write(rendered.decode('utf-8'))
-                fout.flush()
+            return 0, [(os.path.splitext(document)[0] + '.bbl', rendered)]
         else:
-            sys.stdout.write(rendered.decode('utf-8'))
+            return 0, [(None, rendered)]
+    except crosstex.CrossTeXError as e:
+        logger.error(str(e))
+        return 1, []
+
+def write(outputs, written=None):
+    '''Write what finish returned.
+
+    written maps the path of each file written before to its contents; files
+    whose contents would not change are left alone.
+    '''
+    for path, text in outputs:
+        if path is None:
+            sys.stdout.write(text)
             sys.stdout.flush()
-        return 0
+        elif written is None or written.get(path) != text:
+            crosstex.client.write_file(path, text)
+            if written is not None:
+                written[path] = text
+
+def signatures(paths):
+    'The signature of each path, or None for those that do not exist.'
+    found = {}
+    for path in paths:
+        try:
+            found[path] = crosstex.cache.signature(path)
+        except OSError:
+            found[path] = None
+    return found
+
+def watch(args, xtx, interval=WATCH_INTERVAL):
+    '''Finish the command, then again whenever one of its inputs changes.
+
+    The inputs are the files parsed and the directories searched for them.
+    After a change the files are parsed again with CrossTeX.reload, which only
+    parses the databases that changed and only drops the objects resolved from
+    entries that changed.  Returns the status of the last run once
+    interrupted.
+    '''
+    written = {}
+    status = 0
+    try:
+        while True:
+            known = signatures(xtx.inputs())
+            status, outputs = finish(args, xtx)
+            write(outputs, written)
+            while signatures(known) == known:
+                time.sleep(interval)
+            logger.debug('Inputs changed, running again.')
+            xtx.reload()
+    except KeyboardInterrupt:
+        return status
+
+def documents(args):
+    '''The documents --batch builds: the files, then those the manifest lists.
+
+    The manifest names one document per line, relative to its own directory.
+    '''
+    found = list(args.files)
+    if args.manifest:
+        directory = os.path.dirname(args.manifest)
+        try:
+            with open(args.manifest) as stream:
+                lines = [line.strip() for line in stream]
+        except (IOError, OSError) as e:
+            raise crosstex.CrossTeXError('Could not read manifest %r: %s' % (args.manifest, e))
+        found += [os.path.join(directory, line) for line in lines
+                  if line and not line.startswith('#')]
+    return found
+
+def build(args, document, xtx, citations):
+    '''Build the bibliography of one document of a batch; returns what finish does.
+
+    A document that cannot be built for any reason does not stop the others.
+    '''
+    xtx.start_document(document)
+    try:
+        return finish(args, xtx, document, citations)
+    except Exception:
+        logger.error('Could not build the bibliography of %s:\n%s' %
+                     (document, traceback.format_exc().rstrip()))
+        return 1, []
+
+# What the processes forked by batch build: the arguments and (document, xtx,
+# citations) for each document
+_batch = None
+
+def _forked():
+    args, parsed = _batch
+    for xtx in set([xtx for document, xtx, citations in parsed]):
+        xtx.forked()
+
+def _build_worker(index):
+    '''Build the bibliography of one document in a forked process.
+
+    Returns what finish does and everything that was logged meanwhile, so
+    that the messages come out in order when the result is written.
+    '''
+    args, parsed = _batch
+    collector = crosstex.parse._Collector()
+    logger.addHandler(collector)
+    propagate, logger.propagate = logger.propagate, False
+    try:
+        status, outputs = build(args, *parsed[index])
+    finally:
+        logger.propagate = propagate
+        logger.removeHandler(collector)
+    return status, outputs, collector.records
+
+def batch(args):
+    '''Build and write the bibliography of each document in a batch.
+
+    The aux files of documents that use the same databases (see
+    Parser.bibdata) are parsed by one CrossTeX, which merges the databases
+    once; the objects resolved for one of these documents are reused for the
+    next.  With more than one job, the bibliographies are built in forked
+    processes, which start out with everything parsed here, and written here
+    in order.  Returns the status of the first document that failed, if any.
+    '''
+    global _batch
+    groups = {}
+    parsed = []
+    try:
+        paths = documents(args)
+        probe = configure(args)
+        for document in paths:
+            key = probe.bibdata(document)
+            if key not in groups:
+                groups[key] = configure(args) if groups else probe
+            xtx = groups[key]
+            parsed.append((document, xtx, xtx.parse_document(document)))
+    except crosstex.CrossTeXError as e:
+        logger.error(str(e))
+        return 1
+    results = None
+    jobs = min(args.jobs, len(parsed))
+    if jobs > 1:
+        try:
+            context = multiprocessing.get_context('fork')
+        except ValueError:
+            logger.debug('Cannot fork processes, building one document at a time.')
+        else:
+            _batch = (args, parsed)
+            pool = concurrent.futures.ProcessPoolExecutor(max_workers=jobs, mp_context=context,
+                                                          initializer=_forked)
+            results = pool.map(_build_worker, range(len(parsed)))
+    if results is None:
+        results = (build(args, *p) + ([],) for p in parsed)
+    status = 0
+    try:
+        for s, outputs, records in results:
+            for record in records:
+                logging.getLogger(record.name).handle(record)
+            write(outputs)
+            status = status or s
+    finally:
+        if _batch is not None:
+            pool.shutdown()
+            _batch = None
+    return status
+
+def main(argv):
+    if argv and argv[0] == 'cache':
+        return cache_main(argv[1:])
+    if argv and argv[0] == 'serve':
+        return serve_main(argv[1:])
+    args = parse_args(argv)
+    if args.batch:
+        return batch(args)
+    try:
+        xtx = load(args)
     except crosstex.CrossTeXError as e:
         logger.error(str(e))
         return 1
+    if args.watch:
+        return watch(args, xtx)
+    status, outputs = finish(args, xtx)
+    write(outputs)
+    return status
@@ -0,0 +1,219 @@
+'''
+A compact, column-oriented store for the raw entries of a database.
+
+Parsing a database normally leaves an Entry for each entry, a Field and a
+Value for each of its fields, and separate strings for every field name.  For
+databases with hundreds of thousands of entries these small objects take far
+more memory than the text they hold.  ColumnarEntries keeps the same
+information in a handful of arrays instead: field names and kinds are
+interned, file names are numbered in a source table, @default frames are
+shared, and the text of all values lives in one UTF-8 buffer.  Entry, Field
+and Value tuples are only built for the keys that are looked up.
+'''
+
+import array
+import bisect
+import zlib
+
+import crosstex.parse
+
+# The value kind of a field that is kept in ColumnarEntries.extras; its index
+# there takes the place of its line number.
+EXTRA = 0xffffffff
+
+def _hash(key):
+    'A hash of a key that stays the same when the store is pickled.'
+    return zlib.crc32(key.encode('utf-8'))
+
+class ColumnarEntries(object):
+    '''The entries of one database, standing in for XTXFileInfo.entries.
+
+    Entries are added with add() in the order they were created, so that the
+    order of their rows is that of their uids; when the database is merged,
+    base is set to the uid of the first row.  Once every entry has been added,
+    freeze() drops the dictionary that was used to look up keys meanwhile, in
+    favour of sorted arrays of key hashes.
+
+    A field is stored as its name, the kind of its value, its line and the end
+    of its text, which starts where the text of the field before it ends.
+    Conditionals, and anything else that is not a Field holding a string Value
+    from the file of its entry, are kept as they are in extras.
+    '''
+
+    def __init__(self):
+        self.base = 0
+        self.files = []
+        self.strings = []
+        self.frames = []
+        self.extras = []
+        self._file_ids = {}
+        self._string_ids = {}
+        self._frame_ids = {}
+        # one item per entry
+        self._kinds = array.array('I')
+        self._files = array.array('I')
+        self._lines = array.array('I')
+        self._defaults = array.array('I')
+        self._keys_end = array.array('I')
+        self._fields_end = array.array('I')
+        # one item per key of each entry
+        self._entry_keys = array.array('I')
+        # one item per field of each entry
+        self._field_names = array.array('I')
+        self._field_kinds = array.array('I')
+        self._field_lines = array.array('I')
+        self._field_ends = array.array('Q')
+        self._text = bytearray()
+        # one item per distinct key, in the order the keys were first added
+        self._key_ends = array.array('Q')
+        self._key_text = bytearray()
+        # the rows of each key: key ids and rows while adding, then by key
+        self._key_ids = {}
+        self._hashes = array.array('I')
+        self._hash_keys = array.array('I')
+        self._rows_end = array.array('I')
+        self._rows = array.array('I')
+
+    @property
+    def count(self):
+        return len(self._kinds)
+
+    def _intern(self, table, ids, value):
+        if value not in ids:
+            ids[value] = len(table)
+            table.append(value)
+        return ids[value]
+
+    def add(self, entry):
+        'Add an Entry under each of its keys.'
+        row = len(self._kinds)
+        self._kinds.append(self._intern(self.strings, self._string_ids, entry.kind))
+        self._files.append(self._intern(self.files, self._file_ids, entry.file))
+        self._lines.append(entry.line)
+        # Every entry after a @default shares its tuple of defaults
+        if id(entry.defaults) not in self._frame_ids:
+            self._frame_ids[id(entry.defaults)] = len(self.frames)
+            self.frames.append(entry.defaults)
+        self._defaults.append(self._frame_ids[id(entry.defaults)])
+        for key in entry.keys:
+            if key not in self._key_ids:
+                self._key_ids[key] = len(self._key_ends)
+                self._key_text += key.encode('utf-8')
+                self._key_ends.append(len(self._key_text))
+            self._entry_keys.append(self._key_ids[key])
+            # kept in pairs until freeze() groups them by key
+            self._hash_keys.append(self._key_ids[key])
+            self._rows.append(row)
+        self._keys_end.append(len(self._entry_keys))
+        for field in entry.fields:
+            self._add_field(entry, field)
+        self._fields_end.append(len(self._field_names))
+
+    def _add_field(self, entry, field):
+        value = getattr(field, 'value', None)
+        if isinstance(field, crosstex.parse.Field) and isinstance(value, crosstex.parse.Value) and \
+           isinstance(value.value, str) and value.file == entry.file and 0 <= value.line < EXTRA:
+            self._field_names.append(self._intern(self.strings, self._string_ids, field.name))
+            self._field_kinds.append(self._intern(self.strings, self._string_ids, value.kind))
+            self._field_lines.append(value.line)
+            self._text += value.value.encode('utf-8')
+        else:
+            self._field_names.append(0)
+            self._field_kinds.append(EXTRA)
+            self._field_lines.append(len(self.extras))
+            self.extras.append(field)
+        self._field_ends.append(len(self._text))
+
+    def freeze(self):
+        '''Index the keys once every entry has been added.
+
+        The rows of each key are grouped together, in the order they were
+        added, and the keys are sorted by hash for get() to search.
+        '''
+        keys = len(self._key_ends)
+        counts = [0] * (keys + 1)
+        for key in self._hash_keys:
+            counts[key + 1] += 1
+        for i in range(keys):
+            counts[i + 1] += counts[i]
+        self._rows_end = array.array('I', counts[1:])
+        rows = array.array('I', bytes(self._rows.itemsize * len(self._rows)))
+        for key, row in zip(self._hash_keys, self._rows):
+            rows[counts[key]] = row
+            counts[key] += 1
+        self._rows = rows
+        order = sorted(range(keys), key=lambda k: _hash(self._key(k)))
+        self._hash_keys = array.array('I', order)
+        self._hashes = array.array('I', [_hash(self._key(k)) for k in order])
+        self._key_ids = None
+        self._file_ids = self._string_ids = self._frame_ids = None
+
+    def _key(self, key):
+        start = self._key_ends[key - 1] if key else 0
+        return self._key_text[start:self._key_ends[key]].decode('utf-8')
+
+    def _find(self, key):
+        'Return the id of key, or None.'
+        if self._key_ids is not None:
+            return self._key_ids.get(key)
+        h = _hash(key)
+        i = bisect.bisect_left(self._hashes, h)
+        while i < len(self._hashes) and self._hashes[i] == h:
+            if self._key(self._hash_keys[i]) == key:
+                return self._hash_keys[i]
+            i += 1
+        return None
+
+    def entry(self, row):
+        'Build the Entry for a row, fields and all.'
+        file = self.files[self._files[row]]
+        start = self._keys_end[row - 1] if row else 0
+        keys = tuple([self._key(k) for k in self._entry_keys[start:self._keys_end[row]]])
+        fields = []
+        first = self._fields_end[row - 1] if row else 0
+        for i in range(first, self._fields_end[row]):
+            if self._field_kinds[i] == EXTRA:
+                fields.append(self.extras[self._field_lines[i]])
+                continue
+            start = self._field_ends[i - 1] if i else 0
+            text = self._text[start:self._field_ends[i]].decode('utf-8')
+            value = crosstex.parse.Value(file, self._field_lines[i], self.strings[self._field_kinds[i]], text)
+            fields.append(crosstex.parse.Field(self.strings[self._field_names[i]], value))
+        return crosstex.parse.Entry(self.base + row, self.strings[self._kinds[row]], keys,
+                                    tuple(fields), file, self._lines[row],
+                                    self.frames[self._defaults[row]])
+
+    def get(self, key, default=None):
+        key = self._find(key)
+        if key is None:
+            return default
+        if self._key_ids is not None:
+            rows = [r for k, r in zip(self._hash_keys, self._rows) if k == key]
+        else:
+            start = self._rows_end[key - 1] if key else 0
+            rows = self._rows[start:self._rows_end[key]]
+        return [self.entry(r) for r in rows]
+
+    def __getitem__(self, key):
+        found = self.get(key)
+        if found is None:
+            raise KeyError(key)
+        return found
+
+    def __contains__(self, key):
+        return self._find(key) is not None
+
+    def keys(self):
+        return [self._key(k) for k in range(len(self._key_ends))]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self._key_ends)
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def values(self):
+        return [es for key, es in self.items()]
@@ -1,4 +1,7 @@
 CROSSTEX_FILE_ENDING = ".xtx"
 BIBTEX_FILE_ENDING = ".bib"
 BIB_CACHE_FILE_ENDING = ".bbl"
-CACHE_FILE_ENDING = ".cache"
+CACHE_FILE_NAME = "databases.sqlite"
+CACHE_SIZE = 512 * 1024 * 1024
+
+VERSION = "0.9.0"
@@ -1,6 +1,8 @@
-import collections
+import collections.abc
 import copy
+import keyword
 
+import crosstex
 import crosstex.parse
 
 class CiteableTrue(object):
@@ -20,33 +22,82 @@ class Field(object):
         self.iterable = iterable
         self.name = None
     
-    def __get__(self, obj, objtype):
-        if hasattr(obj, '_' + self.name):
-            return getattr(obj, '_' + self.name)
-        return None
-
-    def __set__(self, obj, value):
-        ''' Set the filed of a specified object '''
+    def check(self, value):
+        ''' Check that value may be set in this field of an object '''
 
         # It is a single value
         is_compatible_type = value is None or value.__class__ in self.types
 
         # It's multiple values, we need to check each values type
         has_compatible_subtypes = self.iterable and \
-                isinstance(value, collections.Iterable) and \
-                all([isinstance(v, self.types) for v in value])
+                isinstance(value, collections.abc.Iterable) and \
+                all(isinstance(v, self.types) for v in value)
 
-        if is_compatible_type or has_compatible_subtypes:
-            setattr(obj, '_' + self.name, value)
-        else:
+        if not (is_compatible_type or has_compatible_subtypes):
             raise TypeError('Field %s does not allow type %s' %
                             (self.name, str(type(value))))
 
+def _unknown(kwargs):
+    'Raise the error for fields that no object of a class has.'
+    for key in kwargs:
+        if key.startswith('_'):
+            raise crosstex.CrossTeXError("Invalid keyname. Starts with '_'.")
+        raise crosstex.CrossTeXError("Cannot set attribute. No such field " + key + ".")
+
+def _make_init(cls):
+    '''Compile the __init__ of a class of objects.
+
+    It takes each field as a keyword argument, defaulting to None, and sets
+    every slot.  A value is only handed to its Field to check when it is not
+    None or of one of the types the Field allows, which is most of them, nor a
+    list of these for a field that may have several.
+    '''
+    namespace = {'_unknown': _unknown}
+    params = []
+    body = []
+    for i, name in enumerate(cls._slots):
+        assert name.isidentifier() and not keyword.iskeyword(name)
+        field = cls._fields[name]
+        namespace['_types%d' % i] = frozenset(field.types)
+        namespace['_check%d' % i] = field.check
+        params.append('%s=None, ' % name)
+        body.append('    if %s is not None and %s.__class__ not in _types%d:\n' % (name, name, i))
+        if field.iterable:
+            body.append('        if %s.__class__ is not list:\n' % name)
+            body.append('            _check%d(%s)\n' % (i, name))
+            body.append('        else:\n')
+            body.append('            for _value in %s:\n' % name)
+            body.append('                if _value.__class__ not in _types%d:\n' % i)
+            body.append('                    _check%d(%s)\n' % (i, name))
+            body.append('                    break\n')
+        else:
+            body.append('        _check%d(%s)\n' % (i, name))
+        body.append('    self.%s = %s\n' % (name, name))
+    source = 'def __init__(self, %s**_kwargs):\n' % ''.join(['*, '] + params if params else [])
+    source += '    if _kwargs:\n        _unknown(_kwargs)\n'
+    source += ''.join(body)
+    exec(compile(source, '<%s.__init__>' % cls.kind, 'exec'), namespace)
+    init = namespace['__init__']
+    init.__qualname__ = cls.__qualname__ + '.__init__'
+    init.__module__ = cls.__module__
+    return init
+
 class ObjectMeta(type):
+    '''Make a class of objects out of the Fields it declares.
+
+    There are as many objects as entries in a database, so rather than in a
+    __dict__, each object keeps the value of a field in a slot of the same name,
+    which reads as fast as any attribute.  A class only adds slots for the
+    fields its base does not have; the Fields themselves are kept in _fields,
+    to check the values set through __init__ or set_field.  Unless it has its
+    own, a class gets an __init__ compiled for its fields (see _make_init).
+    '''
+
     def __new__(cls, name, bases, dct):
         allowed = set([])
         required = set([])
         alternates = {}
+        fields = {}
 
         for attr, value in dct.items():
             if attr == 'citeable':
@@ -59,12 +110,13 @@ class ObjectMeta(type):
                     required.add(attr)
                 if isinstance(value.alternates, str):
                     alternates[attr] = value.alternates
-                elif isinstance(value.alternates, collections.Iterable):
+                elif isinstance(value.alternates, collections.abc.Iterable):
                     assert all([isinstance(a, str) for a in value.alternates])
                     alternates[attr] = [a for a in value.alternates]
                 else:
                     assert False
                 value.name = attr
+                fields[attr] = value
 
         optional = allowed - required
         assert len(bases) <= 1
@@ -82,25 +134,33 @@ class ObjectMeta(type):
         dct['allowed'] = allowed
         dct['required'] = required
         dct['alternates'] = alternates
-        return super(ObjectMeta, cls).__new__(cls, name, bases, dct)
+        inherited = set([])
+        for base in bases:
+            inherited |= set(getattr(base, '_slots', ()))
+            newfields = dict(getattr(base, '_fields', {}))
+            newfields.update(fields)
+            fields = newfields
+            del newfields
+        # A Field left in the class would hide the slot of a base
+        for attr in fields:
+            dct.pop(attr, None)
+        dct['__slots__'] = tuple(sorted(allowed - inherited))
+        dct['_slots'] = tuple(sorted(allowed))
+        dct['_fields'] = fields
+        new = super(ObjectMeta, cls).__new__(cls, name, bases, dct)
+        if '__init__' not in dct:
+            new.__init__ = _make_init(new)
+        return new
 
 class Object(metaclass = ObjectMeta):
     citeable = CiteableFalse()
 
-    def __init__(self, **kwargs):
-        for key, word in kwargs.items():
-            if key.startswith('_'):
-                raise CrossTeXError("Invalid keyname. Starts with '_'.")
-
-            if not hasattr(self, key):
-                raise CrossTeXError("Cannot set attribute. No such field " + key + ".")
-            
-            setattr(self, key, word)
-
     def isset_field(self, name):
         return getattr(self, name, None) is not None
 
     def set_field(self, name, value):
+        if name in self._fields:
+            self._fields[name].check(value)
         setattr(self, name, value)
 
     def items(self):
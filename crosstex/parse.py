@@ -12,8 +12,11 @@ be resolved and checked.
 '''
 
 import collections
+import concurrent.futures
 import copy
+import hashlib
 import logging
+import mmap
 import os
 import re
 
@@ -26,12 +29,20 @@ import ply.lex
 import ply.yacc
 
 import crosstex
+import crosstex.cache
+import crosstex.columnar
+import crosstex.paths
+import crosstex.scan
+import crosstex.search
 from crosstex.constants import *
 
 logger = logging.getLogger('crosstex.parse')
 
 next_uid = 1
 
+_lexer = None
+_parser = None
+
 Entry = collections.namedtuple('Entry', ('uid', 'kind', 'keys', 'fields', 'file', 'line', 'defaults'))
 Value = collections.namedtuple('Value', ('file', 'line', 'kind', 'value'))
 Field = collections.namedtuple('Field', ('name', 'value'))
@@ -59,6 +70,343 @@ def create_value(_file, line, value, kind=None):
 
     return Value(_file, line, kind, value)
 
+TOKENIZERS = ('ply', 'fast')
+
+# Databases smaller than this many bytes are parsed in place, which is quicker
+# than handing them to a worker process and merging what it sends back
+PREFETCH_BYTES = 64 * 1024
+
+def engine(tokenizer='ply'):
+    '''Return a (lexer, parser) pair ready to process one database file.
+
+    The master regular expression and the LALR tables are built the first time
+    this is called and are shared by every file parsed afterwards.  The tables
+    are normally read from the precomputed crosstex/parsetab.py; PLY falls back
+    to computing them in memory if the grammar no longer matches.  Each caller
+    gets its own lexer, so per-file state never leaks between files.
+
+    With tokenizer='fast' the lexer is a crosstex.scan.Scanner instead of the
+    PLY lexer; both produce the same tokens.
+    '''
+    global _lexer
+    if tokenizer not in TOKENIZERS:
+        raise crosstex.CrossTeXError('Unknown tokenizer %r.' % tokenizer)
+    if tokenizer == 'fast':
+        return crosstex.scan.Scanner(), grammar()
+    if _lexer is None:
+        _lexer = ply.lex.lex(reflags=re.UNICODE)
+    return _lexer.clone(), grammar()
+
+def grammar():
+    'Return the shared LALR parser.'
+    global _parser
+    if _parser is None:
+        _parser = ply.yacc.yacc(debug=0, write_tables=0)
+    return _parser
+
+def reset_engine():
+    'Drop the shared lexer and parser so that the next file rebuilds them.'
+    global _lexer, _parser
+    _lexer = None
+    _parser = None
+
+def run(lexer, parser, contents):
+    'Parse contents with the shared parser without it keeping hold of lexer.'
+    try:
+        parser.parse(contents, lexer=lexer)
+    finally:
+        # PLY remembers the token method of the last lexer, and through it
+        # the lexer's input and database
+        parser.token = None
+
+def write_tables():
+    'Regenerate crosstex/parsetab.py after the grammar has been changed.'
+    global _parser
+    _parser = ply.yacc.yacc(debug=0, write_tables=1,
+                            outputdir=os.path.dirname(__file__))
+
+def parse_database(path, tokenizer='ply', columnar=False):
+    '''Parse one .xtx or .bib file into an XTXFileInfo.
+
+    Included files are only recorded, not parsed; they are followed when the
+    result is merged into a Parser.  With columnar set, the entries are kept
+    in a crosstex.columnar.ColumnarEntries rather than a dictionary.
+    '''
+    logger.debug('Processing database %s.' % path)
+    db = XTXFileInfo()
+    if columnar:
+        db.entries = crosstex.columnar.ColumnarEntries()
+    stream = open(path)
+
+    contents  = stream.read()
+
+    if contents:
+        lexer, parser = engine(tokenizer)
+        lexer.path = path
+        lexer.file = os.path.basename(path)
+        lexer.lineno = 1
+        lexer.expectstring = False
+
+        lexer.db = db
+        lexer.defaults = ()
+
+        run(lexer, parser, contents)
+    stream.close()
+    if columnar:
+        db.entries.freeze()
+    return db
+
+class _Collector(logging.Handler):
+    'Hold on to log records so that another process can emit them.'
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None
+        self.records.append(record)
+
+def _parse_worker(path, tokenizer, level, store=None):
+    '''Parse one database in a worker process.
+
+    Returns the signature and digest of the file, the XTXFileInfo as split up
+    by crosstex.cache.encode, and everything that was logged meanwhile, so that
+    the messages come out in order when the result is merged.  With a
+    CacheStore the worker stores the database itself and sends back None
+    instead, so that the parent only has to load it.
+    '''
+    collector = _Collector()
+    logger.setLevel(level)
+    logger.addHandler(collector)
+    propagate, logger.propagate = logger.propagate, False
+    try:
+        stat = crosstex.cache.signature(path)
+        digest = crosstex.cache.digest(path)
+        encoded = crosstex.cache.encode(parse_database(path, tokenizer))
+        if store is not None:
+            if store.store(path, digest, stat, encoded) is not None:
+                encoded = None
+            store.close()
+    finally:
+        logger.propagate = propagate
+        logger.removeHandler(collector)
+    return stat, digest, encoded, collector.records
+
+class LazyFields(object):
+    '''The fields of an entry in a memory-mapped database.
+
+    Nothing is decoded until the fields are first iterated, indexed or
+    pickled; then the text of the entry is run through the grammar again and
+    the mapped file is no longer referenced.
+    '''
+
+    __slots__ = ('_source', '_span', '_file', '_fields')
+
+    def __init__(self, source, span, _file):
+        self._source = source
+        self._span = span
+        self._file = _file
+        self._fields = None
+
+    def materialize(self):
+        if self._fields is None:
+            lexer, parser = engine('fast')
+            lexer.file = self._file
+            lexer.lineno = self._span.lineno
+            lexer.expectstring = False
+            lexer.db = XTXFileInfo()
+            lexer.defaults = ()
+            run(lexer, parser, self._source[self._span.start:self._span.end])
+            entries = [e for es in lexer.db.entries.values() for e in es]
+            self._fields = tuple(entries[0].fields) if entries else ()
+            self._source = None
+        return self._fields
+
+    @property
+    def materialized(self):
+        return self._fields is not None
+
+    def __iter__(self):
+        return iter(self.materialize())
+
+    def __len__(self):
+        return len(self.materialize())
+
+    def __getitem__(self, index):
+        return self.materialize()[index]
+
+    def __reduce__(self):
+        return (tuple, (self.materialize(),))
+
+class Entries(object):
+    '''The entries of every database merged so far, as lists of Entry by key.
+
+    Each merged database is kept as a layer, and looking up a key concatenates
+    what the layers have for it in the order they were merged.  Databases
+    parsed in this process are plain dictionaries; consecutive ones are
+    folded into one.  Those loaded from the cache are StoredEntries, which
+    only read the entries for a key from the store when it is looked up, with
+    one query per store.  ColumnarEntries build the entries for a key from
+    their arrays when it is looked up.
+
+    Keys that name the same entry, as in @conference{a = b, ...}, form a
+    group; so do the keys of any entries sharing one of them.  The groups are
+    kept in a union-find as layers are added, from the keys of the entries
+    that have several, which each database lists along with its entries.
+    '''
+
+    def __init__(self):
+        self._layers = []
+        self._found = {}
+        self._index = None
+        # The union-find: the parent of each key in a group with others, and
+        # the keys of each group by the key at its root
+        self._parent = {}
+        self._members = {}
+        self._selected = {}
+
+    def add(self, layer, groups=()):
+        '''Add the entries of another database.
+
+        groups lists the keys of each of its entries that has several.
+        '''
+        self._found = {}
+        self._index = None
+        self._selected = {}
+        for keys in groups:
+            for key in keys[1:]:
+                self._union(keys[0], key)
+        if not isinstance(layer, dict):
+            self._layers.append(layer)
+            return
+        if not self._layers or not isinstance(self._layers[-1], dict):
+            self._layers.append({})
+        merged = self._layers[-1]
+        for k, es in layer.items():
+            if k in merged:
+                merged[k] += es
+            else:
+                merged[k] = list(es)
+
+    def get(self, key, default=None):
+        if key not in self._found:
+            stored = collections.defaultdict(list)
+            for layer in self._layers:
+                if isinstance(layer, crosstex.cache.StoredEntries):
+                    stored[layer.store].append(layer)
+            hits = {}
+            for store, layers in stored.items():
+                hits.update(store.find(key, layers))
+            found = []
+            for layer in self._layers:
+                if isinstance(layer, crosstex.cache.StoredEntries):
+                    found += hits.get(layer, [])
+                else:
+                    found += layer.get(key, [])
+            self._found[key] = found
+        return self._found[key] or default
+
+    def __getitem__(self, key):
+        found = self.get(key)
+        if not found:
+            raise KeyError(key)
+        return found
+
+    def _find(self, key):
+        parent = self._parent
+        while key in parent and parent[key] != key:
+            # Halve the path on the way
+            parent[key] = parent[parent[key]]
+            key = parent[key]
+        return key
+
+    def _union(self, a, b):
+        a, b = self._find(a), self._find(b)
+        if a == b:
+            return
+        members = self._members
+        if len(members.get(a, (a,))) < len(members.get(b, (b,))):
+            a, b = b, a
+        self._parent.setdefault(a, a)
+        self._parent[b] = a
+        members[a] = members.pop(a, (a,)) + members.pop(b, (b,))
+
+    def group(self, key):
+        'The keys in the group of key, in the order they were put together.'
+        return self._members.get(self._find(key), (key,))
+
+    def select(self, key):
+        '''The entries of the group of key, as Database._select uses them.
+
+        Returns (keys, base, extensions, duplicates): the keys in the group,
+        the first entry that is not an @extend, the @extend entries, and
+        (key, entry) for each other entry that is not one, by a key it has.
+        The entries of the keys are gone through in the order group returns
+        them, once per group.
+        '''
+        root = self._find(key)
+        if root not in self._selected:
+            keys = self.group(key)
+            seen = set([])
+            base = None
+            extensions = []
+            duplicates = []
+            for k in keys:
+                for entry in self.get(k, []):
+                    if entry.uid in seen:
+                        continue
+                    seen.add(entry.uid)
+                    if entry.kind == 'extend':
+                        extensions.append(entry)
+                    elif base is None:
+                        base = entry
+                    else:
+                        duplicates.append((k, entry))
+            self._selected[root] = (frozenset(keys), base, extensions, duplicates)
+        return self._selected[root]
+
+    def __contains__(self, key):
+        return bool(self.get(key))
+
+    def keys(self):
+        seen = set([])
+        keys = []
+        for layer in self._layers:
+            for key in layer.keys():
+                if key not in seen:
+                    seen.add(key)
+                    keys.append(key)
+        return keys
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def index(self):
+        'The crosstex.search.Index of the entries, for constrained citations.'
+        if self._index is None:
+            self._index = crosstex.search.Index(self._layers)
+        return self._index
+
+    def ordered(self, keys):
+        'Those of keys there are entries for, in the order keys() returns them.'
+        keys = set(keys)
+        order = {}
+        for i, layer in enumerate(self._layers):
+            if isinstance(layer, crosstex.cache.StoredEntries):
+                positions = layer.store.positions(layer.file_id, keys)
+            else:
+                positions = dict([(key, position) for position, key in enumerate(layer.keys())
+                                  if key in keys])
+            for key, position in positions.items():
+                order.setdefault(key, (i, position))
+        return sorted(order, key=order.get)
+
 class XTXFileInfo:
     'Same stuff as in Parser, but only for one file'
 
@@ -69,43 +417,157 @@ class XTXFileInfo:
         self.titlesmalls = set([])
         self.preambles = set([])
         self.entries = collections.defaultdict(list)
+        # The keys of each entry that has several (see Entries)
+        self.groups = []
         self.tobeparsed = []
 
     def parse(self, file, **kwargs):
         self.tobeparsed.append(file)
 
-    def merge(self, db):
-        db.cite = set(db.cite) | set(self.cite)
-        db.alias = db.alias.copy()
+    def add_entry(self, entry):
+        if len(entry.keys) > 1:
+            self.groups.append(entry.keys)
+        if isinstance(self.entries, crosstex.columnar.ColumnarEntries):
+            self.entries.add(entry)
+            return
+        for key in entry.keys:
+            self.entries[key].append(entry)
+
+    def merge(self, db, follow=True):
+        '''Add everything from this file to db, a Parser.
+
+        db is updated in place, so merging costs as much as this file holds,
+        no matter how much was merged before.
+        '''
+        db.cite.update(self.cite)
         db.alias.update(self.alias)
-        db.titlephrases = set(db.titlephrases) | set(self.titlephrases)
-        db.titlesmalls = set(db.titlesmalls) | set(self.titlesmalls)
-        db.preambles = set(db.preambles) | set(self.preambles)
+        db.titlephrases.update(self.titlephrases)
+        db.titlesmalls.update(self.titlesmalls)
+        db.preambles.update(self.preambles)
         
+        self.renumber()
+        db.entries.add(self.entries, self.groups)
+        if follow:
+            db.parse_all(self.tobeparsed, exts=[CROSSTEX_FILE_ENDING, BIBTEX_FILE_ENDING])
+
+    def renumber(self):
+        '''Give the entries new uids, in the order they were created.
+
+        Uids are handed out again whenever a file is merged, so entries read
+        from a cache or parsed in another process never collide with those
+        already in the database.
+        '''
+        global next_uid
+        if isinstance(self.entries, (crosstex.cache.StoredEntries, crosstex.columnar.ColumnarEntries)):
+            self.entries.base = next_uid
+            next_uid += self.entries.count
+            return
+        renumbered = {}
+        for es in self.entries.values():
+            for e in es:
+                renumbered[e.uid] = e
+        for uid in sorted(renumbered):
+            renumbered[uid] = renumbered[uid]._replace(uid=next_uid)
+            next_uid += 1
         for k, es in self.entries.items():
-            db.entries[k] += es
-        for file in self.tobeparsed:
-            db.parse(file, exts=[CROSSTEX_FILE_ENDING, BIBTEX_FILE_ENDING])
+            self.entries[k] = [renumbered[e.uid] for e in es]
 
 class Parser:
     'A structure of almost raw data from the databases.'
 
-    def __init__(self, path):
+    def __init__(self, path, tokenizer='ply', use_mmap=False, jobs=1, cache=None, columnar=False):
         self.cite = set([])
         self.alias = {}
         self.titlephrases = set([])
         self.titlesmalls = set([])
         self.preambles = set([])
-        self.entries = collections.defaultdict(list)
+        self.entries = Entries()
         self.citations = set([])
+        self.sources = []
         self._bibstyle = 'plain'
         self._path = path
         self._seen = collections.defaultdict(dict)
         self._dirstack = []
+        self._tokenizer = tokenizer
+        self._use_mmap = use_mmap
+        self._jobs = jobs
+        self._pool = None
+        self._depth = 0
+        self._prefetched = {}
+        self._locks = {}
+        self._cache = cache
+        self._columnar = columnar
+        self._manifest = None
+        self._index = crosstex.paths.PathIndex(cache)
+        self._parsed = {}
+        self._reusable = {}
 
     def set_path(self, path):
         self._path = path
 
+    def renew(self):
+        '''Return a new Parser with the same settings, to parse the same files again.
+
+        Databases this one parsed without the cache are reused by the new one
+        instead of being parsed again, unless they have changed since.
+        '''
+        parser = Parser(self._path, tokenizer=self._tokenizer, use_mmap=self._use_mmap,
+                        jobs=self._jobs, cache=self._cache, columnar=self._columnar)
+        parser._reusable = self._parsed
+        return parser
+
+    def inputs(self):
+        'The paths of the files parsed and of the directories searched for them.'
+        paths = set(self._index.directories())
+        for found in self._seen.values():
+            paths.update(found.values())
+        return sorted(paths)
+
+    def bibdata(self, name, visited=None):
+        '''The databases the .aux file name uses, without parsing anything.
+
+        Returns (name, path) for each database its \\bibdata and those of the
+        .aux files it inputs name, in order, where path is what the name
+        resolves to, or None if it cannot be found.
+        '''
+        visited = visited if visited is not None else set([])
+        found = self._find(name, ['.aux'], quiet=True)
+        if found is None or found[0] in visited:
+            return ()
+        path, directory, seen = found
+        visited.add(path)
+        databases = []
+        self._dirstack.append(directory)
+        try:
+            with open(path) as stream:
+                for line in stream:
+                    if line.startswith(r'\bibdata'):
+                        for db in line[9:].rstrip().rstrip('}').split(','):
+                            found = self._find(db, [CROSSTEX_FILE_ENDING, BIBTEX_FILE_ENDING], quiet=True)
+                            databases.append((db, found and found[0]))
+                    elif line.startswith(r'\@input'):
+                        for f in line[8:].rstrip().rstrip('}').split(','):
+                            databases.extend(self.bibdata(f, visited))
+        except (IOError, OSError):
+            pass
+        finally:
+            self._dirstack.pop()
+        return tuple(databases)
+
+    def parse_document(self, name):
+        '''Parse the .aux file of another document and return its citations.
+
+        The databases it uses are not merged again if a document parsed
+        before used them already, under the same names; the caller makes sure
+        these resolve to the same files (see bibdata).  The .aux files it
+        inputs are parsed even if another document's had the same names.
+        '''
+        for found in self._seen.values():
+            found.pop('.aux', None)
+        self.citations = set([])
+        self.parse(name, ['.aux'])
+        return self.citations
+
     def parse(self, name, exts=['.aux', CROSSTEX_FILE_ENDING, BIB_CACHE_FILE_ENDING]):
         'Find a file with a reasonable extension and extract its information.'
         if name in self._seen:
@@ -113,22 +575,178 @@ class Parser:
             for ext, path in self._seen[name].items():
                 if ext in exts:
                     return path
+        if self._manifest is not None:
+            self._manifest.queried.add(name)
+        found = self._find(name, exts)
+        if found is None:
+            return None
+        path, directory, seen = found
+        try:
+            self._dirstack.append(directory)
+            ext = os.path.splitext(path)[1]
+            if self._manifest is None and self._cache is not None and not self._use_mmap and \
+               ext in (CROSSTEX_FILE_ENDING, BIBTEX_FILE_ENDING) and ext in exts:
+                return self._parse_tree(path, name=seen)
+            return self._parse_from_path(path, name=seen)
+        finally:
+            self._dirstack.pop()
+
+    def _parse_tree(self, path, name=None):
+        '''Parse a database and the databases it includes.
+
+        If the manifest recorded the last time shows that none of them has
+        changed, nor would any @include find a different file, they are all
+        loaded from the cache without being looked up again.  Otherwise they
+        are parsed as usual while a new manifest is recorded.
+        '''
+        store = self._cache
+        context = repr((self._dirstack[-1], list(self._path)))
+        manifest = store.load_manifest(path, context)
+        if manifest is not None and self._replay(manifest, store, context):
+            logger.debug('Processing database %r and its includes from cache.' % path)
+            return path
+        before = set(self._seen)
+        self._manifest = manifest = crosstex.cache.Manifest()
+        try:
+            result = self._parse_from_path(path, name=name)
+        finally:
+            self._manifest = None
+        if manifest.complete and not manifest.queried & before:
+            store.store_manifest(path, context, manifest)
+        return result
+
+    def _replay(self, manifest, store, context):
+        '''Merge everything a manifest lists, if it is all still valid.
+
+        Nothing is merged unless every file in it can be loaded.
+        '''
+        for name in manifest.queried:
+            if name in self._seen:
+                return False
+        changed = manifest.changed(self._index.exists)
+        if changed is None:
+            return False
+        dbs = []
+        for path, digest in manifest.files:
+            try:
+                db = store.load_digest(path, digest)
+            except Exception:
+                return False
+            if db is None:
+                return False
+            dbs.append(db)
+        if changed:
+            for path, stat in changed:
+                store.touch(path, stat)
+                manifest.stats[path] = stat
+            store.store_manifest(manifest.files[0][0], context, manifest)
+        for name, ext, path in manifest.seen:
+            self._seen[name][ext] = path
+        for (path, digest), db in zip(manifest.files, dbs):
+            self.sources.append((path, manifest.stats[path]))
+            db.merge(self, follow=False)
+        return True
+
+    def parse_all(self, names, exts=['.aux', CROSSTEX_FILE_ENDING, BIB_CACHE_FILE_ENDING]):
+        '''Parse several files in turn, exactly as calling parse on each would.
+
+        With more than one job, the databases among them that have no fresh
+        cache are first handed to worker processes, if there are at least two
+        of PREFETCH_BYTES or more.  Their results are still
+        merged here one at a time and in order, so the outcome is the same as
+        that of a sequential parse.
+        '''
+        if self._jobs <= 1 or self._use_mmap:
+            for name in names:
+                self.parse(name, exts)
+            return
+        self._depth += 1
+        fetched = []
+        try:
+            fetched = self._prefetch(names, exts)
+            for name in names:
+                self.parse(name, exts)
+        finally:
+            self._depth -= 1
+            for path in fetched:
+                future = self._prefetched.pop(path, None)
+                if future is not None:
+                    future.cancel()
+                if path in self._locks:
+                    self._locks.pop(path).release()
+            if self._depth == 0 and self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
+
+    def _prefetch(self, names, exts):
+        '''Start parsing the uncached databases among names in worker processes.
+
+        Returns the paths that were handed out.
+        '''
+        paths = []
+        for name in names:
+            if name in self._seen:
+                continue
+            found = self._find(name, exts, quiet=True)
+            if found is None:
+                continue
+            path = found[0]
+            ext = os.path.splitext(path)[1]
+            if ext not in (CROSSTEX_FILE_ENDING, BIBTEX_FILE_ENDING) or \
+               ext not in exts or path in paths or path in self._prefetched:
+                continue
+            try:
+                if os.path.getsize(path) < PREFETCH_BYTES:
+                    continue
+            except OSError:
+                continue
+            if self._cache is not None:
+                try:
+                    if self._cache.has(path, crosstex.cache.signature(path)):
+                        continue
+                except (IOError, OSError):
+                    pass
+                # Leave databases another process is parsing to it
+                lock = self._cache.lock(path)
+                if not lock.acquire(timeout=0):
+                    continue
+                self._locks[path] = lock
+            paths.append(path)
+        if len(paths) < 2:
+            for path in paths:
+                if path in self._locks:
+                    self._locks.pop(path).release()
+            return []
+        if self._pool is None:
+            self._pool = concurrent.futures.ProcessPoolExecutor(max_workers=min(self._jobs, len(paths)))
+        level = logger.getEffectiveLevel()
+        for path in paths:
+            self._prefetched[path] = self._pool.submit(_parse_worker, path, self._tokenizer, level,
+                                                       self._cache)
+        return paths
+
+    def _find(self, name, exts, quiet=False):
+        '''Resolve name to a file without parsing it.
+
+        Returns (path, directory, name) where directory is where the files the
+        file includes are looked up first and name is what it is recorded as
+        seen under, or None if there is no such file.
+        '''
         if os.path.sep in name:
-            logger.debug('%r has a %r, treating it as a path to a file.' % (name, os.path.sep))
+            if not quiet:
+                logger.debug('%r has a %r, treating it as a path to a file.' % (name, os.path.sep))
             path = name
             if self._dirstack:
                 path = os.path.join(self._dirstack[-1], path)
-            if not os.path.exists(path):
-                logger.error('Can not parse %r because it resolves to %r which doesn\'t exist' % (name, path))
+            if not self._index.exists(path):
+                if not quiet:
+                    self._incomplete()
+                    logger.error('Can not parse %r because it resolves to %r which doesn\'t exist' % (name, path))
                 return None
-            try:
-                self._dirstack.append(os.path.dirname(path))
-                return self._parse_from_path(path)
-            finally:
-                self._dirstack.pop()
+            return path, os.path.dirname(path), None
         base, ext = os.path.splitext(name)
         if ext:
-            if not self._check_ext(name, ext, exts):
+            if not self._check_ext(name, ext, exts, quiet=quiet):
                 return None
             tryexts = [ext]
         else:
@@ -139,17 +757,20 @@ class Parser:
             trydirs = self._path
         for d in trydirs:
             for e in tryexts:
-                try:
-                    self._dirstack.append(d)
-                    path = os.path.join(d, base + e)
-                    if not os.path.exists(path):
-                        continue
-                    return self._parse_from_path(path, name=name)
-                finally:
-                    self._dirstack.pop()
-        logger.error('Can not find %s database.' % name)
+                path = os.path.join(d, base + e)
+                if self._index.exists(path):
+                    return path, d, name
+                if not quiet and self._manifest is not None:
+                    self._manifest.absent.add(path)
+        if not quiet:
+            self._incomplete()
+            logger.error('Can not find %s database.' % name)
         return None
 
+    def _incomplete(self):
+        if self._manifest is not None:
+            self._manifest.complete = False
+
     def _parse_from_path(self, path, name=None):
         'Parse a file from an absolute path'
         assert os.path.sep in path
@@ -158,6 +779,8 @@ class Parser:
         if self._check_ext(path, ext):
             func = '_parse_ext_' + ext[1:]
             self._seen[name][ext] = path
+            if self._manifest is not None:
+                self._manifest.seen.append((name, ext, path))
             return getattr(self, func)(path)
         return None
 
@@ -174,8 +797,8 @@ class Parser:
             elif line.startswith(r'\bibstyle'):
                 self._bibstyle = line[10:].rstrip().rstrip('}').split(' ')
             elif line.startswith(r'\bibdata'):
-                for f in line[9:].rstrip().rstrip('}').split(','):
-                    self.parse(f, [CROSSTEX_FILE_ENDING, BIBTEX_FILE_ENDING])
+                self.parse_all(line[9:].rstrip().rstrip('}').split(','),
+                               [CROSSTEX_FILE_ENDING, BIBTEX_FILE_ENDING])
             elif line.startswith(r'\@input'):
                 for f in line[8:].rstrip().rstrip('}').split(','):
                     self.parse(f, ['.aux'])
@@ -185,58 +808,120 @@ class Parser:
 
     def _parse_ext_xtx(self, path):
         'Parse and handle options set in a CrossTeX .xtx or BibTeX .bib database file.'
-        cache_path = os.path.join(os.path.dirname(path),
-                                  os.path.basename(path) + CACHE_FILE_ENDING)
+        if self._use_mmap:
+            return self._parse_mapped(path)
+        store = self._cache
+        future = self._prefetched.pop(path, None)
+        lock = self._locks.pop(path, None)
+        if future is not None:
+            try:
+                stat, digest, encoded, records = future.result()
+            except Exception as e:
+                logger.debug('Parsing %s in a worker failed, parsing it again: %s.' % (path, e))
+            else:
+                for record in records:
+                    logging.getLogger(record.name).handle(record)
+                if encoded is None:
+                    db = store.load_digest(path, digest)
+                else:
+                    db = crosstex.cache.decode(encoded)
+                if db is not None:
+                    if lock is not None:
+                        lock.release()
+                    self._record(path, digest, stat)
+                    db.merge(self)
+                    return path
+                logger.debug('Could not load %s, which a worker stored, parsing it again.' % path)
+        if store is None:
+            stat = crosstex.cache.signature(path)
+            reused = self._reusable.get(path)
+            if reused is not None and reused[0] == stat:
+                logger.debug('Reusing database %r, which has not changed.' % path)
+                # Merging renumbers the entries, which the previous Parser
+                # still uses
+                db = copy.copy(reused[1])
+                db.entries = copy.copy(db.entries)
+            else:
+                db = parse_database(path, self._tokenizer, self._columnar)
+            self._parsed[path] = (stat, db)
+            self._record(path, None, stat)
+            db.merge(self)
+            return path
+        stat = crosstex.cache.signature(path)
         try:
-            if os.path.exists(cache_path) and \
-               os.path.getmtime(path) < os.path.getmtime(cache_path):
+            try:
+                digest, db = store.load(path, stat)
+            except Exception as e:
+                logger.error("Could not read cache '%r', falling back to database: %s." % (store.path, e))
+                digest, db = crosstex.cache.digest(path), None
+            if db is None:
+                # Let only one process parse the database; the others wait
+                # for it and then load what it stored
+                if lock is None:
+                    lock = store.lock(path)
+                    if not lock.acquire():
+                        logger.debug('Gave up waiting for another process to parse %s.' % path)
+                    db = store.load_digest(path, digest)
+            if db is not None:
                 logger.debug("Processing database %r from cache." % path)
-                with open(cache_path, 'rb') as cache_stream:
-                    db = pickle.load(cache_stream)
-                db.merge(self)
-                return path
-        except EOFError as e:
-            logger.error("Could not read cache '%r', falling back to database: %s." % (cache_path, e))
-        except pickle.UnpicklingError as e:
-            logger.error("Could not read cache '%r', falling back to database: %s." % (cache_path, e))
-        except IOError as e:
-            logger.error("Could not read cache '%r', falling back to database: %s." % (cache_path, e))
-        except OSError as e:
-            logger.error("Could not read cache '%r', falling back to database: %s." % (cache_path, e))
-        logger.debug('Processing database %s.' % path)
+            else:
+                db = parse_database(path, self._tokenizer, self._columnar)
+                try:
+                    encoded = crosstex.cache.encode(db)
+                except pickle.PicklingError as e:
+                    logger.error("Could not write cache '%r': %s." % (store.path, e))
+                else:
+                    store.store(path, digest, stat, encoded)
+        finally:
+            if lock is not None:
+                lock.release()
+        self._record(path, digest, stat)
+        db.merge(self)
+        return path
+
+    def _record(self, path, digest, stat):
+        self.sources.append((path, stat))
+        if self._manifest is not None:
+            self._manifest.files.append((path, digest))
+            self._manifest.stats[path] = stat
+
+    def _parse_mapped(self, path):
+        '''Parse a database through a memory map instead of reading it.
+
+        Only the keys of each entry are extracted here; their fields stay in
+        the mapped file until the entry is looked up (see LazyFields).  The
+        cache is bypassed in this mode, because both reading and writing it
+        would materialize every entry.
+        '''
+        logger.debug('Processing database %s through a memory map.' % path)
         db = XTXFileInfo()
-        stream = open(path)
-        
-        contents  = stream.read()
-        
-        if contents:
-            lexer = ply.lex.lex(reflags=re.UNICODE)
+        contents = None
+        with open(path, 'rb') as stream:
+            st = os.fstat(stream.fileno())
+            self._record(path, None, crosstex.cache.stat_signature(st))
+            if st.st_size > 0:
+                contents = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+        if contents is not None:
+            lexer = crosstex.scan.LazyScanner()
             lexer.path = path
             lexer.file = os.path.basename(path)
             lexer.lineno = 1
             lexer.expectstring = False
+            lexer.source = contents
 
             lexer.db = db
             lexer.defaults = ()
 
-            parser = ply.yacc.yacc(debug=0, write_tables=0)
-            parser.parse(contents, lexer=lexer)
-        stream.close()
+            run(lexer, grammar(), contents)
         db.merge(self)
-        try:
-            with open(cache_path, 'wb') as cache_stream:
-                pickle.dump(db, cache_stream, protocol=2)
-        except pickle.PicklingError as e:
-            logger.error("Could not write cache '%r', falling back to database: %s." % (cache_path, e))
-        except IOError as e:
-            logger.error("Could not write cache '%r', falling back to database: %s." % (cache_path, e))
-        except OSError as e:
-            logger.error("Could not write cache '%r', falling back to database: %s." % (cache_path, e))
         return path
 
-    def _check_ext(self, name, ext, exts=['.aux', CROSSTEX_FILE_ENDING, BIBTEX_FILE_ENDING]):
+    def _check_ext(self, name, ext, exts=['.aux', CROSSTEX_FILE_ENDING, BIBTEX_FILE_ENDING], quiet=False):
         func = '_parse_ext_' + ext[1:]
         if not hasattr(self, func) or not ext in exts: 
+            if quiet:
+                return False
+            self._incomplete()
             logger.error('Can not parse %r because the extension is not %s.'
                                 % (name, '/'.join([e[1:] for e in exts])))
             return False
@@ -386,7 +1071,7 @@ def t_newline(t):
 def t_error(t):
     logger.error('%s:%d: Syntax error near "%s".' %
                  (t.lexer.file, t.lexer.lineno, t.value[:20]))
-    t.skip(1)
+    t.lexer.skip(1)
 
 #
 # Grammar; start symbol is stmts.
@@ -443,17 +1128,23 @@ def p_stmt_string(t):
     
     for key, value in t[3]:
         ent = create_entry('string', [key], [Field('name', value)], file, line, defaults)
-        t.lexer.db.entries[key].append(ent)
+        t.lexer.db.add_entry(ent)
 
 def p_stmt_entry(t):
     'stmt : entry'
-    for key in t[1].keys:
-        t.lexer.db.entries[key].append(t[1])
+    t.lexer.db.add_entry(t[1])
+
+def entry_fields(t, fields, close):
+    'Return the fields of an entry, deferring them if the lexer skipped them.'
+    if isinstance(t[close], crosstex.scan.Span):
+        return LazyFields(t.lexer.source, t[close], t.lexer.file)
+    return fields
 
 def p_entry(t):
     'entry : AT NAME OPENBRACE keys COMMA conditionals CLOSEBRACE'
     file, line, defaults = t.lexer.file, t.lineno(2), t.lexer.defaults
-    t[0] = create_entry(t[2].lower(), t[4], t[6], file, line, defaults)
+    fields = entry_fields(t, t[6], 7)
+    t[0] = create_entry(t[2].lower(), t[4], fields, file, line, defaults)
 
 def p_entry_extend(t):
     '''
@@ -461,7 +1152,7 @@ def p_entry_extend(t):
           | ATEXTEND OPENBRACE keys CLOSEBRACE
     '''
     if len(t) == 7:
-        fields = t[5]
+        fields = entry_fields(t, t[5], 6)
     else:
         fields = []
     file, line, defaults = t.lexer.file, t.lineno(1), t.lexer.defaults
@@ -531,3 +1222,18 @@ def p_error(t):
     ply.yacc.errok()
     logger.error('%s:%d: Parse error near "%s".' %
                  (t.lexer.file, t.lexer.lineno, t.value[:20]))
+
+def _grammar_version():
+    '''A digest of the tokens and grammar rules.
+
+    Cached databases are only used by a CrossTeX with the same grammar.
+    '''
+    h = hashlib.sha1()
+    h.update(repr((tokens, Entry._fields, Value._fields, Field._fields,
+                   Conditional._fields)).encode('utf-8'))
+    for name, func in sorted(globals().items()):
+        if name.startswith(('p_', 't_')) and callable(func):
+            h.update((name + '\n' + (func.__doc__ or '') + '\n').encode('utf-8'))
+    return h.hexdigest()
+
+GRAMMAR_VERSION = _grammar_version()
@@ -0,0 +1,60 @@
+
+# parsetab.py
+# This file is automatically generated. Do not edit.
+# pylint: disable=W,C,R
+_tabversion = '3.10'
+
+_lr_method = 'LALR'
+
+_lr_signature = 'AT ATALIAS ATCITE ATCOMMENT ATDEFAULT ATEXTEND ATINCLUDE ATPREAMBLE ATSTRING ATTITLEPHRASE ATTITLESMALL CLOSEBRACE COMMA EQUALS LBRACK NAME NUMBER OPENBRACE RBRACK STRING\n    stmts :\n          | stmt stmts\n    stmt  : ATCOMMENT STRING\n    stmt : ATPREAMBLE OPENBRACE STRING CLOSEBRACEstmt : ATTITLEPHRASE STRINGstmt : ATTITLESMALL STRINGstmt : ATINCLUDE NAMEstmt : ATDEFAULT fieldstmt : ATCITE STRINGstmt : ATALIAS STRING STRINGstmt : ATSTRING OPENBRACE fields CLOSEBRACEstmt : entryentry : AT NAME OPENBRACE keys COMMA conditionals CLOSEBRACE\n    entry : ATEXTEND OPENBRACE keys COMMA conditionals CLOSEBRACE\n          | ATEXTEND OPENBRACE keys CLOSEBRACE\n    keys : NAMEkeys : NAME EQUALS keysconditionals :conditionals : conditionalconditionals : conditional conditionalsconditionals : fields conditionalsconditional : LBRACK fields RBRACK fieldsfields :fields : fieldfields : field COMMA fieldsfield : NAME EQUALS valuevalue : simplevaluesimplevalue : NAMEsimplevalue : NUMBERsimplevalue : STRING'
+    
+_lr_action_items = {'$end':([0,1,2,12,15,16,18,19,20,21,23,30,36,37,38,39,40,41,42,46,56,60,],[-1,0,-1,-12,-2,-3,-5,-6,-7,-8,-9,-10,-4,-28,-26,-27,-29,-30,-11,-15,-14,-13,]),'ATCOMMENT':([0,2,12,16,18,19,20,21,23,30,36,37,38,39,40,41,42,46,56,60,],[3,3,-12,-3,-5,-6,-7,-8,-9,-10,-4,-28,-26,-27,-29,-30,-11,-15,-14,-13,]),'ATPREAMBLE':([0,2,12,16,18,19,20,21,23,30,36,37,38,39,40,41,42,46,56,60,],[4,4,-12,-3,-5,-6,-7,-8,-9,-10,-4,-28,-26,-27,-29,-30,-11,-15,-14,-13,]),'ATTITLEPHRASE':([0,2,12,16,18,19,20,21,23,30,36,37,38,39,40,41,42,46,56,60,],[5,5,-12,-3,-5,-6,-7,-8,-9,-10,-4,-28,-26,-27,-29,-30,-11,-15,-14,-13,]),'ATTITLESMALL':([0,2,12,16,18,19,20,21,23,30,36,37,38,39,40,41,42,46,56,60,],[6,6,-12,-3,-5,-6,-7,-8,-9,-10,-4,-28,-26,-27,-29,-30,-11,-15,-14,-13,]),'ATINCLUDE':([0,2,12,16,18,19,20,21,23,30,36,37,38,39,40,41,42,46,56,60,],[7,7,-12,-3,-5,-6,-7,-8,-9,-10,-4,-28,-26,-27,-29,-30,-11,-15,-14,-13,]),'ATDEFAULT':([0,2,12,16,18,19,20,21,23,30,36,37,38,39,40,41,42,46,56,60,],[8,8,-12,-3,-5,-6,-7,-8,-9,-10,-4,-28,-26,-27,-29,-30,-11,-15,-14,-13,]),'ATCITE':([0,2,12,16,18,19,20,21,23,30,36,37,38,39,40,41,42,46,56,60,],[9,9,-12,-3,-5,-6,-7,-8,-9,-10,-4,-28,-26,-27,-29,-30,-11,-15,-14,-13,]),'ATALIAS':([0,2,12,16,18,19,20,21,23,30,36,37,38,39,40,41,42,46,56,60,],[10,10,-12,-3,-5,-6,-7,-8,-9,-10,-4,-28,-26,-27,-29,-30,-11,-15,-14,-13,]),'ATSTRING':([0,2,12,16,18,19,20,21,23,30,36,37,38,39,40,41,42,46,56,60,],[11,11,-12,-3,-5,-6,-7,-8,-9,-10,-4,-28,-26,-27,-29,-30,-11,-15,-14,-13,]),'AT':([0,2,12,16,18,19,20,21,23,30,36,37,38,39,40,41,42,46,56,60,],[13,13,-12,-3,-5,-6,-7,-8,-9,-10,-4,-28,-26,-27,-29,-30,-11,-15,-14,-13,]),'ATEXTEND':([0,2,12,16,18,19,20,21,23,30,36,37,38,39,40,41,42,46,56,60,],[14,14,-12,-3,-5,-6,-7,-8,-9,-10,-4,-28,-26,-27,-29,-30,-11,-15,-14,-13,]),'STRING':([3,5,6,9,10,17,24,29,],[16,18,19,23,24,28,30,41,]),'OPENBRACE':([4,11,14,26,],[17,25,27,33,]),'NAME':([7,8,13,25,27,29,32,33,37,38,39,40,41,43,45,47,48,49,51,52,53,61,62,],[20,22,26,22,35,37,-24,35,-28,-26,-27,-29,-30,22,22,35,-25,22,22,22,22,22,-22,]),'EQUALS':([22,35,],[29,47,]),'CLOSEBRACE':([25,28,31,32,34,35,37,38,39,40,41,43,45,48,49,50,51,52,54,55,57,58,61,62,],[-23,36,42,-24,46,-16,-28,-26,-27,-29,-30,-23,-18,-25,-18,56,-18,-18,-17,60,-20,-21,-23,-22,]),'NUMBER':([29,],[40,]),'LBRACK':([32,37,38,39,40,41,43,45,48,49,51,52,61,62,],[-24,-28,-26,-27,-29,-30,-23,53,-25,53,53,53,-23,-22,]),'RBRACK':([32,37,38,39,40,41,43,48,53,59,],[-24,-28,-26,-27,-29,-30,-23,-25,-23,61,]),'COMMA':([32,34,35,37,38,39,40,41,44,54,],[43,45,-16,-28,-26,-27,-29,-30,49,-17,]),}
+
+_lr_action = {}
+for _k, _v in _lr_action_items.items():
+   for _x,_y in zip(_v[0],_v[1]):
+      if not _x in _lr_action:  _lr_action[_x] = {}
+      _lr_action[_x][_k] = _y
+del _lr_action_items
+
+_lr_goto_items = {'stmts':([0,2,],[1,15,]),'stmt':([0,2,],[2,2,]),'entry':([0,2,],[12,12,]),'field':([8,25,43,45,49,51,52,53,61,],[21,32,32,32,32,32,32,32,32,]),'fields':([25,43,45,49,51,52,53,61,],[31,48,52,52,52,52,59,62,]),'keys':([27,33,47,],[34,44,54,]),'value':([29,],[38,]),'simplevalue':([29,],[39,]),'conditionals':([45,49,51,52,],[50,55,57,58,]),'conditional':([45,49,51,52,],[51,51,51,51,]),}
+
+_lr_goto = {}
+for _k, _v in _lr_goto_items.items():
+   for _x, _y in zip(_v[0], _v[1]):
+       if not _x in _lr_goto: _lr_goto[_x] = {}
+       _lr_goto[_x][_k] = _y
+del _lr_goto_items
+_lr_productions = [
+  ("S' -> stmts","S'",1,None,None,None),
+  ('stmts -> <empty>','stmts',0,'p_ignore','parse.py',430),
+  ('stmts -> stmt stmts','stmts',2,'p_ignore','parse.py',431),
+  ('stmt -> ATCOMMENT STRING','stmt',2,'p_ignore','parse.py',432),
+  ('stmt -> ATPREAMBLE OPENBRACE STRING CLOSEBRACE','stmt',4,'p_stmt_preamble','parse.py',436),
+  ('stmt -> ATTITLEPHRASE STRING','stmt',2,'p_stmt_titlephrase','parse.py',440),
+  ('stmt -> ATTITLESMALL STRING','stmt',2,'p_stmt_titlesmall','parse.py',444),
+  ('stmt -> ATINCLUDE NAME','stmt',2,'p_stmt_include','parse.py',448),
+  ('stmt -> ATDEFAULT field','stmt',2,'p_stmt_default','parse.py',452),
+  ('stmt -> ATCITE STRING','stmt',2,'p_stmt_cite','parse.py',464),
+  ('stmt -> ATALIAS STRING STRING','stmt',3,'p_stmt_alias','parse.py',468),
+  ('stmt -> ATSTRING OPENBRACE fields CLOSEBRACE','stmt',4,'p_stmt_string','parse.py',472),
+  ('stmt -> entry','stmt',1,'p_stmt_entry','parse.py',480),
+  ('entry -> AT NAME OPENBRACE keys COMMA conditionals CLOSEBRACE','entry',7,'p_entry','parse.py',485),
+  ('entry -> ATEXTEND OPENBRACE keys COMMA conditionals CLOSEBRACE','entry',6,'p_entry_extend','parse.py',491),
+  ('entry -> ATEXTEND OPENBRACE keys CLOSEBRACE','entry',4,'p_entry_extend','parse.py',492),
+  ('keys -> NAME','keys',1,'p_keys_singleton','parse.py',502),
+  ('keys -> NAME EQUALS keys','keys',3,'p_keys_multiple','parse.py',506),
+  ('conditionals -> <empty>','conditionals',0,'p_conditionals_empty','parse.py',510),
+  ('conditionals -> conditional','conditionals',1,'p_conditionals_singleton','parse.py',514),
+  ('conditionals -> conditional conditionals','conditionals',2,'p_conditionals_multiple','parse.py',518),
+  ('conditionals -> fields conditionals','conditionals',2,'p_conditionals_unconditional','parse.py',522),
+  ('conditional -> LBRACK fields RBRACK fields','conditional',4,'p_conditional','parse.py',526),
+  ('fields -> <empty>','fields',0,'p_fields_empty','parse.py',530),
+  ('fields -> field','fields',1,'p_fields_singleton','parse.py',534),
+  ('fields -> field COMMA fields','fields',3,'p_fields','parse.py',538),
+  ('field -> NAME EQUALS value','field',3,'p_field','parse.py',542),
+  ('value -> simplevalue','value',1,'p_value_singleton','parse.py',546),
+  ('simplevalue -> NAME','simplevalue',1,'p_simplevalue_name','parse.py',550),
+  ('simplevalue -> NUMBER','simplevalue',1,'p_simplevalue_number','parse.py',554),
+  ('simplevalue -> STRING','simplevalue',1,'p_simplevalue_string','parse.py',558),
+]
@@ -0,0 +1,102 @@
+'''
+Find databases and other inputs without probing for every possible name.
+
+Resolving a name means trying each directory of the search path with each
+acceptable extension.  Rather than asking the file system about every one of
+these paths, which is a round trip each on a network file system, a PathIndex
+lists each directory once and answers from the listing.  Directories that do
+not exist are remembered as empty.  Listings are trusted for the rest of the
+run; with a CacheStore they are also kept in the cache, and reused for as long
+as the directory has the same signature.
+
+A name the listing only has with another case or Unicode normalization may
+still name the file, on the case-insensitive file systems of macOS and
+Windows, so it is looked up as usual.
+'''
+
+import logging
+import os
+import time
+import unicodedata
+
+import crosstex.cache
+from crosstex.constants import *
+
+logger = logging.getLogger('crosstex.parse')
+
+# Only files with these extensions are indexed; other paths are looked up as
+# usual
+SUFFIXES = ('.aux', CROSSTEX_FILE_ENDING, BIBTEX_FILE_ENDING, BIB_CACHE_FILE_ENDING)
+
+# A directory modified less than this many seconds before it was listed may
+# change again without its signature changing, so its listing is not stored
+RACY_SECONDS = 2
+
+def fold(name):
+    'The form of name under which file systems that ignore case find it.'
+    return unicodedata.normalize('NFC', name).casefold()
+
+class PathIndex(object):
+    'The files in each directory searched so far.'
+
+    def __init__(self, store=None, suffixes=SUFFIXES):
+        self.store = store
+        self.suffixes = suffixes
+        self._listings = {}
+        # The folded names of each listing, once a name was missing from it
+        self._folded = {}
+
+    def exists(self, path):
+        'Like os.path.exists, but answered from the listing of the directory.'
+        directory, name = os.path.split(path)
+        if not name.lower().endswith(self.suffixes):
+            return os.path.exists(path)
+        directory = directory or os.curdir
+        if name in self.listing(directory):
+            return True
+        if directory not in self._folded:
+            self._folded[directory] = frozenset([fold(n) for n in self.listing(directory)])
+        return fold(name) in self._folded[directory] and os.path.exists(path)
+
+    def listing(self, directory):
+        'Return the names of the indexed files in directory.'
+        if directory not in self._listings:
+            self._listings[directory] = self._list(directory)
+        return self._listings[directory]
+
+    def directories(self):
+        'The directories listed so far.'
+        return list(self._listings)
+
+    def clear(self):
+        'Forget every listing, so that directories are looked at again.'
+        self._listings = {}
+        self._folded = {}
+
+    def _list(self, directory):
+        try:
+            st = os.stat(directory)
+        except OSError:
+            return frozenset()
+        stat = crosstex.cache.stat_signature(st)
+        if self.store is not None:
+            names = self.store.load_listing(directory, stat)
+            if names is not None:
+                return names
+        names = set([])
+        try:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    if not entry.name.lower().endswith(self.suffixes):
+                        continue
+                    # os.path.exists is False for a dangling link
+                    if entry.is_symlink() and not os.path.exists(entry.path):
+                        continue
+                    names.add(entry.name)
+        except OSError as e:
+            logger.debug('Could not list %r: %s.' % (directory, e))
+            return frozenset()
+        names = frozenset(names)
+        if self.store is not None and time.time() - st.st_mtime >= RACY_SECONDS:
+            self.store.store_listing(directory, stat, names)
+        return names
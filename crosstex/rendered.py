@@ -0,0 +1,104 @@
+'''
+Reuse what was rendered for citations that have not changed.
+
+Rendering a bibliography formats every cited object from scratch, although
+from one run to the next usually only a citation or two was added to the
+document.  RenderedItems remembers what a style computed for each citation:
+the text of its item, its sort key and its label before any suffix telling
+apart labels that collide.  Each is kept under the citation, a fingerprint
+of the resolved object and what it is, and reused for as long as all three
+match; the style and everything else it depends upon is part of the context
+RenderedItems are stored under (see CrossTeX).  Whatever was logged while
+computing something is logged again when it is reused.
+
+The order of the items and their final labels are still worked out on every
+run, from the sort keys and labels kept, so that labels only change when
+citations with colliding labels come or go.
+'''
+
+import hashlib
+import logging
+
+import crosstex.objects
+import crosstex.parse
+
+logger = logging.getLogger('crosstex')
+
+def _canonical(value):
+    if isinstance(value, crosstex.parse.Value):
+        return (value.kind, value.value)
+    if isinstance(value, crosstex.objects.Object):
+        # The fields that are set, in the order of their names
+        fields = [(name, getattr(value, name)) for name in value._slots]
+        return (value.kind,) + tuple([(name, _canonical(v)) for name, v in
+                                      fields if v is not None])
+    if isinstance(value, (list, tuple)):
+        return tuple([_canonical(v) for v in value])
+    return value
+
+def fingerprint(obj):
+    '''A digest of everything about a resolved object that a style can render.
+
+    Where its values came from is left out, as styles never render it.
+    '''
+    return hashlib.sha1(repr(_canonical(obj)).encode('utf-8')).hexdigest()
+
+class _Capture(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append((record.name, record.levelno, record.getMessage()))
+
+class RenderedItems(object):
+    '''What a style computed for each citation, in this run and the previous one.
+
+    previous maps (what, citation, fingerprint) to (value, log) for what was
+    computed in the previous run, and items the same for this run so far;
+    log lists (logger, level, message) for each message logged meanwhile.
+    '''
+
+    def __init__(self, previous=None):
+        self.previous = previous or {}
+        self.items = {}
+        self.reused = 0
+        self.computed = 0
+        self._fingerprints = {}
+
+    def get(self, what, cite, obj, func, *args):
+        'Return func(*args), unless it was computed for the same citation of an identical obj.'
+        key = (what, cite, self.fingerprint(obj))
+        if key in self.items:
+            value, log = self.items[key]
+        elif key in self.previous:
+            value, log = self.items[key] = self.previous[key]
+            self.reused += 1
+        else:
+            capture = _Capture()
+            logger.addHandler(capture)
+            try:
+                value = func(*args)
+            finally:
+                logger.removeHandler(capture)
+            self.items[key] = (value, capture.records)
+            self.computed += 1
+            return value
+        for name, level, message in log:
+            logging.getLogger(name).log(level, message)
+        return value
+
+    def fingerprint(self, obj):
+        # The object is held on to, so that its id is not reused
+        if id(obj) not in self._fingerprints:
+            self._fingerprints[id(obj)] = (obj, fingerprint(obj))
+        return self._fingerprints[id(obj)][1]
+
+    def advance(self):
+        'Start the next run, reusing what was computed in this one.'
+        self.previous = self.items
+        self.items = {}
+        self.reused = 0
+        self.computed = 0
+        self._fingerprints = {}
@@ -0,0 +1,148 @@
+'''
+Narrow down the entries a constrained citation may match.
+
+A constrained citation such as \cite{!liskov:2003} names the first entry whose
+resolved fields contain each of the strings it gives.  Rather than resolving
+every entry to find out, an Index looks up the words in which each string
+occurs and only the keys whose entries hold these words, directly or through
+the objects they refer to, are resolved and matched.  The candidates are a
+superset of the keys that match: a string that occurs in a field occurs in a
+word of the raw text of an entry the resolved object was built from, and so
+does each run of letters and digits in it.
+
+Databases are only indexed once a constrained citation is looked up in them.
+The index of a database parsed in this process is kept in memory; that of a
+database in the cache is stored along with it and queried there (see
+CacheStore.search), so that it is built only once.
+'''
+
+import collections
+import itertools
+import re
+
+import crosstex.cache
+import crosstex.parse
+
+WORDS = re.compile(r'\w+')
+
+# Fields that no other field takes its value from, and whose text is too long
+# to be worth indexing; constraints on them do not narrow anything down
+UNINDEXED = ('abstract',)
+
+# How names are separated in author and editor fields, as in Database._build
+_author = re.compile('\s+and\s+')
+
+def words(text):
+    'The words of text, lowercased as constraints are.'
+    return WORDS.findall(str(text).lower())
+
+def index(items):
+    '''Index the entries of one database.
+
+    items yields (key, list of Entry) as dict.items() does.  Returns
+    (postings, referrers), where postings maps each word to the keys whose
+    entries contain it, and referrers each key to the other keys whose entries
+    may refer to it.
+    '''
+    postings = collections.defaultdict(set)
+    referrers = collections.defaultdict(set)
+    conditional = crosstex.parse.Conditional
+    for key, entries in items:
+        texts = []
+        refs = set([])
+        for entry in entries:
+            refs.update(entry.keys)
+            for f in itertools.chain(entry.defaults, entry.fields):
+                # The fields a conditional sets, as well as the others
+                for name, value in f.then_fields if f.__class__ is conditional else (f,):
+                    if value.kind == 'key':
+                        refs.add(value.value)
+                    elif name in ('author', 'editor'):
+                        refs.update(_author.split(str(value.value)))
+                    if name not in UNINDEXED:
+                        texts.append(str(value.value))
+        for word in set(words(' '.join(texts))):
+            postings[word].add(key)
+        refs.discard(key)
+        for ref in refs:
+            referrers[ref].add(key)
+    return postings, referrers
+
+class Index(object):
+    'The index of the layers of an Entries.'
+
+    def __init__(self, layers):
+        self._layers = layers
+        self._postings = None
+        self._referrers = None
+        self._vocabulary = None
+
+    def _built(self):
+        if self._postings is None:
+            self._postings = collections.defaultdict(set)
+            self._referrers = collections.defaultdict(set)
+            for layer in self._layers:
+                if isinstance(layer, crosstex.cache.StoredEntries):
+                    continue
+                postings, referrers = index(layer.items())
+                for word, keys in postings.items():
+                    self._postings[word] |= keys
+                for key, keys in referrers.items():
+                    self._referrers[key] |= keys
+            # One word per line, to find those containing a string at once
+            self._vocabulary = '\n'.join(self._postings)
+
+    def _stored(self):
+        'The file ids of the StoredEntries layers, by store.'
+        stored = collections.defaultdict(list)
+        for layer in self._layers:
+            if isinstance(layer, crosstex.cache.StoredEntries):
+                stored[layer.store].append(layer.file_id)
+        return stored
+
+    def containing(self, piece):
+        'The keys whose entries have a word containing piece.'
+        self._built()
+        keys = set([])
+        for word in re.findall('[^\n]*%s[^\n]*' % re.escape(piece), self._vocabulary):
+            keys |= self._postings[word]
+        for store, file_ids in self._stored().items():
+            keys |= store.search(file_ids, piece)
+        return keys
+
+    def closure(self, keys, alias):
+        'keys and the keys whose objects may take values from theirs.'
+        self._built()
+        aliases = collections.defaultdict(set)
+        for key, target in alias.items():
+            aliases[target].add(key)
+        stored = self._stored()
+        found = set(keys)
+        frontier = found
+        while frontier:
+            more = set([])
+            for key in frontier:
+                more |= self._referrers.get(key, set([]))
+                more |= aliases.get(key, set([]))
+            for store, file_ids in stored.items():
+                more |= store.referrers(file_ids, frontier)
+            frontier = more - found
+            found |= frontier
+        return found
+
+    def candidates(self, values, alias):
+        '''The keys whose objects may contain every one of values.
+
+        values are lowercased strings and alias maps keys to the keys they
+        stand for, as in Parser.  Returns None if any key may.
+        '''
+        # An alias for a constrained citation may stand for any object
+        wild = set([key for key, target in alias.items() if target.startswith('!')])
+        found = None
+        for value in values:
+            for piece in set(words(value)):
+                keys = self.closure(self.containing(piece) | wild, alias)
+                found = keys if found is None else found & keys
+                if not found:
+                    return found
+        return found
@@ -0,0 +1,177 @@
+'''
+Keep CrossTeX running between runs of LaTeX.
+
+"crosstex serve" listens on a Unix socket for the command lines crosstex
+forwards to it (see crosstex.client) and runs each of them as crosstex would,
+in the directory it was run in.  Every command still parses its files, but
+with the modules, grammar and cache already loaded this costs little, and
+changed databases are noticed exactly as they would be otherwise.  The
+objects resolved from the databases are kept between commands that parse the
+same databases, with the same signatures, so that a document is only resolved
+again once something it uses changed.  What a command rendered is kept too,
+and reused when the same command finds the same databases and citations.
+
+Commands are run one at a time.  Nothing is ever sent over a network: the
+socket is only accessible to the user running the server.
+'''
+
+import collections
+import contextlib
+import io
+import json
+import logging
+import os
+import signal
+import socket
+import socketserver
+import sys
+import traceback
+
+import crosstex
+import crosstex.client
+import crosstex.cmd
+
+logger = logging.getLogger('crosstex')
+
+# How many sets of databases to keep resolved objects for
+RESOLVED_SETS = 8
+
+# How many rendered bibliographies to keep
+ANSWERS = 32
+
+class LRU(collections.OrderedDict):
+    'A dictionary that only keeps the size most recently used items.'
+
+    def __init__(self, size):
+        collections.OrderedDict.__init__(self)
+        self.size = size
+
+    def __getitem__(self, key):
+        value = collections.OrderedDict.__getitem__(self, key)
+        self.move_to_end(key)
+        return value
+
+    def __setitem__(self, key, value):
+        collections.OrderedDict.__setitem__(self, key, value)
+        while len(self) > self.size:
+            self.popitem(last=False)
+
+class Server(socketserver.UnixStreamServer):
+
+    def __init__(self, path):
+        socketserver.UnixStreamServer.__init__(self, path, Handler, bind_and_activate=False)
+        self.resolved = LRU(RESOLVED_SETS)
+        self.answers = LRU(ANSWERS)
+        # Only the user running the server may connect
+        umask = os.umask(0o077)
+        try:
+            self.server_bind()
+        finally:
+            os.umask(umask)
+        self.server_activate()
+
+    def run(self, argv, cwd):
+        '''Run one command line as crosstex.cmd.main would, in cwd.
+
+        Returns the answer for crosstex.client: the exit status, what was
+        written to standard output and standard error, and the files to write.
+        '''
+        stdout = io.StringIO()
+        stderr = io.StringIO()
+        handler = logging.StreamHandler(stderr)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        root = logging.getLogger()
+        handlers, root.handlers = root.handlers, [handler]
+        levels = [(l, l.level) for l in (logger, logging.getLogger('crosstex.parse'))]
+        directory = os.getcwd()
+        status, files = 1, []
+        try:
+            os.chdir(cwd)
+            with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+                try:
+                    status, outputs = self._run(argv, cwd, stderr)
+                except SystemExit as e:
+                    # from argparse, after printing usage or help
+                    status = e.code if isinstance(e.code, int) else 1
+                    outputs = []
+                except Exception:
+                    traceback.print_exc()
+                    outputs = []
+            for path, text in outputs:
+                if path is None:
+                    stdout.write(text)
+                else:
+                    files.append((path, text))
+        finally:
+            os.chdir(directory)
+            root.handlers = handlers
+            for l, level in levels:
+                l.setLevel(level)
+        return {'status': status,
+                'stdout': stdout.getvalue(),
+                'stderr': stderr.getvalue(),
+                'files': files}
+
+    def _run(self, argv, cwd, stderr):
+        try:
+            args, xtx = crosstex.cmd.prepare(argv, self.resolved)
+        except crosstex.CrossTeXError as e:
+            logger.error(str(e))
+            return 1, []
+        # Everything finish uses comes from the command line, the databases
+        # and the citations
+        key = (tuple(argv), cwd, xtx.sources(), frozenset(xtx.aux_citations()))
+        if not args.verbose and key in self.answers:
+            status, outputs, logged = self.answers[key]
+            stderr.write(logged)
+            return status, outputs
+        start = len(stderr.getvalue())
+        status, outputs = crosstex.cmd.finish(args, xtx)
+        self.answers[key] = (status, outputs, stderr.getvalue()[start:])
+        return status, outputs
+
+class Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.read().decode('utf-8'))
+            argv, cwd = list(request['argv']), request['cwd']
+        except (ValueError, KeyError, TypeError) as e:
+            logger.error('Ignoring a malformed request: %s.' % e)
+            return
+        answer = self.server.run(argv, cwd)
+        self.wfile.write(json.dumps(answer).encode('utf-8'))
+
+def serve(path):
+    '''Answer commands on the Unix socket at path until terminated.
+
+    Returns 1 if another server is listening there already.
+    '''
+    if os.path.exists(path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except OSError:
+            # left behind by a server that is gone
+            os.unlink(path)
+        else:
+            logger.error('Another server is listening on %s.' % path)
+            return 1
+        finally:
+            probe.close()
+    directory = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(directory):
+        os.makedirs(directory, 0o700)
+    server = Server(path)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    sys.stdout.write('Serving on %s.\n' % path)
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if os.path.exists(path):
+            os.unlink(path)
+    return 0
@@ -180,7 +180,7 @@ class Style(crosstex.style.Style):
             cb = self._callback(obj.kind)
             if cb is None:
                 raise crosstex.style.UnsupportedCitation(obj.kind)
-            item = cb(obj)
+            item = self.reuse('item', cite, obj, cb, obj)
             label = label_dict[cite]
             if not in_list:
                 bib += self._fmt.list_begin()
@@ -234,9 +234,9 @@ class Style(crosstex.style.Style):
         elif 'titlecase-upper' in self._flags:
             return crosstex.style.title_uppercase(title)
         elif 'titlecase-title' in self._flags:
-            return crosstex.style.title_titlecase(title, self._db.titlephrases())
+            return crosstex.style.title_titlecase(title, self._db.titlephrases_matcher())
         elif 'titlecase-lower' in self._flags:
-            return crosstex.style.title_lowercase(title, self._db.titlesmalls())
+            return crosstex.style.title_lowercase(title, self._db.titlesmalls_matcher())
         return title
 
     def render_booktitle(self, booktitle, context=None, history=None):
@@ -1,4 +1,5 @@
 import collections
+import functools
 import itertools
 import re
 import logging
@@ -25,6 +26,9 @@ class UnsupportedCitation(Exception):
 
 class Style(object):
 
+    # The crosstex.rendered.RenderedItems to reuse what was computed before
+    rendered = None
+
     @classmethod
     def formats(cls):
         return set([])
@@ -44,6 +48,15 @@ class Style(object):
         '''Render the list of (key, obj) citations'''
         raise NotImplementedError()
 
+    def reuse(self, what, cite, obj, func, *args):
+        '''Return func(*args), what this style computes as what for the citation of obj.
+
+        If it was computed for an identical object before, that is reused.
+        '''
+        if self.rendered is None:
+            return func(*args)
+        return self.rendered.get(what, cite, obj, func, *args)
+
 ################################### Utilities ##################################
 
 _endre = re.compile(r"(\\end\{[^}]*\}|['\s}])*$")
@@ -63,15 +76,24 @@ def punctuate(string, punctuation='', tail=' '):
 
 ################################# Format Names #################################
 
-def break_name(name, short=False, plain=False):
-    '''Break a name into 'first', 'von', 'last', 'jr' parts'''
+# The parts of a name as break_name returns them, as tuples: first, von, last
+# and jr, short the first names abbreviated as for break_name(name, short=True),
+# and sort the key name_sort_last_first returns
+Name = collections.namedtuple('Name', ('first', 'von', 'last', 'jr', 'short', 'sort'))
+
+# How many distinct names parse_name keeps parsed
+NAMES_CACHED = 4096
+
+def _split_name(name, plain):
+    '''Split a name into words, leaving braced groups whole.
+
+    Returns the words and how many commas the name has outside braces.
+    '''
     value = ''
     lastchar = ' '
     names = []
     nesting = 0
-
-    if not isinstance(name, str):
-        raise CrossTeXError("Name is not a string: " + str(name))
+    commas = 0
 
     for i in range(0, len(name)):
         charc = name[i]
@@ -91,13 +113,20 @@ def break_name(name, short=False, plain=False):
                 value += charc
             nesting += 1
         elif charc == ',' and nesting == 0 and lastchar != '\\':
-            logger.warning("Name '" + name + "' contains a comma. Make sure it is formatted <first middle last>")
+            commas += 1
         else:
             if not plain or (charc != '\\' and lastchar != '\\'):
                 value += charc
         lastchar = charc
     names.append(value)
+    return names, commas
+
+def _warn_commas(name, commas):
+    for i in range(commas):
+        logger.warning("Name '" + name + "' contains a comma. Make sure it is formatted <first middle last>")
 
+def _name_parts(names):
+    '''Tell apart the 'first', 'von', 'last', 'jr' parts of the words of a name'''
     # extract lastname, check suffixes and last name modifiers
     # extract also a list of first names
     snames = ['Jr.', 'Sr.', 'Jr', 'Sr', 'III', 'IV']
@@ -116,36 +145,77 @@ def break_name(name, short=False, plain=False):
         lnameoffset = mnameoffset = snameoffset - 1
 
     # return the person info as a tuple
-    (fnames, mnames, lnames, snames) = (names[:mnameoffset], names[mnameoffset:lnameoffset], names[lnameoffset:snameoffset], names[snameoffset:])
-    if short:
-        fnamesabbr = []
-        for n in fnames:
-            abbr = ''
-            initial = 0
-            sep = ''
-            while initial < len(n):
-                if n[initial] == '\\':
-                    initial += 1
-                elif n[initial] in '{}':
-                    pass
-                elif n[initial] == '~':
-                    abbr += n[initial]
-                elif n[initial] in '-.':
-                    sep = n[initial]
-                elif sep != None:
-                    if sep != '.':
-                        abbr += sep
-                    abbr += n[initial] + '.'
-                    sep = None
+    return (names[:mnameoffset], names[mnameoffset:lnameoffset], names[lnameoffset:snameoffset], names[snameoffset:])
+
+def _abbreviate(fnames):
+    '''The first names abbreviated to their initials, as one name'''
+    fnamesabbr = []
+    for n in fnames:
+        abbr = ''
+        initial = 0
+        sep = ''
+        while initial < len(n):
+            if n[initial] == '\\':
                 initial += 1
-            if abbr:
-                fnamesabbr.append(abbr)
-        return (['~'.join(fnamesabbr)], mnames, lnames, snames)
+            elif n[initial] in '{}':
+                pass
+            elif n[initial] == '~':
+                abbr += n[initial]
+            elif n[initial] in '-.':
+                sep = n[initial]
+            elif sep != None:
+                if sep != '.':
+                    abbr += sep
+                abbr += n[initial] + '.'
+                sep = None
+            initial += 1
+        if abbr:
+            fnamesabbr.append(abbr)
+    return ['~'.join(fnamesabbr)]
+
+@functools.lru_cache(maxsize=NAMES_CACHED)
+def _parse_name(name):
+    names, commas = _split_name(name, False)
+    (fnames, mnames, lnames, snames) = _name_parts(names)
+    sort = tuple([tuple([n.lower().strip(' \t{}') for n in part])
+                  for part in ((mnames + lnames), fnames, snames)])
+    return Name(tuple(fnames), tuple(mnames), tuple(lnames), tuple(snames),
+                tuple(_abbreviate(fnames)), sort), commas
+
+def parse_name(name):
+    '''Return the Name of name.
+
+    Each distinct name is only broken into its parts once, however many
+    citations and styles render it; a name with a comma is warned about each
+    time, as break_name does.
+    '''
+    if not isinstance(name, str):
+        raise crosstex.CrossTeXError("Name is not a string: " + str(name))
+    parsed, commas = _parse_name(name)
+    _warn_commas(name, commas)
+    return parsed
+
+def break_name(name, short=False, plain=False):
+    '''Break a name into 'first', 'von', 'last', 'jr' parts'''
+    if not isinstance(name, str):
+        raise crosstex.CrossTeXError("Name is not a string: " + str(name))
+
+    if not plain:
+        parsed = parse_name(name)
+        return (list(parsed.short if short else parsed.first), list(parsed.von),
+                list(parsed.last), list(parsed.jr))
+
+    names, commas = _split_name(name, plain)
+    _warn_commas(name, commas)
+    (fnames, mnames, lnames, snames) = _name_parts(names)
+    if short:
+        return (_abbreviate(fnames), mnames, lnames, snames)
     else:
         return (fnames, mnames, lnames, snames)
 
 def name_last_initials(name, size):
-    (fnames, mnames, lnames, snames) = break_name(name)
+    parsed = parse_name(name)
+    (mnames, lnames) = (parsed.von, parsed.last)
     mnamestr = ''
     for mname in mnames:
         first = 0
@@ -176,15 +246,10 @@ def name_last_initials(name, size):
     return mnamestr + lnamestr
 
 def name_sort_last_first(name):
-    (fnames, mnames, lnames, snames) = break_name(name)
-    fnames = [n.lower().strip(' \t{}') for n in fnames]
-    mnames = [n.lower().strip(' \t{}') for n in mnames]
-    lnames = [n.lower().strip(' \t{}') for n in lnames]
-    snames = [n.lower().strip(' \t{}') for n in snames]
-    return tuple([tuple(x) for x in ((mnames + lnames), fnames, snames)])
+    return parse_name(name).sort
 
 def name_last_first(name):
-    (fnames, mnames, lnames, snames) = break_name(name)
+    (fnames, mnames, lnames, snames) = parse_name(name)[:4]
     namestr = ''
     for n in mnames:
         namestr = punctuate(namestr) + n
@@ -199,7 +264,7 @@ def name_last_first(name):
     return namestr
 
 def name_first_last(name):
-    (fnames, mnames, lnames, snames) = break_name(name)
+    (fnames, mnames, lnames, snames) = parse_name(name)[:4]
     namestr = ''
     for n in fnames:
         namestr = punctuate(namestr) + n
@@ -214,7 +279,8 @@ def name_first_last(name):
     return namestr
 
 def name_shortfirst_last(name):
-    (fnames, mnames, lnames, snames) = break_name(name, short=True)
+    parsed = parse_name(name)
+    (fnames, mnames, lnames, snames) = (parsed.short, parsed.von, parsed.last, parsed.jr)
     namestr = ''
     for n in fnames:
         namestr = punctuate(namestr) + n
@@ -233,7 +299,7 @@ def names_last(names):
     if names:
         names = list(names)
         for i in range(len(names)):
-            (fnames, mnames, lnames, snames) = break_name(names[i])
+            lnames = parse_name(names[i]).last
             names[i] = ''
             for n in lnames:
                 names[i] = punctuate(names[i]) + n
@@ -323,7 +389,48 @@ def title_uppercase(title):
             incommand = False
     return newtitle
 
+class Phrases(object):
+    '''Phrases that titles keep as they are, to find those at a position at once.
+
+    The phrases are kept in a trie of their lowercased characters, so that
+    matching at a position of a title only walks as far along the title as
+    some phrase follows it, rather than trying every phrase there.  Build it
+    once for all the titles to render (see Database.titlephrases_matcher).
+    '''
+
+    def __init__(self, phrases):
+        self._root = {}
+        # In order, so that of phrases differing only in case the same is found
+        for phrase in sorted(phrases):
+            node = self._root
+            for char in phrase.lower():
+                node = node.setdefault(char, {})
+            # Phrases ending at a node are kept under None
+            node.setdefault(None, []).append(phrase)
+
+    def longest(self, title, lowered, i):
+        '''The longest phrase that lowered, title lowercased, starts with at i.
+
+        Only phrases that end a word of title or end near its end are found.
+        Returns '' if there are none.
+        '''
+        match = ''
+        node = self._root
+        j = i
+        while node is not None:
+            for phrase in node.get(None, ()):
+                if len(phrase) > len(match) and (i + len(phrase) >= len(title) - 1 or not title[i + len(phrase)].isalnum()):
+                    match = phrase
+            if j >= len(lowered):
+                break
+            node = node.get(lowered[j])
+            j += 1
+        return match
+
 def title_titlecase(title, titlephrases):
+    if not isinstance(titlephrases, Phrases):
+        titlephrases = Phrases(titlephrases)
+    lowered = title.lower()
     newtitle = ''
     ignoreuntil = 0
     dollars = 0
@@ -358,10 +465,7 @@ def title_titlecase(title, titlephrases):
 
         if i >= ignoreuntil:
             if wordbreak and not (inliteral or inmath or incommand):
-                match = ''
-                for phrase in titlephrases:
-                    if title.lower().startswith(phrase.lower(), i) and len(phrase) > len(match) and (i + len(phrase) >= len(title) - 1 or not title[i + len(phrase)].isalnum()):
-                        match = phrase
+                match = titlephrases.longest(title, lowered, i)
                 if len(match) > 0:
                     ignoreuntil = i + len(match)
                     newtitle += match
@@ -378,6 +482,9 @@ def title_titlecase(title, titlephrases):
     return newtitle
 
 def title_lowercase(title, lowerphrases):
+    if not isinstance(lowerphrases, Phrases):
+        lowerphrases = Phrases(lowerphrases)
+    lowered = title.lower()
     newtitle = ''
     ignoreuntil = 0
     dollars = 0
@@ -412,10 +519,7 @@ def title_lowercase(title, lowerphrases):
 
         if i >= ignoreuntil:
             if wordbreak and not (sentencebreak or inliteral or inmath or incommand):
-                match = ''
-                for phrase in lowerphrases:
-                    if title.lower().startswith(phrase.lower(), i) and len(phrase) > len(match) and (i + len(phrase) >= len(title) - 1 or not title[i + len(phrase)].isalnum()):
-                        match = phrase.lower()
+                match = lowerphrases.longest(title, lowered, i).lower()
                 if len(match) > 0:
                     ignoreuntil = i + len(match)
                     newtitle += match
@@ -447,19 +551,19 @@ def label_initials(authors):
 def label_fullnames(authors):
     value = ''
     if len(authors) == 2:
-        (fnames1, mnames1, lnames1, snames1) = break_name(authors[0])
-        (fnames2, mnames2, lnames2, snames2) = break_name(authors[1])
+        (fnames1, mnames1, lnames1, snames1) = parse_name(authors[0])[:4]
+        (fnames2, mnames2, lnames2, snames2) = parse_name(authors[1])[:4]
         value = ' '.join(mnames1 + lnames1) + ' \& ' + ' '.join(mnames2 + lnames2)
     elif authors:
-        (fnames1, mnames1, lnames1, snames1) = break_name(authors[0])
+        (fnames1, mnames1, lnames1, snames1) = parse_name(authors[0])[:4]
         value = ' '.join(mnames1 + lnames1)
         if len(authors) > 2:
             value += ' et al.'
         return value
 
 def label_lastnames_list(authors):
-    broken_names = [break_name(a) for a in authors]
-    last_names   = [' '.join(mname + lname) for (fname, mname, lname, sname) in broken_names]
+    names      = [parse_name(a) for a in authors]
+    last_names = [' '.join(n.von + n.last) for n in names]
     return last_names
 
 def label_lastnames_all(authors):
@@ -482,19 +586,33 @@ def label_lastnames_first(authors):
     else:
         return '%s et~al\mbox{.}' % last_names[0]
 
-def label_generate_initials(citations):
+def label_initials_year(obj):
+    if not obj.author:
+        return None
+    author = [a.name.value if hasattr(a, 'name') else a.value for a in obj.author]
+    year = getattr(obj, 'year', None)
+    label = crosstex.style.label_initials(author)
+    if year:
+        if isinstance(year, crosstex.parse.Value):
+            label += '%02i' % (int(year.value) % 100)
+        else:
+            label += '%02i' % (year % 100)
+    return label
+
+def label_generate_initials(citations, initials=None):
+    '''Label each citation with initials and year, telling apart those that collide.
+
+    initials(cite, obj) returns the label before that, and defaults to
+    label_initials_year(obj).
+    '''
     by_label = collections.defaultdict(list)
     for cite, obj in citations:
-        if not obj.author:
+        if initials is not None:
+            label = initials(cite, obj)
+        else:
+            label = label_initials_year(obj)
+        if label is None:
             continue
-        author = [a.name.value if hasattr(a, 'name') else a.value for a in obj.author]
-        year = getattr(obj, 'year', None)
-        label = crosstex.style.label_initials(author)
-        if year:
-            if isinstance(year, crosstex.parse.Value):
-                label += '%02i' % (int(year.value) % 100)
-            else:
-                label += '%02i' % (year % 100)
         by_label[label].append(cite)
     by_cite = {}
     for label, citelist in by_label.items():
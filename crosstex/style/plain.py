@@ -180,7 +180,7 @@ class Style(crosstex.style.Style):
             cb = self._callback(obj.kind)
             if cb is None:
                 raise crosstex.style.UnsupportedCitation(obj.kind)
-            item = cb(obj)
+            item = self.reuse('item', cite, obj, cb, obj)
             label = label_dict[cite]
             if not in_list:
                 bib += self._fmt.list_begin()
@@ -202,7 +202,7 @@ class Style(crosstex.style.Style):
             labels = [''] * len(citations)
             longest = '0' * digits
         elif cite_by == 'initials':
-            labels = crosstex.style.label_generate_initials(citations)
+            labels = crosstex.style.label_generate_initials(citations, self._initials)
             if labels:
                 longest = max([(len(l), l) for l in labels])[1]
         elif cite_by == 'fullname':
@@ -216,6 +216,9 @@ class Style(crosstex.style.Style):
         label_dict = dict(zip([c for c, o in citations], labels))
         return label_dict, longest
 
+    def _initials(self, cite, obj):
+        return self.reuse('label', cite, obj, crosstex.style.label_initials_year, obj)
+
     def _callback(self, kind):
         if not hasattr(self, 'render_' + kind):
             return None
@@ -250,9 +253,9 @@ class Style(crosstex.style.Style):
         elif 'titlecase-upper' in self._flags:
             return crosstex.style.title_uppercase(title)
         elif 'titlecase-title' in self._flags:
-            return crosstex.style.title_titlecase(title, self._db.titlephrases())
+            return crosstex.style.title_titlecase(title, self._db.titlephrases_matcher())
         elif 'titlecase-lower' in self._flags:
-            return crosstex.style.title_lowercase(title, self._db.titlesmalls())
+            return crosstex.style.title_lowercase(title, self._db.titlesmalls_matcher())
         return title
 
     def render_booktitle(self, booktitle, context=None, history=None):
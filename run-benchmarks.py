@@ -0,0 +1,623 @@
+#! /usr/bin/python3
+
+import os
+import os.path
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from sys import exit, argv
+
+import crosstex
+import crosstex.cache
+import crosstex.client
+import crosstex.cmd
+import crosstex.objects
+import crosstex.parse
+import crosstex.server
+import crosstex.style
+
+results = []
+
+def make_database(directory, name, entries, includes=(), abstracts=True):
+    'Write a synthetic database with the given number of entries.'
+    path = os.path.join(directory, name + '.xtx')
+    with open(path, 'w') as fout:
+        for include in includes:
+            fout.write('@include %s\n' % include)
+        for i in range(entries):
+            fout.write('@inproceedings{%s%d,\n' % (name, i))
+            fout.write('    author = "Alice Author%d and Bob {van Builder} and Carol C. Coder",\n' % i)
+            fout.write('    title = "{A Study of Things Numbered %d}",\n' % i)
+            fout.write('    booktitle = "Proceedings of the Symposium on Benchmarks",\n')
+            if abstracts:
+                fout.write('    abstract = {%s},\n' % ('We study {things} in depth. ' * 20))
+            fout.write('    pages = "%d--%d",\n' % (i, i + 10))
+            fout.write('    year = %d,\n' % (1990 + i % 30))
+            fout.write('}\n\n')
+    return path
+
+def make_aux(directory, name, databases, citations=()):
+    path = os.path.join(directory, name + '.aux')
+    with open(path, 'w') as fout:
+        for c in citations:
+            fout.write('\\citation{%s}\n' % c)
+        fout.write('\\bibstyle{plain}\n')
+        fout.write('\\bibdata{%s}\n' % ','.join(databases))
+    return path
+
+def cache_dir(directory):
+    return os.path.join(directory, 'cache')
+
+def open_cache(directory):
+    return crosstex.cache.CacheStore(cache_dir(directory), crosstex.parse.GRAMMAR_VERSION)
+
+def remove_cache(directory):
+    shutil.rmtree(cache_dir(directory), ignore_errors=True)
+
+def report(name, seconds, note=''):
+    line = '%-40s %10.3f ms' % (name, seconds * 1000)
+    if note:
+        line += '  ' + note
+    print(line)
+    results.append((name, seconds))
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    value = func(*args, **kwargs)
+    return time.perf_counter() - start, value
+
+def bench_parse():
+    'Parse 40 databases referenced from one .aux file, without and with the cache.'
+    directory = tempfile.mkdtemp()
+    try:
+        names = ['db%02d' % i for i in range(40)]
+        for name in names:
+            make_database(directory, name, 25)
+        aux = make_aux(directory, 'paper', names)
+
+        crosstex.parse.reset_engine()
+        seconds, _ = timed(crosstex.parse.engine)
+        report('parse: build lexer and parser', seconds)
+
+        for run in ('first', 'second', 'cached'):
+            if run != 'cached':
+                remove_cache(directory)
+            parser = crosstex.parse.Parser([directory], cache=open_cache(directory))
+            seconds, _ = timed(parser.parse, aux)
+            report('parse: 40 databases (%s run)' % run, seconds,
+                   '%d entries' % len(parser.entries))
+    finally:
+        shutil.rmtree(directory)
+
+def bench_tokenize():
+    'Tokenize one large database with each tokenizer.'
+    directory = tempfile.mkdtemp()
+    try:
+        path = make_database(directory, 'large', 2000)
+        with open(path) as stream:
+            contents = stream.read()
+        for tokenizer in crosstex.parse.TOKENIZERS:
+            lexer, parser = crosstex.parse.engine(tokenizer)
+            lexer.file = 'large.xtx'
+            lexer.lineno = 1
+            lexer.expectstring = False
+            lexer.input(contents)
+            seconds, tokens = timed(lambda: sum(1 for t in iter(lexer.token, None)))
+            report('tokenize: %s' % tokenizer, seconds,
+                   '%d tokens, %d bytes' % (tokens, len(contents)))
+    finally:
+        shutil.rmtree(directory)
+
+def bench_jobs():
+    '''Parse 40 uncached databases with one process and with several.
+
+    Also reports the processor time this process takes, which is what is left
+    to wait for once the workers have processors of their own.  Small
+    databases are parsed in place whatever the number of jobs.
+    '''
+    directory = tempfile.mkdtemp()
+    try:
+        for entries in (250, 20):
+            names = ['db%d_%02d' % (entries, i) for i in range(40)]
+            for name in names:
+                make_database(directory, name, entries)
+            aux = make_aux(directory, 'paper%d' % entries, names)
+            for jobs in sorted(set([1, 2, 4, os.cpu_count() or 1])):
+                remove_cache(directory)
+                parser = crosstex.parse.Parser([directory], jobs=jobs, cache=open_cache(directory))
+                cpu = time.process_time()
+                seconds, _ = timed(parser.parse, aux)
+                report('jobs: 40x%d entries (%d jobs)' % (entries, jobs), seconds,
+                       '%d entries, %.0f ms in this process' %
+                       (len(parser.entries), (time.process_time() - cpu) * 1000))
+    finally:
+        shutil.rmtree(directory)
+
+def bench_merge():
+    'Merge 500 small databases, as if all included from one file.'
+    directory = tempfile.mkdtemp()
+    try:
+        dbs = []
+        for i in range(500):
+            path = make_database(directory, 'small%03d' % i, 4)
+            with open(path, 'a') as fout:
+                fout.write('@titlephrase "Phrase Number %d"\n' % i)
+                fout.write('@alias "alias%d" "small%03d0"\n' % (i, i))
+            dbs.append(crosstex.parse.parse_database(path))
+        for count in (125, 250, 500):
+            parser = crosstex.parse.Parser([directory])
+            def merge():
+                for db in dbs[:count]:
+                    db.merge(parser, follow=False)
+            seconds, _ = timed(merge)
+            report('merge: %d databases' % count, seconds,
+                   '%.3f ms per database' % (seconds * 1000 / count))
+    finally:
+        shutil.rmtree(directory)
+
+def bench_cached():
+    'Resolve 30 citations from a large cached database.'
+    directory = tempfile.mkdtemp()
+    try:
+        make_database(directory, 'large', 50000)
+        aux = make_aux(directory, 'paper', ['large'],
+                       ['large%d' % (i * 1657) for i in range(30)])
+        for run in ('uncached', 'cached'):
+            db = crosstex.Database(cache_dir=cache_dir(directory))
+            db.append_path(directory)
+            seconds, _ = timed(db.parse_file, aux)
+            report('cached: parse 50000 entries (%s)' % run, seconds)
+            seconds, _ = timed(lambda: [db.lookup(c) for c in db.aux_citations()])
+            report('cached: resolve 30 citations (%s)' % run, seconds)
+    finally:
+        shutil.rmtree(directory)
+
+def bench_columnar():
+    'Memory held by the raw entries of a large database, in dictionaries and in arrays.'
+    directory = tempfile.mkdtemp()
+    try:
+        entries = 10000
+        path = make_database(directory, 'large', entries, abstracts=False)
+        text = None
+        for columnar in (False, True):
+            seconds, db = timed(crosstex.parse.parse_database, path, 'fast', columnar)
+            del db
+            # parse again to measure, as tracing slows everything down
+            tracemalloc.start()
+            db = crosstex.parse.parse_database(path, 'fast', columnar)
+            held = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            if text is None:
+                text = sum([len(k.encode('utf-8')) for k in db.entries.keys()]) + \
+                       sum([len(f.value.value.encode('utf-8'))
+                            for es in db.entries.values() for e in es for f in e.fields])
+            report('columnar: %d entries (%s)' % (entries, 'arrays' if columnar else 'dictionaries'),
+                   seconds, '%d bytes per entry, %d beyond the text of its fields' %
+                   (held // entries, (held - text) // entries))
+            del db
+    finally:
+        shutil.rmtree(directory)
+
+def bench_serve():
+    'Render a 300-citation paper through a server, cold and warm.'
+    directory = tempfile.mkdtemp()
+    try:
+        names = ['db%d' % i for i in range(4)]
+        for name in names:
+            make_database(directory, name, 500)
+        make_aux(directory, 'paper', names,
+                 ['db%d%d' % (i % 4, i * 7 % 500) for i in range(300)])
+        path = os.path.join(directory, 'server.sock')
+        server = crosstex.server.Server(path)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            argv = ['--cache-dir', cache_dir(directory), 'paper.aux']
+            for run in ('cold', 'warm', 'warm'):
+                seconds, answer = timed(crosstex.client.request, path, argv, directory)
+                report('serve: 300 citations (%s)' % run, seconds,
+                       '%d bytes of output' % sum([len(t) for p, t in answer['files']]))
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+    finally:
+        shutil.rmtree(directory)
+
+def bench_watch():
+    'Run a 300-citation paper again after editing one entry, cold and as --watch does.'
+    directory = tempfile.mkdtemp()
+    try:
+        names = ['db%d' % i for i in range(4)]
+        for name in names:
+            make_database(directory, name, 500)
+        aux = make_aux(directory, 'paper', names,
+                       ['db%d%d' % (i % 4, i * 7 % 500) for i in range(300)])
+        for cache in ([], ['--no-cache']):
+            argv = ['-d', directory, '--cache-dir', cache_dir(directory)] + cache + [aux]
+            args, xtx = crosstex.cmd.prepare(argv)
+            crosstex.cmd.finish(args, xtx)
+            path = os.path.join(directory, 'db1.xtx')
+            with open(path) as fin:
+                text = fin.read()
+            with open(path, 'w') as fout:
+                fout.write(text.replace('Things Numbered 7}', 'Things Numbered Seven}'))
+            def cold():
+                return crosstex.cmd.finish(*crosstex.cmd.prepare(argv))
+            def again():
+                xtx.reload()
+                return crosstex.cmd.finish(args, xtx)
+            label = ' '.join(cache) or 'cache'
+            seconds, (status, outputs) = timed(cold)
+            report('watch: one edit (%s, cold)' % label, seconds)
+            seconds, (status, reloaded) = timed(again)
+            report('watch: one edit (%s, reload)' % label, seconds,
+                   'same output' if reloaded == outputs else 'DIFFERENT OUTPUT')
+            with open(path, 'w') as fout:
+                fout.write(text)
+    finally:
+        shutil.rmtree(directory)
+
+def bench_rendered():
+    'Sort and render a 1000-item bibliography, then again after citing one more entry.'
+    directory = tempfile.mkdtemp()
+    try:
+        make_database(directory, 'db', 1001)
+        argv = ['-d', directory, '--cache-dir', cache_dir(directory),
+                os.path.join(directory, 'paper.aux')]
+        for run, cited in (('nothing kept', 1000), ('one more citation', 1001)):
+            make_aux(directory, 'paper', ['db'], ['db%d' % i for i in range(cited)])
+            args, xtx = crosstex.cmd.prepare(argv)
+            citations = [(c, xtx.lookup(c)) for c in sorted(xtx.aux_citations())]
+            seconds, rendered = timed(lambda: xtx.render(xtx.sort(citations)))
+            report('rendered: %d items (%s)' % (cited, run), seconds,
+                   '%d bytes of output' % len(rendered))
+    finally:
+        shutil.rmtree(directory)
+
+def bench_titlecase():
+    'Render 1000 items with --titlecase title and 3000 title phrases.'
+    directory = tempfile.mkdtemp()
+    try:
+        with open(os.path.join(directory, 'phrases.xtx'), 'w') as fout:
+            for i in range(3000):
+                fout.write('@titlephrase "Phrase%d of Things"\n' % i)
+            for i in range(1000):
+                fout.write('@misc{paper%d, author = "Alice Author", title = "a study of'
+                           ' phrase%d of things and how they are numbered in titles", year = 2000}\n' % (i, i * 3))
+        make_aux(directory, 'paper', ['phrases'], ['paper%d' % i for i in range(1000)])
+        argv = ['-d', directory, '--no-cache', '--titlecase', 'title',
+                os.path.join(directory, 'paper.aux')]
+        args, xtx = crosstex.cmd.prepare(argv)
+        citations = [(c, xtx.lookup(c)) for c in sorted(xtx.aux_citations())]
+        seconds, rendered = timed(lambda: xtx.render(xtx.sort(citations)))
+        report('titlecase: 1000 items, 3000 phrases', seconds,
+               '%d bytes of output' % len(rendered))
+    finally:
+        shutil.rmtree(directory)
+
+def bench_batch():
+    'Build 24 papers citing one lab database, one run each and as one --batch.'
+    directory = tempfile.mkdtemp()
+    try:
+        make_database(directory, 'lab', 3000)
+        papers = []
+        for n in range(24):
+            paper = os.path.join(directory, 'paper%d' % n)
+            os.mkdir(paper)
+            papers.append(make_aux(paper, 'paper', ['lab'],
+                                   ['lab%d' % ((n * 97 + i * 31) % 3000) for i in range(40)]))
+        options = ['-d', directory, '--cache-dir', cache_dir(directory)]
+        crosstex.cmd.main(options + [papers[0]])
+        def separately():
+            for paper in papers:
+                args, xtx = crosstex.cmd.prepare(options + [paper])
+                crosstex.cmd.write(crosstex.cmd.finish(args, xtx)[1])
+        seconds, _ = timed(separately)
+        report('batch: 24 papers (one run each)', seconds)
+        for jobs in ('1', '4'):
+            seconds, status = timed(crosstex.cmd.main, options + ['-j', jobs, '--batch'] + papers)
+            report('batch: 24 papers (--batch -j %s)' % jobs, seconds)
+    finally:
+        shutil.rmtree(directory)
+
+def bench_semantic():
+    'Look up constrained citations in a large database, until its index is in the cache.'
+    directory = tempfile.mkdtemp()
+    try:
+        make_database(directory, 'large', 20000, abstracts=False)
+        for run in ('uncached', 'indexing', 'indexed'):
+            db = crosstex.Database(cache_dir=cache_dir(directory))
+            db.append_path(directory)
+            db.parse_file(os.path.join(directory, 'large.xtx'))
+            seconds, _ = timed(db.lookup, '!author19993')
+            report('semantic: first constraint (%s)' % run, seconds)
+            seconds, _ = timed(db.lookup, '!year=1995:numbered 15005')
+            report('semantic: next constraint (%s)' % run, seconds)
+    finally:
+        shutil.rmtree(directory)
+
+def make_places(fout):
+    fout.write('@country{usa, shortname = "USA", longname = "United States"}\n')
+    fout.write('@state{ny, shortname = "NY", longname = "New York", country = usa}\n')
+    fout.write('@location{ithaca, city = "Ithaca", state = ny}\n')
+    fout.write('@conference{sosp, shortname = "SOSP", longname = "Symposium on Principles"}\n')
+    fout.write('@workshop{hotos, shortname = "HotOS", longname = "Hot Topics", conference = sosp}\n')
+
+def bench_resolve():
+    'Resolve papers at the end of a long chain of aliases, and papers sharing many objects.'
+    directory = tempfile.mkdtemp()
+    try:
+        depth = 5000
+        with open(os.path.join(directory, 'chain.xtx'), 'w') as fout:
+            make_places(fout)
+            fout.write('@alias "venue0" "hotos"\n')
+            for i in range(1, depth):
+                fout.write('@alias "venue%d" "venue%d"\n' % (i, i - 1))
+            for i in range(200):
+                fout.write('@inproceedings{chain%d, author = "Alice Author", title = "Chained %d",'
+                           ' booktitle = venue%d, address = ithaca, year = 2000}\n' % (i, i, depth - 1))
+        with open(os.path.join(directory, 'fanout.xtx'), 'w') as fout:
+            make_places(fout)
+            for i in range(1000):
+                fout.write('@author{author%d, name = "Author %d", address = ithaca}\n' % (i, i))
+            fout.write('@inproceedings{everyone, author = "%s", title = "Everyone",'
+                       ' booktitle = hotos, year = 2000}\n' % ' and '.join(['author%d' % i for i in range(1000)]))
+            for i in range(2000):
+                fout.write('@inproceedings{fan%d, author = "author%d and author%d", title = "Fan %d",'
+                           ' booktitle = hotos, address = ithaca, year = 2000}\n' % (i, i % 1000, (i * 7) % 1000, i))
+        for name, keys in (('chain', ['chain%d' % i for i in range(200)]),
+                           ('fanout', ['everyone'] + ['fan%d' % i for i in range(2000)])):
+            db = crosstex.Database(use_cache=False)
+            db.append_path(directory)
+            db.parse_file(os.path.join(directory, name + '.xtx'))
+            seconds, objects = timed(lambda: [db.lookup(k) for k in keys])
+            report('resolve: %s (%d papers)' % (name, len(keys)), seconds,
+                   '%d resolved' % len([o for o in objects if o is not None]))
+    finally:
+        shutil.rmtree(directory)
+
+def bench_conditionals():
+    'Resolve papers inheriting many conditionals through conferences and authors.'
+    directory = tempfile.mkdtemp()
+    try:
+        years = range(1970, 2020)
+        with open(os.path.join(directory, 'conditionals.xtx'), 'w') as fout:
+            for y in years:
+                fout.write('@location{city%d, city = "City %d", name = "City %d"}\n' % (y, y, y))
+            for c in range(20):
+                fout.write('@conference{conf%d, shortname = "C%d", longname = "Conference %d",\n' % (c, c, c))
+                for y in years:
+                    fout.write('  [year = %d] address = city%d, volume = "%d",\n' % (y, y, y))
+                fout.write('}\n')
+                fout.write('@workshop{work%d, shortname = "W%d", longname = "Workshop %d", conference = conf%d,\n' % (c, c, c, c))
+                for y in years:
+                    fout.write('  [year = %d] month = "jun",\n' % y)
+                fout.write('  [month = "jun"] pages = "1--2"}\n')
+            for a in range(100):
+                fout.write('@author{author%d, name = "Author %d",\n' % (a, a))
+                for y in years[::5]:
+                    fout.write('  [year = %d] address = city%d,\n' % (y, y))
+                fout.write('}\n')
+            for i in range(2000):
+                fout.write('@inproceedings{paper%d, author = "author%d and author%d and author%d",'
+                           ' title = "Paper %d", booktitle = %s%d, year = %d}\n' %
+                           (i, i % 100, (i * 3) % 100, (i * 7) % 100, i,
+                            ('conf', 'work')[i % 2], i % 20, years[i % len(years)]))
+        db = crosstex.Database(use_cache=False)
+        db.append_path(directory)
+        db.parse_file(os.path.join(directory, 'conditionals.xtx'))
+        seconds, objects = timed(lambda: [db.lookup('paper%d' % i) for i in range(2000)])
+        report('conditionals: 2000 papers', seconds,
+               '%d resolved' % len([o for o in objects if o is not None]))
+    finally:
+        shutil.rmtree(directory)
+
+def bench_groups():
+    'Merge and resolve papers known by several keys and extended under each.'
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'groups.xtx')
+        with open(path, 'w') as fout:
+            make_places(fout)
+            for i in range(5000):
+                fout.write('@inproceedings{paper%d = p%d = short%d, author = "Alice Author",'
+                           ' title = "Grouped %d", booktitle = hotos, year = 2000}\n' % (i, i, i, i))
+                fout.write('@extend{p%d, address = ithaca}\n' % i)
+                fout.write('@extend{short%d, pages = "1--2"}\n' % i)
+        db = crosstex.Database(use_cache=False)
+        db.append_path(directory)
+        seconds, _ = timed(db.parse_file, path)
+        report('groups: parse 5000 papers', seconds)
+        keys = ['short%d' % i for i in range(5000)]
+        seconds, objects = timed(lambda: [db.lookup(k) for k in keys])
+        report('groups: resolve 5000 papers', seconds,
+               '%d resolved' % len([o for o in objects if o is not None]))
+    finally:
+        shutil.rmtree(directory)
+
+def bench_stored():
+    'Resolve 2000 papers, again with the objects in the cache, and after editing an author.'
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'stored.xtx')
+        def write(edited):
+            with open(path, 'w') as fout:
+                make_places(fout)
+                for a in range(200):
+                    fout.write('@author{author%d, name = "%s %d", address = ithaca,\n' %
+                               (a, 'Edited' if a == edited else 'Author', a))
+                    for y in range(1980, 2020, 4):
+                        fout.write('  [year = %d] institution = "Place %d",\n' % (y, y))
+                    fout.write('}\n')
+                for i in range(2000):
+                    fout.write('@inproceedings{paper%d, author = "author%d and author%d and author%d",'
+                               ' title = "Paper %d", booktitle = %s, year = %d}\n' %
+                               (i, i % 200, (i * 3) % 200, (i * 7) % 200, i,
+                                ('sosp', 'hotos')[i % 2], 1980 + i % 40))
+        keys = ['paper%d' % i for i in range(2000)]
+        write(None)
+        for run, edited in (('cold', None), ('warm', None), ('one author edited', 0)):
+            if edited is not None:
+                write(edited)
+            db = crosstex.Database(cache_dir=cache_dir(directory))
+            db.append_path(directory)
+            db.parse_file(path)
+            seconds, objects = timed(lambda: [db.lookup(k) for k in keys])
+            stored, _ = timed(db.store_resolved)
+            report('stored: 2000 papers (%s)' % run, seconds,
+                   '%d resolved, %.0f ms storing them' %
+                   (len([o for o in objects if o is not None]), stored * 1000))
+    finally:
+        shutil.rmtree(directory)
+
+def bench_objects():
+    'Resolve every entry of a large database, then read every field of each object.'
+    directory = tempfile.mkdtemp()
+    try:
+        path = make_database(directory, 'objects', 20000, abstracts=False)
+        keys = ['objects%d' % i for i in range(20000)]
+        for traced in (False, True):
+            db = crosstex.Database(use_cache=False)
+            db.append_path(directory)
+            db.parse_file(path)
+            if not traced:
+                seconds, objects = timed(lambda: [db.lookup(k) for k in keys])
+                report('objects: resolve 20000 entries', seconds,
+                       '%d resolved' % len([o for o in objects if o is not None]))
+                seconds, _ = timed(lambda: [[getattr(o, f) for f in o.allowed] for o in objects])
+                report('objects: read every field', seconds,
+                       '%d fields' % sum([len(o.allowed) for o in objects]))
+                continue
+            tracemalloc.start()
+            seconds, objects = timed(lambda: [db.lookup(k) for k in keys])
+            held = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            report('objects: resolve 20000 entries (traced)', seconds,
+                   '%d KiB held after resolving them' % (held // 1024))
+    finally:
+        shutil.rmtree(directory)
+
+def bench_construct():
+    'Construct 100000 objects from the fields Database._build hands them.'
+    value = crosstex.parse.Value(file='bench.xtx', line=1, kind='string', value='Value')
+    names = [crosstex.objects.author(name=value) for i in range(3)]
+    fields = {'author': names, 'title': value, 'booktitle': value, 'pages': value,
+              'year': value, 'address': value, 'abstract': value}
+    count = 100000
+    seconds, _ = timed(lambda: [crosstex.objects.inproceedings(**fields) for i in range(count)])
+    report('construct: %d objects' % count, seconds,
+           '%.2f us each' % (seconds / count * 1e6))
+
+def bench_names():
+    'Sort, label and render the authors of 5000 papers, written by 500 people.'
+    people = ['Alice B. Author%d and Bob {van Builder} Jr.' % i for i in range(500)]
+    papers = [[p for part in (people[i % 500], people[(i * 7) % 500]) for p in part.split(' and ')]
+              for i in range(5000)]
+    def names():
+        for authors in papers:
+            [crosstex.style.name_sort_last_first(a) for a in authors]
+            crosstex.style.label_initials(authors)
+            crosstex.style.names_shortfirst_last(authors)
+            crosstex.style.names_first_last(authors)
+            crosstex.style.label_lastnames_all(authors)
+    seconds, _ = timed(names)
+    report('names: 5000 papers, 500 people', seconds,
+           '%d names' % sum([len(authors) for authors in papers]))
+
+# Prints the peak RSS in KiB of parsing a database and resolving the citations
+# of an aux file, or of only importing crosstex with 'import' as the mode.
+# ru_maxrss starts at the peak of the process that started this one, so on
+# Linux the peak is reset first and read from VmHWM instead.
+MEMORY_CHILD = '''
+import resource, sys
+import crosstex
+try:
+    with open('/proc/self/clear_refs', 'w') as stream:
+        stream.write('5')
+    proc = True
+except (IOError, OSError):
+    proc = False
+if sys.argv[2] != 'import':
+    xtx = crosstex.CrossTeX(xtx_path=[sys.argv[1]], tokenizer='fast', use_mmap=sys.argv[2] == 'mmap',
+                            use_cache=False)
+    xtx.parse(sys.argv[3])
+    for c in xtx.aux_citations():
+        xtx.lookup(c)
+peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+if proc:
+    with open('/proc/self/status') as stream:
+        for line in stream:
+            if line.startswith('VmHWM:'):
+                peak = int(line.split()[1])
+print(peak)
+'''
+
+def bench_memory():
+    '''Peak memory of parsing a large database and resolving 30 citations.
+
+    Each mode runs in a process of its own, next to one that only imports
+    crosstex, and neither uses the cache, so that both only read the
+    database.  Pages of the file that were mapped and touched count towards
+    the peak with --mmap, so it still peaks above the size of the file.
+    '''
+    directory = tempfile.mkdtemp()
+    try:
+        path = make_database(directory, 'large', 60000)
+        aux = make_aux(directory, 'paper', ['large'],
+                       ['large%d' % (i * 1999) for i in range(30)])
+        size = os.path.getsize(path)
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join([os.path.dirname(os.path.abspath(__file__))] +
+                                            [p for p in env.get('PYTHONPATH', '').split(os.pathsep) if p])
+        baseline = None
+        for mode in ('import', 'read', 'mmap'):
+            seconds, out = timed(subprocess.check_output,
+                                 [sys.executable, '-c', MEMORY_CHILD, directory, mode, aux],
+                                 env=env)
+            kib = int(out.decode('ascii').strip().splitlines()[-1])
+            if baseline is None:
+                baseline = kib
+                report('memory: import crosstex', seconds, 'peak RSS %d KiB' % kib)
+            else:
+                report('memory: 60000 entries (%s)' % mode, seconds,
+                       'peak RSS %d KiB, %d KiB above importing, for a %d KiB file' %
+                       (kib, kib - baseline, size // 1024))
+    finally:
+        shutil.rmtree(directory)
+
+BENCHMARKS = [('parse', bench_parse),
+              ('tokenize', bench_tokenize),
+              ('jobs', bench_jobs),
+              ('merge', bench_merge),
+              ('cached', bench_cached),
+              ('columnar', bench_columnar),
+              ('serve', bench_serve),
+              ('watch', bench_watch),
+              ('rendered', bench_rendered),
+              ('titlecase', bench_titlecase),
+              ('batch', bench_batch),
+              ('semantic', bench_semantic),
+              ('resolve', bench_resolve),
+              ('conditionals', bench_conditionals),
+              ('groups', bench_groups),
+              ('stored', bench_stored),
+              ('objects', bench_objects),
+              ('construct', bench_construct),
+              ('names', bench_names),
+              ('memory', bench_memory)]
+
+if len(argv) < 2 or argv[1] == 'all':
+    selected = [b for n, b in BENCHMARKS]
+else:
+    selected = [b for n, b in BENCHMARKS if n in argv[1:]]
+    if not selected:
+        print('No such benchmark ' + ' '.join(argv[1:]))
+        exit(-1)
+
+for bench in selected:
+    bench()
@@ -1,11 +1,45 @@
 #! /usr/bin/python3
 
+import difflib
+import logging
 import os
 import os.path
+import pprint
+import re
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 from sys import exit, argv 
-from subprocess import call, DEVNULL
+from subprocess import call, run, Popen, DEVNULL, PIPE
+
+import crosstex
+import crosstex.client
+import crosstex.parse
+import crosstex.style
 
 DIR = "tests"
+DATABASE_DIRS = ["tests", "old-tests"]
+CACHE_DIR = os.path.join(tempfile.gettempdir(), "crosstex-tests-cache")
+REPO = os.path.dirname(os.path.abspath(__file__))
+CROSSTEX = [sys.executable, os.path.join(REPO, "bin", "crosstex")]
+# Run the crosstex of this tree, never forward to a server that happens to be
+# running, and warn in the same order every time
+ENV = dict(os.environ,
+           PYTHONPATH=os.pathsep.join(filter(None, [REPO, os.environ.get("PYTHONPATH")])),
+           CROSSTEX_SOCKET=os.path.join(tempfile.gettempdir(), "crosstex-tests-no-server.sock"),
+           PYTHONHASHSEED="0")
+# Options that change how databases are parsed and kept, which a cache written
+# without them must still serve correctly
+SWITCHES = [["--tokenizer", "fast"], ["--columnar"], ["--tokenizer", "fast", "--columnar"]]
+# Constrained citations, which are matched against what each entry refers to
+CONSTRAINTS = ["!sirer", "!schneider", "!g{\\\"u}n", "!renesse:gossip", "!2004", "!year=2005:hot",
+               "!booktitle=symposium", "!booktitle=hotos", "!booktitle=nsdi:2004", "!address=boston",
+               "!address=massachusetts", "!address=ithaca", "!title=revisited", "!gossip:2005",
+               "!month=may", "!journal=things", "!chain", "!chains", "!nomatch", "p4b"]
+# The key of each entry of a database, to cite them all
+ENTRY_KEY = re.compile(r"@\w+\s*\{\s*([^,\s{}]+)\s*,")
 num_tests = 0
 success = 0
 failure = 0
@@ -24,7 +58,7 @@ def run_test(path, filename):
         print("WARNING: xelatex failed")
 
     # Run test
-    res = call(["crosstex" , "-v", filename], cwd=DIR)
+    res = call(["crosstex" , "-v", "--cache-dir", CACHE_DIR, filename], cwd=DIR)
 
     # Compile final doc
     latex_res = latex_res and call(["xelatex", "-interaction", "errorstopmode", filename], cwd=DIR, stdout=DEVNULL)
@@ -37,8 +71,475 @@ def run_test(path, filename):
         failure += 1
 
     # Cleanup
-    call(["rm", "-f", "*.cache", filename + ".log", filename + ".aux"], cwd=DIR)
+    call(["rm", "-f", filename + ".log", filename + ".aux"], cwd=DIR)
+    shutil.rmtree(CACHE_DIR, ignore_errors=True)
+
+
+def tokenize(path, tokenizer):
+    with open(path) as stream:
+        contents = stream.read()
+    lexer, parser = crosstex.parse.engine(tokenizer)
+    lexer.file = os.path.basename(path)
+    lexer.lineno = 1
+    lexer.expectstring = False
+    lexer.input(contents)
+    return [(t.type, t.value, t.lineno, t.lexpos) for t in iter(lexer.token, None)]
+
+def run_lexer_test(path):
+    'Check that the fast tokenizer emits exactly the tokens of the PLY lexer'
+    global num_tests
+    global success
+    global failure
+
+    print("### Comparing tokenizers on " + path)
+
+    expected = tokenize(path, 'ply')
+    actual = tokenize(path, 'fast')
+
+    num_tests += 1
+
+    if expected == actual:
+        success += 1
+    else:
+        failure += 1
+        for i, (e, a) in enumerate(zip(expected + [None], actual + [None])):
+            if e != a:
+                print("token %d: ply gives %r, fast gives %r" % (i, e, a))
+                break
+
+def run_lexer_tests():
+    for d in DATABASE_DIRS:
+        for filename in sorted(os.listdir(d)):
+            if filename.endswith(".xtx") or filename.endswith(".bib"):
+                run_lexer_test(d + "/" + filename)
+
+def check(description, expected, actual):
+    'Count a test that passes if actual equals expected, and show how they differ if not'
+    global num_tests
+    global success
+    global failure
+
+    num_tests += 1
+
+    if expected == actual:
+        success += 1
+    else:
+        failure += 1
+        print("FAILED: " + description)
+        for line in difflib.unified_diff(pprint.pformat(expected).splitlines(),
+                                         pprint.pformat(actual).splitlines(),
+                                         "expected", "actual", lineterm=""):
+            print(line)
+
+def write_file(path, contents):
+    with open(path, "w") as f:
+        f.write(contents)
+
+def edit_file(path, old, new):
+    with open(path) as f:
+        contents = f.read()
+    assert old in contents
+    write_file(path, contents.replace(old, new))
+
+def write_aux(path, citations, databases):
+    with open(path, "w") as aux:
+        for citation in citations:
+            aux.write("\\citation{%s}\n" % citation)
+        aux.write("\\bibstyle{plain}\n\\bibdata{%s}\n" % ",".join(databases))
+
+def run_crosstex(args, cwd, env=ENV):
+    'Run crosstex with args in cwd and return (status, bbls, stderr)'
+    bbls = [f[:-4] for f in args if f.endswith(".aux")]
+    for name in bbls:
+        if os.path.exists(os.path.join(cwd, name + ".bbl")):
+            os.remove(os.path.join(cwd, name + ".bbl"))
+    res = run(CROSSTEX + args, cwd=cwd, env=env, stdout=PIPE, stderr=PIPE, universal_newlines=True)
+    contents = []
+    for name in bbls:
+        path = os.path.join(cwd, name + ".bbl")
+        if os.path.exists(path):
+            with open(path) as bbl:
+                contents.append(bbl.read())
+        else:
+            contents.append(None)
+    return (res.returncode, contents, res.stderr)
+
+def run_cache_test(path):
+    'Check that runs with a cold and a warm cache cite every entry of a database as a run without one'
+    print("### Comparing cached runs on " + path)
+
+    directory = tempfile.mkdtemp()
+    cache = os.path.join(directory, "cache")
+    with open(path) as database:
+        keys = sorted(set(ENTRY_KEY.findall(database.read())))
+    write_aux(os.path.join(directory, "doc.aux"), keys, [os.path.splitext(os.path.basename(path))[0]])
+    args = ["-d", os.path.abspath(os.path.dirname(path)), "doc.aux"]
+
+    expected = run_crosstex(["--no-cache"] + args, directory)
+    check("cold cache on " + path, expected, run_crosstex(["--cache-dir", cache] + args, directory))
+    check("warm cache on " + path, expected, run_crosstex(["--cache-dir", cache] + args, directory))
+    for options in SWITCHES:
+        check("warm cache with %s on %s" % (" ".join(options), path),
+              run_crosstex(["--no-cache"] + options + args, directory),
+              run_crosstex(["--cache-dir", cache] + options + args, directory))
+
+    shutil.rmtree(directory)
+
+def run_include_test():
+    'Check that the cache notices edits to a database that another one includes'
+    print("### Editing an included database")
+
+    directory = tempfile.mkdtemp()
+    write_file(os.path.join(directory, "main.xtx"),
+               '@include other\n'
+               '@misc{first, author = "Ann Smith", title = "First paper", year = 2001}\n')
+    write_file(os.path.join(directory, "other.xtx"),
+               '@misc{second, author = "Bo Jones", title = "Second paper", year = 2002}\n')
+    write_file(os.path.join(directory, "third.xtx"),
+               '@misc{third, author = "Cy Young", title = "Third paper", year = 2003}\n')
+    write_aux(os.path.join(directory, "doc.aux"), ["first", "second"], ["main"])
+    args = ["--cache-dir", os.path.join(directory, "cache"), "doc.aux"]
+    run_crosstex(args, directory)
+
+    edit_file(os.path.join(directory, "other.xtx"), "Second paper", "Second paper, revised")
+    check("edited included database", run_crosstex(["--no-cache", "doc.aux"], directory),
+          run_crosstex(args, directory))
+    edit_file(os.path.join(directory, "other.xtx"), "@misc", "@include third\n@misc")
+    write_aux(os.path.join(directory, "doc.aux"), ["first", "second", "third"], ["main"])
+    check("include added to an included database", run_crosstex(["--no-cache", "doc.aux"], directory),
+          run_crosstex(args, directory))
+
+    shutil.rmtree(directory)
+
+def write_proceedings(directory):
+    'Write main.xtx, which includes people.xtx, and doc.aux, which cites from it, to directory'
+    write_file(os.path.join(directory, "people.xtx"),
+               '@location{boston, city = "Boston", name = "Boston, MA"}\n'
+               '@author{al, name = "Al Smith", [year = 2004] address = boston}\n'
+               '@author{bo, name = "Bo Jones"}\n')
+    write_file(os.path.join(directory, "main.xtx"),
+               '@include people\n'
+               '@conference{conf, shortname = "CONF", longname = "Some Conference",\n'
+               '  [year = 2004] month = "mar", [month = "mar"] pages = "1--10"}\n'
+               '@inproceedings{a, author = "al and bo", title = "A", booktitle = conf, year = 2004}\n'
+               '@inproceedings{b, author = "Cy Young", title = "B", booktitle = conf, year = 2005}\n'
+               '@inproceedings{c, author = "al", title = "C", booktitle = conf, year = 2005}\n')
+    write_aux(os.path.join(directory, "doc.aux"), ["a", "b", "c"], ["main"])
+
+def run_resolved_test():
+    'Check that the cache rebuilds resolved objects when an entry they read changes'
+    print("### Editing entries that resolved objects read")
+
+    directory = tempfile.mkdtemp()
+    write_proceedings(directory)
+    args = ["--cache-dir", os.path.join(directory, "cache"), "doc.aux"]
+    run_crosstex(args, directory)
+
+    for description, name, old, new in [
+            ("author of two citations", "people.xtx", '"Al Smith"', '"Alan Smith"'),
+            ("author of one citation", "people.xtx", '"Bo Jones"', '"Bob Jones"'),
+            ("conference", "main.xtx", '"Some Conference"', '"Another Conference"'),
+            ("conditional", "main.xtx", '[year = 2004] month = "mar"', '[year = 2005] month = "mar"')]:
+        edit_file(os.path.join(directory, name), old, new)
+        check("resolved objects after editing the " + description,
+              run_crosstex(["--no-cache", "doc.aux"], directory), run_crosstex(args, directory))
+
+    shutil.rmtree(directory)
+
+def constraint_matches(directory, scan, **options):
+    'The title of what each of CONSTRAINTS resolves to, looking at every entry if scan'
+    candidates = crosstex.Constraint.candidates
+    level = logging.getLogger("crosstex").level
+    if scan:
+        crosstex.Constraint.candidates = lambda self, index, alias: None
+    logging.getLogger("crosstex").setLevel(logging.CRITICAL)
+    try:
+        db = crosstex.Database(**options)
+        db.append_path(directory)
+        db.parse_file(os.path.join(directory, "main.xtx"))
+        matches = []
+        for citation in CONSTRAINTS:
+            obj = db.lookup(citation)
+            matches.append((citation, obj and str(obj.title.value)))
+        return matches
+    finally:
+        crosstex.Constraint.candidates = candidates
+        logging.getLogger("crosstex").setLevel(level)
+
+def run_constraint_test():
+    'Check that constrained citations match the same entries with and without the cache'
+    print("### Citing by constraints")
+
+    directory = tempfile.mkdtemp()
+    write_file(os.path.join(directory, "places.xtx"),
+               '@state{ma, shortname = "MA", longname = "Massachusetts"}\n'
+               '@location{boston, city = "Boston", state = ma}\n'
+               '@location{ithaca, name = "Ithaca, NY"}\n')
+    write_file(os.path.join(directory, "main.xtx"),
+               '@include places\n'
+               '@author{egs, name = "Emin G{\\"u}n Sirer", shortname = "E. G. Sirer"}\n'
+               '@author{fbs, name = "Fred B. Schneider"}\n'
+               '@alias "sirer" "egs"\n'
+               '@conference{sosp, shortname = "SOSP", longname = "Symposium on Operating Systems Principles",\n'
+               '  [year = 2003] address = ithaca}\n'
+               '@conference{nsdi, shortname = "NSDI", longname = "Networked Systems Design and Implementation",\n'
+               '  [year = 2004] address = boston}\n'
+               '@workshop{hotos, shortname = "HotOS", longname = "Workshop on Hot Topics"}\n'
+               '@inproceedings{p1, author = "egs and Robbert van Renesse", title = "Gossip Things",\n'
+               '  booktitle = sosp, year = 2003}\n'
+               '@inproceedings{p2, author = "fbs", title = "Chain Replication", booktitle = nsdi, year = 2004}\n'
+               '@inproceedings{p3, author = "fbs and egs", title = "Hot Chains", booktitle = hotos, year = 2005}\n'
+               '@inproceedings{p4 = p4b, author = "Robbert van Renesse", title = "Gossip Revisited",\n'
+               '  booktitle = nsdi, year = 2005, month = "may"}\n'
+               '@article{a1, author = "Zed Alice", title = "Things in Journals", journal = "Journal of Things",\n'
+               '  year = 2004}\n')
+    write_aux(os.path.join(directory, "doc.aux"), CONSTRAINTS, ["main"])
+    cache = ["--cache-dir", os.path.join(directory, "cache")]
+
+    expected = run_crosstex(["--no-cache", "doc.aux"], directory)
+    for description, args in [("cold cache", cache), ("warm cache", cache),
+                              ("--columnar", ["--no-cache", "--columnar"]), ("--mmap", ["--no-cache", "--mmap"])]:
+        check("constrained citations with " + description, expected,
+              run_crosstex(args + ["doc.aux"], directory))
+    # The candidates the index gives must include every entry that matches
+    for description, options in [("without the cache", dict(use_cache=False)),
+                                 ("with a warm cache", dict(cache_dir=os.path.join(directory, "cache"))),
+                                 ("with --columnar", dict(use_cache=False, columnar=True))]:
+        check("constrained citations %s against every entry" % description,
+              constraint_matches(directory, True, **options), constraint_matches(directory, False, **options))
+
+    shutil.rmtree(directory)
+
+def run_concurrent_test(runs=4, entries=2000):
+    'Check that runs sharing a cold cache at the same time agree with a run without it'
+    print("### Running %d times at once with one cache" % runs)
+
+    directory = tempfile.mkdtemp()
+    write_file(os.path.join(directory, "big.xtx"), "".join(
+        '@misc{entry%d, author = "Author %d and Other Person", title = "Paper number %d", year = %d}\n'
+        % (i, i % 97, i, 1950 + i % 60) for i in range(entries)))
+    for i in range(runs):
+        write_aux(os.path.join(directory, "doc%d.aux" % i), ["entry%d" % j for j in range(0, entries, 7)], ["big"])
+
+    expected = run_crosstex(["--no-cache", "doc0.aux"], directory)
+    cached = ["--cache-dir", os.path.join(directory, "cache")]
+    with ThreadPoolExecutor(runs) as pool:
+        results = list(pool.map(lambda i: run_crosstex(cached + ["doc%d.aux" % i], directory), range(runs)))
+    for i, result in enumerate(results):
+        check("concurrent run %d" % i, expected, result)
+
+    shutil.rmtree(directory)
+
+def run_jobs_test(databases=4, entries=400):
+    'Check that parsing databases in worker processes gives what parsing them in turn gives'
+    print("### Parsing %d databases in worker processes" % databases)
+
+    directory = tempfile.mkdtemp()
+    names = ["db%d" % i for i in range(databases)]
+    for name in names:
+        # Large enough to be handed to a worker, and with a warning to pass on
+        write_file(os.path.join(directory, name + ".xtx"), "".join(
+            '@misc{%s_%d, author = "Author %d", title = "%s paper %d: %s", year = %d, foofoo = "x"}\n'
+            % (name, i, i % 31, name, i, "words " * 30, 1950 + i % 60) for i in range(entries)))
+    write_aux(os.path.join(directory, "doc.aux"), ["%s_%d" % (name, i) for name in names for i in (0, 7, 99)],
+              names)
+
+    expected = run_crosstex(["--no-cache", "doc.aux"], directory)
+    cache = ["--cache-dir", os.path.join(directory, "cache")]
+    check("--no-cache -j 3", expected, run_crosstex(["--no-cache", "-j", "3", "doc.aux"], directory))
+    check("cold cache -j 3", expected, run_crosstex(cache + ["-j", "3", "doc.aux"], directory))
+    check("warm cache -j 3", expected, run_crosstex(cache + ["-j", "3", "doc.aux"], directory))
+
+    shutil.rmtree(directory)
+
+def run_cache_tests():
+    for d in DATABASE_DIRS:
+        for filename in sorted(os.listdir(d)):
+            if filename.endswith(".xtx") or filename.endswith(".bib"):
+                run_cache_test(d + "/" + filename)
+    run_include_test()
+    run_resolved_test()
+    run_constraint_test()
+    run_concurrent_test()
+    run_jobs_test()
+
+def wait_until(condition, timeout=30):
+    'Wait until condition() is true; returns False if it is still false after timeout seconds'
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.1)
+    return True
+
+def read_file(path):
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return f.read()
+
+def run_server_test():
+    'Check that commands served or forwarded by crosstex serve write what a local run writes'
+    print("### Running through crosstex serve")
+
+    directory = tempfile.mkdtemp()
+    write_proceedings(directory)
+    socket = os.path.join(directory, "crosstex.sock")
+    env = dict(ENV, CROSSTEX_SOCKET=socket, XDG_CACHE_HOME=os.path.join(directory, "cache"))
+    server = Popen(CROSSTEX + ["serve"], cwd=directory, env=env, stdout=DEVNULL, stderr=DEVNULL)
+    check("server listening", True, wait_until(lambda: os.path.exists(socket)))
+
+    def served():
+        answer = crosstex.client.request(socket, ["doc.aux"], directory)
+        return (answer["status"], [dict(answer["files"]).get("doc.bbl")], answer["stderr"])
+
+    try:
+        for edit in [None, None, ("people.xtx", '"Al Smith"', '"Alan Smith"'),
+                     ("main.xtx", '[year = 2004] month = "mar"', '[year = 2005] month = "mar"')]:
+            if edit is not None:
+                edit_file(os.path.join(directory, edit[0]), edit[1], edit[2])
+            expected = run_crosstex(["--no-cache", "doc.aux"], directory)
+            check("served run", expected, served())
+            check("forwarded run", expected, run_crosstex(["doc.aux"], directory, env))
+    finally:
+        server.terminate()
+        server.wait()
+
+    shutil.rmtree(directory)
+
+def run_watch_test():
+    'Check that --watch runs again when a database is touched, and writes what a new run writes'
+    print("### Watching a document")
+
+    directory = tempfile.mkdtemp()
+    write_proceedings(directory)
+    shutil.copy(os.path.join(directory, "doc.aux"), os.path.join(directory, "local.aux"))
+    bbl = os.path.join(directory, "doc.bbl")
+    log = os.path.join(directory, "watch.log")
+    with open(log, "w") as stderr:
+        watcher = Popen(CROSSTEX + ["-v", "--watch", "--cache-dir", os.path.join(directory, "cache"),
+                                    "doc.aux"], cwd=directory, env=ENV, stdout=DEVNULL, stderr=stderr)
+    try:
+        check("first run under --watch", True, wait_until(lambda: os.path.exists(bbl)))
+        os.utime(os.path.join(directory, "people.xtx"))
+        check("run again after touching a database", True,
+              wait_until(lambda: "running again" in read_file(log)))
+        for name, old, new in [("people.xtx", '"Al Smith"', '"Alan Smith"'),
+                               ("main.xtx", '[year = 2004] month = "mar"', '[year = 2005] month = "mar"')]:
+            before = read_file(bbl)
+            edit_file(os.path.join(directory, name), old, new)
+            check("run again after editing " + name, True, wait_until(lambda: read_file(bbl) != before))
+            check("--watch after editing " + name, run_crosstex(["--no-cache", "local.aux"], directory)[1],
+                  [read_file(bbl)])
+    finally:
+        watcher.terminate()
+        watcher.wait()
+
+    shutil.rmtree(directory)
+
+def run_batch_test():
+    'Check that building two documents in one run writes what two separate runs write'
+    print("### Building two documents at once")
+
+    directory = tempfile.mkdtemp()
+    write_proceedings(directory)
+    write_aux(os.path.join(directory, "other.aux"), ["c", "b"], ["main"])
+    documents = ["doc.aux", "other.aux"]
+    write_file(os.path.join(directory, "documents.txt"), "# both documents\n\n" + "\n".join(documents) + "\n")
+
+    def build(args):
+        for name in documents:
+            if os.path.exists(os.path.join(directory, name[:-4] + ".bbl")):
+                os.remove(os.path.join(directory, name[:-4] + ".bbl"))
+        status, bbls, stderr = run_crosstex(args, directory)
+        return (status, [read_file(os.path.join(directory, name[:-4] + ".bbl")) for name in documents],
+                sorted(stderr.splitlines()))
+
+    separate = [run_crosstex(["--no-cache", name], directory) for name in documents]
+    expected = (max(status for status, bbls, stderr in separate),
+                [bbls[0] for status, bbls, stderr in separate],
+                sorted(line for status, bbls, stderr in separate for line in stderr.splitlines()))
+    cache = ["--cache-dir", os.path.join(directory, "cache")]
+    for args in [["--no-cache", "--batch"] + documents,
+                 ["--no-cache", "--manifest", "documents.txt"],
+                 ["--no-cache", "-j", "2", "--manifest", "documents.txt"],
+                 cache + ["--batch"] + documents,
+                 cache + ["-j", "2", "--batch"] + documents]:
+        check(" ".join(args), expected, build(args))
+
+    shutil.rmtree(directory)
+
+def run_command_tests():
+    run_server_test()
+    run_watch_test()
+    run_batch_test()
+
+# Overlapping, multi-word, punctuated and case-only variants of one another
+PHRASES = ["OS", "Operating Systems", "Operating", "TCP/IP", "IPv6", "iPhone", "IPHONE",
+           "New York", "New", "SQL", "x86-64"]
+
+def longest_by_scan(phrases, title, i):
+    'The phrase title_titlecase would match at i by trying every phrase in sorted order'
+    match = ''
+    for phrase in sorted(phrases):
+        if title.lower().startswith(phrase.lower(), i) and len(phrase) > len(match) and \
+           (i + len(phrase) >= len(title) - 1 or not title[i + len(phrase)].isalnum()):
+            match = phrase
+    return match
+
+def run_title_tests():
+    'Check the phrases title_titlecase and title_lowercase keep, and how they case a title'
+    print("### Casing titles with phrases")
+
+    phrases = crosstex.style.Phrases(PHRASES)
+    for title, i, expected in [
+            ("operating systems design", 0, "Operating Systems"),
+            ("operating system", 0, "Operating"),
+            ("new york city", 0, "New York"),
+            ("new yorker", 0, "New"),
+            ("an os", 3, "OS"),
+            ("os.", 0, "OS"),
+            ("os-x", 0, "OS"),
+            ("os}", 0, "OS"),
+            ("tcp/ip stack", 0, "TCP/IP"),
+            ("oss x", 0, ""),
+            # A phrase one character from the end of the title matches whatever follows it
+            ("osx", 0, "OS"),
+            ("sq", 0, ""),
+            # Of phrases that differ only in case, the first in sorted order wins
+            ("iphone apps", 0, "IPHONE")]:
+        check("phrase at %d of %r" % (i, title), expected, phrases.longest(title, title.lower(), i))
+
+    titles = ["the design of operating systems for iphone and tcp/ip",
+              "a {new york} os.",
+              "osx and os/2: new-york, os!",
+              "operating systems: the $os$ in \\emph{os} use",
+              "ipv6 on x86-64 in new york",
+              "new yorker and operatings",
+              "MySQL OS"]
+    for title in titles:
+        check("phrases of %r against every phrase" % title,
+              [longest_by_scan(PHRASES, title, i) for i in range(len(title))],
+              [phrases.longest(title, title.lower(), i) for i in range(len(title))])
 
+    check("titlecase", [
+        "The Design Of Operating Systems For IPHONE And TCP/IP",
+        "A {new york} OS.",
+        "Osx And OS/2: New-York, OS!",
+        "Operating Systems: The $os$ In \\emph{OS} Use",
+        "IPv6 On x86-64 In New York",
+        "New Yorker And Operatings",
+        "MySQL OS"], [crosstex.style.title_titlecase(title, phrases) for title in titles])
+    check("titlecase with a list of phrases", [crosstex.style.title_titlecase(title, phrases) for title in titles],
+          [crosstex.style.title_titlecase(title, PHRASES) for title in titles])
+    check("lowercase", [
+        "the design of operating systems for iphone and tcp/ip",
+        "a {new york} os.",
+        "osx and os/2: new-york, os!",
+        "operating systems: the $os$ in \\emph{os} use",
+        "ipv6 on x86-64 in new york",
+        "new yorker and operatings",
+        "mysql os"], [crosstex.style.title_lowercase(title, ["os", "new york"]) for title in titles])
 
 def run_all_tests():
     for filename in os.listdir(DIR):
@@ -50,7 +551,19 @@ def run_all_tests():
         run_test(path, filename)
 
 if len(argv) < 2 or argv[1] == "all":
+    run_lexer_tests()
+    run_cache_tests()
+    run_command_tests()
+    run_title_tests()
     run_all_tests()
+elif argv[1] == "lexer":
+    run_lexer_tests()
+elif argv[1] == "titles":
+    run_title_tests()
+elif argv[1] == "cache":
+    run_cache_tests()
+elif argv[1] == "commands":
+    run_command_tests()
 else:
     name = argv[1]
 
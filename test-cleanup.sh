@@ -1,7 +1,6 @@
 #! /bin/bash
 
 cd ./tests
-rm -f *.bib.cache
 rm -f *.log
 rm -f *.aux
 rm -f *.bbl